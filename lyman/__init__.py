@@ -1 +1,9 @@
-from tools import *
+from .tools.lazy import lazy_package
+
+# Names from lyman.tools are available here, but nothing heavy
+# is imported until one of them is used
+lazy_package(__name__, {"tools": None,
+                        "workflows": None,
+                        "evoked": None,
+                        "mvpa": None},
+             default=".tools")
@@ -14,8 +14,13 @@ from scipy.interpolate import interp1d
 import pandas as pd
 import nibabel as nib
 import nitime as nit
+from multiprocessing import Pool
 
 from lyman import gather_project_info
+from lyman.tools.masks import Mask, get_registry
+
+
+event_dtype = [("run", int), ("onset", float), ("condition", int)]
 
 
 def extract_subject(subj, mask_name, summary_func=np.mean,
@@ -26,8 +31,8 @@ def extract_subject(subj, mask_name, summary_func=np.mean,
     ----------
     subj : string
         subject name
-    mask_name : string
-        name of mask in data hierarchy
+    mask_name : string or Mask
+        name of mask in data hierarchy, or the mask itself
     summary_func : callable or None
         callable to reduce data over voxel dimensions. can take an
         ``axis`` argument to operate over each frame, if this
@@ -56,6 +61,16 @@ def extract_subject(subj, mask_name, summary_func=np.mean,
     except OSError:
         pass
 
+    # Find the mask and what identifies its current version
+    if isinstance(mask_name, Mask):
+        mask = mask_name
+        mask_stamp = mask.digest()
+        mask_name = mask.name or mask_stamp[:12]
+    else:
+        mask = None
+        masks = get_registry(project["data_dir"])
+        mask_stamp = str(masks.mtime(subj, mask_name))
+
     if summary_func is None:
         func_name = ""
     else:
@@ -65,8 +80,6 @@ def extract_subject(subj, mask_name, summary_func=np.mean,
     cache_file = op.join(cache_dir, cache_fname)
 
     # Get paths to the relevant files
-    mask_file = op.join(project["data_dir"], subj, "masks",
-                        "%s.nii.gz" % mask_name)
     ts_dir = op.join(project["analysis_dir"], exp_name, subj,
                      "reg", "epi", "unsmoothed")
     n_runs = len(glob(op.join(ts_dir, "run_*")))
@@ -76,7 +89,7 @@ def extract_subject(subj, mask_name, summary_func=np.mean,
     # Get the hash value for this extraction
     cache_hash = hashlib.sha1()
     cache_hash.update(mask_name)
-    cache_hash.update(str(op.getmtime(mask_file)))
+    cache_hash.update(mask_stamp)
     for ts_file in ts_files:
         cache_hash.update(str(op.getmtime(ts_file)))
     cache_hash = cache_hash.hexdigest()
@@ -89,10 +102,11 @@ def extract_subject(subj, mask_name, summary_func=np.mean,
 
     # Otherwise, do the extraction
     data = []
-    mask = nib.load(mask_file).get_data().astype(bool)
+    if mask is None:
+        mask = masks.get(subj, mask_name)
     for run, ts_file in enumerate(ts_files):
         ts_data = nib.load(ts_file).get_data()
-        roi_data = ts_data[mask].T
+        roi_data = mask.gather(ts_data).T
 
         if summary_func is None:
             data.append(roi_data)
@@ -123,8 +137,8 @@ def extract_group(mask_name, summary_func=np.mean,
 
     Parameters
     ----------
-    mask_name : string
-        name of mask in data hierarchy
+    mask_name : string or Mask
+        name of mask in data hierarchy, or a mask used for every subject
     summary_func : callable or None
         callable to reduce data over voxel dimensions. can take an
         ``axis`` argument to operate over each frame, if this
@@ -155,12 +169,21 @@ def extract_group(mask_name, summary_func=np.mean,
         subj_file = op.join(os.environ["LYMAN_DIR"], "subjects.txt")
         subjects = np.loadtxt(subj_file, str).tolist()
 
+    # Fail before extracting anything if some subjects lack the mask
+    masks = None
+    if not isinstance(mask_name, Mask):
+        project = gather_project_info()
+        masks = get_registry(project["data_dir"])
+        masks.require(mask_name, subjects)
+
     mask_name = [mask_name for s in subjects]
     summary_func = [summary_func for s in subjects]
     exp_name = [exp_name for s in subjects]
 
     data = _map(extract_subject, subjects, mask_name,
                 summary_func, exp_name)
+    if masks is not None:
+        masks.flush()
     for d in data:
         d["data"] = np.asarray(d["data"])
 
@@ -170,7 +193,8 @@ def extract_group(mask_name, summary_func=np.mean,
 def calculate_evoked(data, n_bins, problem=None, events=None, tr=2,
                      calc_method="FIR", offset=0, upsample=1,
                      percent_change=True, correct_baseline=True,
-                     event_names=None):
+                     event_names=None, runwise=False, cache=False,
+                     exp_name=None, dv=None, n_jobs=1):
     """Calcuate an evoked response for a list of datapoints.
 
     Parameters
@@ -201,78 +225,424 @@ def calculate_evoked(data, n_bins, problem=None, events=None, tr=2,
         if True, adjust evoked trace to be 0 in first bin
     event_names : list of strings
         names of conditions, otherwise uses sorted unique
-        values for the condition field in the event dataframe
+        values for the condition field in the event dataframes
+    runwise : boolean
+        if True, accumulate the data with an ``EvokedAccumulator`` one
+        run at a time so the runs are never concatenated and
+        peristimulus windows do not extend across run boundaries
+        (requires `FIR` or `eta` method)
+    cache : boolean
+        if True, store each subject's result in the `evoked` directory
+        of the analysis hierarchy and load it on later calls with the
+        same data, events and parameters. there is one file for each
+        set of parameters, which is overwritten when the data change
+    exp_name : string
+        experiment name for the cache, if not using the default
+    dv : IPython cluster direct view
+        if provided with view on cluster, executes in parallel over
+        subjects
+    n_jobs : int
+        if no direct view is provided and this is greater than 1,
+        executes in parallel over subjects with a local process pool
 
     Returns
     -------
 
-    evoked : squeezed n_obs x n_class x n_bins array
-        evoked response, by observation and event type
+    evoked : squeezed n_obs x n_class x n_bins (x n_vox) array
+        evoked response, by observation and event type; conditions
+        that do not occur for an observation are filled with NaN.
+        if the number of voxels differs across observations, this is
+        instead a list with a squeezed array for each observation
 
     """
-    project = gather_project_info()
-    event_template = op.join(project["data_dir"], "%s",
-                             "events/%s.csv" % problem)
+    # Parse all of the event information once, up front
+    schedules, event_names = _parse_events(data, problem, events, event_names)
+    n_cond = len(event_names)
+
+    # Determine the shape of the output
+    calc_tr = float(tr) / upsample
+    calc_bins = n_bins * upsample
+    vox_shapes = []
+    for data_i in data:
+        run_shapes = set(np.shape(run)[1:] for run in data_i["data"])
+        if len(run_shapes) > 1:
+            raise ValueError("Runs for %s have different voxel shapes: %s"
+                             % (data_i["subj"], sorted(run_shapes)))
+        vox_shapes.append(run_shapes.pop())
+    ragged = len(set(vox_shapes)) > 1
+
+    # Bundle the arguments so the map works with a process pool
+    params = (n_cond, calc_bins, calc_tr, calc_method, offset,
+              upsample, percent_change, correct_baseline, runwise)
+    args = [(d["data"], sched) + params for d, sched in zip(data, schedules)]
+
+    # Possibly find cached results from a previous call
+    if ragged:
+        evoked = [np.empty((n_cond, calc_bins) + shape)
+                  for shape in vox_shapes]
+    else:
+        evoked = np.empty((len(data), n_cond, calc_bins) + vox_shapes[0])
+    cache_files = [None for _ in data]
+    cache_hashes = [None for _ in data]
+    if cache:
+        project = gather_project_info()
+        if exp_name is None:
+            exp_name = project["default_exp"]
+        for i, (data_i, sched) in enumerate(zip(data, schedules)):
+            cache_dir = op.join(project["analysis_dir"],
+                                exp_name, data_i["subj"], "evoked")
+            params_hash, cache_hashes[i] = _hash_evoked(data_i["data"], sched,
+                                                        event_names, params)
+            cache_files[i] = op.join(cache_dir, "evoked_%s.npz" % params_hash)
+            if op.exists(cache_files[i]):
+                with np.load(cache_files[i]) as cache_obj:
+                    if str(cache_obj["hash"]) == cache_hashes[i]:
+                        evoked[i] = cache_obj["evoked"]
+                        cache_files[i] = None
+                        args[i] = None
+    todo = [i for i, args_i in enumerate(args) if args_i is not None]
+
+    # Allow to run in serial or parallel
+    pool = None
+    if dv is not None:
+        _map = dv.map_sync
+    elif n_jobs > 1 and len(todo) > 1:
+        pool = Pool(n_jobs)
+        _map = pool.map
+    else:
+        import __builtin__
+        _map = __builtin__.map
 
-    evoked = []
-    for i, data_i in enumerate(data):
+    try:
+        evoked_list = _map(_evoked_subject_star, [args[i] for i in todo])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # Fill the preallocated output array and possibly save the results
+    for i, evoked_i in zip(todo, evoked_list):
+        evoked[i] = evoked_i
+        if cache_files[i] is not None:
+            try:
+                os.makedirs(op.dirname(cache_files[i]))
+            except OSError:
+                pass
+            np.savez(cache_files[i], evoked=evoked_i, hash=cache_hashes[i])
+
+    if ragged:
+        return [evoked_i.squeeze() for evoked_i in evoked]
+    return evoked.squeeze()
+
+
+def _parse_events(data, problem=None, events=None, event_names=None):
+    """Read event information into an array with integer condition codes.
+
+    Returns a list with a record array for each subject (with `run`,
+    `onset`, and `condition` fields, where `condition` is a 1-based
+    index into the returned list of event names) along with that list.
+
+    """
+    # Can get event information in one of two ways
+    if problem is not None:
+        project = gather_project_info()
+        event_template = op.join(project["data_dir"], "%s",
+                                 "events/%s.csv" % problem)
+        events = [pd.read_csv(event_template % d["subj"]) for d in data]
+
+    # Map from event names to integer index values
+    if event_names is None:
+        event_names = set()
+        for events_i in events:
+            event_names |= set(events_i.condition.unique())
+        event_names = sorted(event_names)
+    event_map = pd.Series(range(1, len(event_names) + 1),
+                          index=event_names)
+
+    schedules = []
+    for events_i in events:
+        sched = np.empty(len(events_i), dtype=event_dtype)
+        sched["run"] = events_i.run
+        sched["onset"] = events_i.onset
+        sched["condition"] = events_i.condition.map(event_map).fillna(0)
+        schedules.append(sched)
+
+    return schedules, list(event_names)
+
+
+def _hash_evoked(run_data, sched, event_names, params):
+    """Hash the inputs of an evoked calculation.
+
+    Returns
+    -------
+    params_hash : string
+        hash of the event names and parameters, which names the cache file
+    evoked_hash : string
+        hash of those along with the data and events
+
+    """
+    params_hash = hashlib.sha1()
+    params_hash.update(str(event_names))
+    params_hash.update(str(params))
+    evoked_hash = params_hash.copy()
+    for data in run_data:
+        data = np.ascontiguousarray(data)
+        evoked_hash.update(str(data.shape))
+        evoked_hash.update(data.dtype.str)
+        evoked_hash.update(data.data)
+    evoked_hash.update(np.ascontiguousarray(sched).data)
+    return params_hash.hexdigest(), evoked_hash.hexdigest()
+
+
+def _evoked_subject_star(args):
+    """Unpack an argument tuple; allows a process pool to map over it."""
+    return _evoked_subject(*args)
+
+
+def _evoked_subject(run_data, sched, n_cond, n_bins, tr, calc_method,
+                    offset, upsample, percent_change, correct_baseline,
+                    runwise=False):
+    """Compute the evoked response for one subject's data."""
+    if runwise:
+        if calc_method not in ["FIR", "eta"]:
+            raise ValueError("Runwise calculation requires `FIR` or `eta`")
+        return _evoked_runwise(run_data, sched, n_cond, n_bins, tr,
+                               calc_method, offset, upsample,
+                               percent_change, correct_baseline)
+
+    # Create the timeseries of event occurances
+    event_list = []
+    data_list = []
+    for run, data in enumerate(run_data):
+        run_sched = sched[sched["run"] == run]
+        data, event_id = _prepare_run(data, run_sched, tr, offset,
+                                      upsample, percent_change)
+        event_list.append(event_id)
+        data_list.append(data)
+
+    # Set up the Nitime objects
+    event_info = np.concatenate(event_list)
+    data = np.concatenate(data_list, axis=0)
+
+    # Do the calculations
+    if data.ndim == 1:
+        evoked_data = _evoked_1d(data, event_info, n_bins, tr,
+                                 calc_method, correct_baseline)
+    elif data.ndim == 2:
+        evoked_data = _evoked_2d(data, event_info, n_bins, tr,
+                                 calc_method, correct_baseline)
+
+    # Put each condition in its place, allowing for missing events
+    evoked = np.empty((n_cond,) + evoked_data.shape[1:])
+    evoked.fill(np.nan)
+    present = np.unique(event_info[event_info > 0])
+    evoked[present - 1] = evoked_data
+
+    return evoked
+
+
+def _prepare_run(data, run_sched, tr, offset, upsample, percent_change):
+    """Resample and scale one run and make its event code timeseries."""
+    # Possibly upsample the data
+    if upsample != 1:
+        time_points = len(data)
+        x = np.linspace(0, time_points - 1, time_points)
+        xx = np.linspace(0, time_points - 1,
+                         time_points * upsample + 1)
+        interpolator = interp1d(x, data, "cubic", axis=0)
+        data = interpolator(xx)
+
+    # Onsets are converted to indices at the original resolution
+    event_id = np.zeros(len(data), int)
+    onsets = run_sched["onset"] + offset
+    event_index = (onsets / (tr * upsample)).astype(int)
+    event_index *= upsample
+    event_id[event_index] = run_sched["condition"]
+
+    if percent_change:
+        data = nit.utils.percent_change(data, ax=0)
+
+    return data, event_id
+
+
+def _fir_design(event_id, n_cond, n_bins):
+    """Build an FIR design matrix for a single run.
+
+    Columns are grouped by condition (using the 1-based codes in
+    `event_id`) and then by bin. Windows are truncated at the end of
+    the run rather than continuing into whatever data follows.
 
-        # Can get event information in one of two ways
-        if problem is not None:
-            subj = data_i["subj"]
-            events_i = pd.read_csv(event_template % subj)
+    """
+    n_tp = len(event_id)
+    X = np.zeros((n_tp, n_cond * n_bins))
+    event_index = np.flatnonzero(event_id)
+    for lag in range(n_bins):
+        rows = event_index + lag
+        valid = rows < n_tp
+        cols = (event_id[event_index[valid]] - 1) * n_bins + lag
+        np.add.at(X, (rows[valid], cols), 1)
+    return X
+
+
+class EvokedAccumulator(object):
+    """Accumulate evoked responses from timeseries data in a single pass.
+
+    Data are consumed one run, or one chunk of frames within a run, at a
+    time. The accumulator keeps running sums of the data in each
+    peristimulus window (along with the window overlap counts), so memory
+    scales with n_cond x n_bins x n_vox rather than the length of the
+    acquisition. At the end it can produce either the event-triggered
+    average or the FIR estimate.
+
+    Parameters
+    ----------
+    n_cond : int
+        number of event types
+    n_bins : int
+        number of bins for the peristumulus trace
+    percent_change : boolean
+        if True, convert signal to percent change by run
+
+    """
+    def __init__(self, n_cond, n_bins, percent_change=True):
+
+        self.n_cond = n_cond
+        self.n_bins = n_bins
+        self.percent_change = percent_change
+
+        n_reg = n_cond * n_bins
+        self.XtX = np.zeros((n_reg, n_reg))
+        self.Xty = None
+        self._in_run = False
+
+    def start_run(self):
+        """Begin a new run; peristimulus windows do not cross runs."""
+        if self._in_run:
+            self.end_run()
+        self._tail = np.zeros(self.n_bins - 1, int)
+        self._run_Xty = None
+        self._run_counts = np.zeros(self.n_cond * self.n_bins)
+        self._run_sum = 0
+        self._run_frames = 0
+        self._in_run = True
+
+    def update(self, data, event_id):
+        """Add a chunk of frames from the current run.
+
+        Parameters
+        ----------
+        data : n_tp (x n_vox) array
+            timeseries data for the chunk
+        event_id : n_tp int array
+            1-based condition code for events starting at each frame,
+            or 0 where no event occurs
+
+        """
+        if not self._in_run:
+            self.start_run()
+        data = np.asarray(data, float)
+        event_id = np.asarray(event_id, int)
+
+        # Events from the end of the previous chunk extend into this one
+        n_lead = len(self._tail)
+        codes = np.concatenate([self._tail, event_id])
+        X = _fir_design(codes, self.n_cond, self.n_bins)[n_lead:]
+        if n_lead:
+            self._tail = codes[-n_lead:]
+
+        # Update the running sums
+        self.XtX += np.dot(X.T, X)
+        if self._run_Xty is None:
+            self._run_Xty = np.dot(X.T, data)
+        else:
+            self._run_Xty += np.dot(X.T, data)
+        self._run_counts += X.sum(axis=0)
+        self._run_sum = self._run_sum + data.sum(axis=0)
+        self._run_frames += len(data)
+
+    def end_run(self):
+        """Finish the current run and fold its sums into the totals."""
+        if not self._in_run:
+            return
+        run_Xty = self._run_Xty
+        self._in_run = False
+        if run_Xty is None:
+            return
+
+        # Percent change is linear, so it can be applied to the sums
+        if self.percent_change:
+            run_mean = self._run_sum / self._run_frames
+            counts = self._run_counts.reshape((-1,) + (1,) *
+                                              (run_Xty.ndim - 1))
+            run_Xty = (run_Xty / run_mean - counts) * 100
+
+        if self.Xty is None:
+            self.Xty = run_Xty
         else:
-            events_i = events[i]
-
-        # Map from event names to integer index values
-        if event_names is None:
-            event_names = sorted(events_i.condition.unique())
-        event_map = pd.Series(range(1, len(event_names) + 1),
-                              index=event_names)
-
-        # Create the timeseries of event occurances
-        event_list = []
-        data_list = []
-        for run, run_data in enumerate(data_i["data"]):
-
-            # Possibly upsample the data
-            if upsample != 1:
-                time_points = len(run_data)
-                x = np.linspace(0, time_points - 1, time_points)
-                xx = np.linspace(0, time_points - 1,
-                                 time_points * upsample + 1)
-                interpolator = interp1d(x, run_data, "cubic", axis=0)
-                run_data = interpolator(xx)
-
-            run_events = events_i[events_i.run == run]
-            run_events.onset += offset
-
-            event_id = np.zeros(len(run_data), int)
-            event_index = np.array(run_events.onset / tr).astype(int)
-            event_index *= upsample
-            event_id[event_index] = run_events.condition.map(event_map)
-            event_list.append(event_id)
-
-            if percent_change:
-                run_data = nit.utils.percent_change(run_data, ax=0)
-            data_list.append(run_data)
-
-        # Set up the Nitime objects
-        event_info = np.concatenate(event_list)
-        data = np.concatenate(data_list, axis=0)
-
-        # Do the calculations
-        calc_tr = float(tr) / upsample
-        calc_bins = n_bins * upsample
-        if data.ndim == 1:
-            evoked_data = _evoked_1d(data, event_info, calc_bins, calc_tr,
-                                     calc_method, correct_baseline)
-        elif data.ndim == 2:
-            evoked_data = _evoked_2d(data, event_info, n_bins, calc_tr,
-                                     calc_method, correct_baseline)
-        evoked.append(evoked_data)
-
-    return np.array(evoked).squeeze()
+            self.Xty += run_Xty
+
+    def add_run(self, data, event_id):
+        """Add a complete run of data."""
+        self.start_run()
+        self.update(data, event_id)
+        self.end_run()
+
+    def result(self, calc_method="FIR", correct_baseline=True):
+        """Return the evoked response from the accumulated data.
+
+        Parameters
+        ----------
+        calc_method : "FIR" | "eta"
+            estimate the response with an FIR model or by taking the
+            event-triggered average
+        correct_baseline : boolean
+            if True, adjust evoked trace to be 0 in first bin
+
+        Returns
+        -------
+        evoked : n_cond x n_bins (x n_vox) array
+            evoked response, with NaN for conditions that did not occur
+
+        Raises
+        ------
+        ValueError
+            If no data have been added.
+
+        """
+        self.end_run()
+        if self.Xty is None:
+            raise ValueError("no data accumulated")
+        counts = np.diag(self.XtX)
+        if calc_method == "FIR":
+            evoked = np.dot(np.linalg.pinv(self.XtX), self.Xty)
+        elif calc_method == "eta":
+            counts_ = counts.reshape((-1,) + (1,) * (self.Xty.ndim - 1))
+            with np.errstate(invalid="ignore", divide="ignore"):
+                evoked = self.Xty / counts_
+        else:
+            raise ValueError("calc_method must be 'FIR' or 'eta'")
+
+        evoked = evoked.reshape((self.n_cond, self.n_bins) +
+                                self.Xty.shape[1:])
+        if correct_baseline:
+            evoked = evoked - evoked[:, :1]
+        present = counts.reshape(self.n_cond, self.n_bins)[:, 0] > 0
+        evoked[~present] = np.nan
+
+        return evoked
+
+
+def _evoked_runwise(run_data, sched, n_cond, n_bins, tr, calc_method,
+                    offset, upsample, percent_change, correct_baseline):
+    """Estimate evoked responses by accumulating over runs."""
+    accumulator = EvokedAccumulator(n_cond, n_bins, percent_change=False)
+    for run, data in enumerate(run_data):
+        run_sched = sched[sched["run"] == run]
+        data, event_id = _prepare_run(data, run_sched, tr, offset,
+                                      upsample, percent_change)
+        accumulator.add_run(data, event_id)
+
+    return accumulator.result(calc_method, correct_baseline)
 
 
 def _evoked_1d(data, events, n_bins, tr, calc_method, correct_baseline):
@@ -319,3 +689,145 @@ def integrate_evoked(evoked, axis=-1):
 
     """
     return sp.trapz(evoked, axis=axis)
+
+
+def bootstrap_evoked(evoked, n_boot=10000, ci=95, random_seed=None,
+                     block_size=1000, chunk_size=None, return_dist=False):
+    """Bootstrap confidence intervals on the mean evoked response.
+
+    Subjects are resampled with replacement, and the mean of each
+    resample is computed for every condition, bin, and voxel at once as
+    a product between a matrix of resample weights and the data.
+
+    Parameters
+    ----------
+    evoked : n_subj x ... array
+        evoked responses, e.g. from ``calculate_evoked``
+    n_boot : int
+        number of bootstrap resamples
+    ci : float
+        width of the confidence interval, in percent
+    random_seed : int or None
+        seed for the random state to obtain stable resamples
+    block_size : int
+        number of resample indices to draw at once
+    chunk_size : int or None
+        if provided, number of features (elements of the trailing
+        dimensions) to process at once, which bounds the memory
+        needed for voxelwise data at n_boot x chunk_size
+    return_dist : boolean
+        if True, also return the full bootstrap distribution
+
+    Returns
+    -------
+    ci_vals : 2 x ... array
+        lower and upper confidence interval bounds for each element
+        of the trailing dimensions of `evoked`
+    boot_dist : n_boot x ... array, optional
+        bootstrapped means
+
+    """
+    rs = np.random.RandomState(random_seed)
+    evoked = np.asarray(evoked, float)
+    n_subj = len(evoked)
+    out_shape = evoked.shape[1:]
+    data = evoked.reshape(n_subj, -1)
+
+    # Build the (n_boot x n_subj) matrix of resample weights in blocks
+    weights = np.empty((n_boot, n_subj))
+    for start in range(0, n_boot, block_size):
+        n_block = min(block_size, n_boot - start)
+        idx = rs.randint(0, n_subj, (n_block, n_subj))
+        idx += n_subj * np.arange(n_block)[:, np.newaxis]
+        counts = np.bincount(idx.ravel(), minlength=n_block * n_subj)
+        weights[start:start + n_block] = counts.reshape(n_block, n_subj)
+    weights /= n_subj
+
+    # Compute the resampled means and percentiles, possibly in chunks
+    if chunk_size is None:
+        chunk_size = data.shape[1]
+    pcts = [50 - ci / 2., 50 + ci / 2.]
+    ci_vals = np.empty((2, data.shape[1]))
+    if return_dist:
+        boot_dist = np.empty((n_boot, data.shape[1]))
+    for start in range(0, data.shape[1], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        boot_chunk = np.dot(weights, data[:, chunk])
+        ci_vals[:, chunk] = np.percentile(boot_chunk, pcts, axis=0)
+        if return_dist:
+            boot_dist[:, chunk] = boot_chunk
+
+    ci_vals = ci_vals.reshape((2,) + out_shape)
+    if return_dist:
+        return ci_vals, boot_dist.reshape((n_boot,) + out_shape)
+    return ci_vals
+
+
+def permute_evoked(evoked, n_perm=10000, random_seed=None,
+                   block_size=1000, chunk_size=None, return_dist=False):
+    """Sign-flipping permutation test of the mean evoked response.
+
+    Under the null hypothesis that the response is symmetric around 0,
+    the sign of each subject's data is exchangeable. The null
+    distribution of the mean is computed for every condition, bin, and
+    voxel at once as a product between a matrix of random signs and the
+    data.
+
+    Parameters
+    ----------
+    evoked : n_subj x ... array
+        evoked responses, e.g. from ``calculate_evoked``
+    n_perm : int
+        number of permutations
+    random_seed : int or None
+        seed for the random state to obtain stable permutations
+    block_size : int
+        number of sign vectors to draw at once
+    chunk_size : int or None
+        if provided, number of features (elements of the trailing
+        dimensions) to process at once
+    return_dist : boolean
+        if True, also return the full null distribution
+
+    Returns
+    -------
+    p_vals : ... array
+        two-tailed p values for each element of the trailing
+        dimensions of `evoked`
+    null_dist : n_perm x ... array, optional
+        permuted means
+
+    """
+    rs = np.random.RandomState(random_seed)
+    evoked = np.asarray(evoked, float)
+    n_subj = len(evoked)
+    out_shape = evoked.shape[1:]
+    data = evoked.reshape(n_subj, -1)
+    observed = np.abs(data.mean(axis=0))
+
+    # Build the (n_perm x n_subj) matrix of signs in blocks
+    signs = np.empty((n_perm, n_subj))
+    for start in range(0, n_perm, block_size):
+        n_block = min(block_size, n_perm - start)
+        flips = rs.randint(0, 2, (n_block, n_subj))
+        signs[start:start + n_block] = flips * 2 - 1
+    signs /= n_subj
+
+    # Compute the null means and p values, possibly in chunks
+    if chunk_size is None:
+        chunk_size = data.shape[1]
+    p_vals = np.empty(data.shape[1])
+    if return_dist:
+        null_dist = np.empty((n_perm, data.shape[1]))
+    for start in range(0, data.shape[1], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        null_chunk = np.dot(signs, data[:, chunk])
+        exceed = np.abs(null_chunk) >= observed[chunk]
+        p_vals[chunk] = (exceed.sum(axis=0) + 1.) / (n_perm + 1)
+        if return_dist:
+            null_dist[:, chunk] = null_chunk
+
+    p_vals = p_vals.reshape(out_shape)
+    if return_dist:
+        return p_vals, null_dist.reshape((n_perm,) + out_shape)
+    return p_vals
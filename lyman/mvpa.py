@@ -19,6 +19,7 @@ from sklearn.cross_validation import (KFold,
 
 import moss
 from lyman import gather_project_info, gather_experiment_info
+from lyman.tools.masks import Mask, as_mask, get_registry
 
 
 def iterated_deconvolution(data, evs, tr=2, hpf_cutoff=128, filter_data=True,
@@ -167,7 +168,7 @@ def extract_dataset(sched, timeseries, mask, tr=2, frames=None,
         must contain `condition` and `onsets` columns
     timeseries : 4D numpy array
         BOLD data
-    mask : 3D boolean array
+    mask : 3D boolean array or Mask
         ROI mask
     tr : int
         acquistion TR (in seconds)
@@ -202,12 +203,11 @@ def extract_dataset(sched, timeseries, mask, tr=2, frames=None,
                              (frames.max() + 1) * upsample,
                              n_frames + 1)[:-1]
 
-    # Double check mask datatype
-    if not mask.dtype == np.bool:
-        raise ValueError("Mask must be boolean array")
+    # Pack the mask, which must be boolean if given as an array
+    mask = as_mask(mask)
 
     # Initialize the outputs
-    X = np.zeros((len(frames), sched.shape[0], mask.sum()))
+    X = np.zeros((len(frames), sched.shape[0], len(mask)))
     if event_names is None:
         event_names = sorted(sched.condition.unique())
     else:
@@ -215,7 +215,7 @@ def extract_dataset(sched, timeseries, mask, tr=2, frames=None,
     y = sched.condition.map(lambda x: event_names.index(x))
 
     # Extract the ROI into a 2D n_tr x n_feat
-    roi_data = timeseries[mask].T
+    roi_data = mask.gather(timeseries).T
 
     # Possibly upsample the raw data
     if upsample is None:
@@ -309,8 +309,7 @@ def extract_subject(subj, problem, roi_name, mask_name=None, frames=None,
         pass
 
     # Get paths to the relevant files
-    mask_file = op.join(project["data_dir"], subj, "masks",
-                        "%s.nii.gz" % mask_name)
+    masks = get_registry(project["data_dir"])
     problem_file = op.join(project["data_dir"], subj, "events",
                            "%s.csv" % problem)
     ts_dir = op.join(project["analysis_dir"], exp_name, subj,
@@ -322,7 +321,7 @@ def extract_subject(subj, problem, roi_name, mask_name=None, frames=None,
     # Get the hash value for this dataset
     ds_hash = hashlib.sha1()
     ds_hash.update(mask_name)
-    ds_hash.update(str(op.getmtime(mask_file)))
+    ds_hash.update(str(masks.mtime(subj, mask_name)))
     ds_hash.update(str(op.getmtime(problem_file)))
     for ts_file in ts_files:
         ds_hash.update(str(op.getmtime(ts_file)))
@@ -346,8 +345,8 @@ def extract_subject(subj, problem, roi_name, mask_name=None, frames=None,
     # Othersies, initialize outputs
     X, y, runs = [], [], []
 
-    # Load mask file
-    mask_data = nib.load(mask_file).get_data().astype(bool)
+    # Load the mask
+    mask = masks.get(subj, mask_name)
 
     # Load the event information
     sched = pd.read_csv(problem_file)
@@ -362,7 +361,7 @@ def extract_subject(subj, problem, roi_name, mask_name=None, frames=None,
 
         # Use the basic extractor function
         X_i, y_i = extract_dataset(sched_r, ts_data,
-                                   mask_data, exp["TR"],
+                                   mask, exp["TR"],
                                    frames, upsample, event_names)
 
         # Just add to list
@@ -462,6 +461,11 @@ def extract_group(problem, roi_name, mask_name=None, frames=None,
         subjects = np.loadtxt(subj_file, str)
     subjects = list(subjects)
 
+    # Fail before extracting anything if some subjects lack the mask
+    project = gather_project_info()
+    masks = get_registry(project["data_dir"])
+    masks.require(mask_name or roi_name, subjects)
+
     # Allow to run in serial or parallel
     if dv is None:
         import __builtin__
@@ -490,6 +494,7 @@ def extract_group(problem, roi_name, mask_name=None, frames=None,
     # Actually do the loading
     data = map(extract_subject, subjects, problem, roi_name, mask_name,
                frames, collapse, confounds, upsample, exp_name, event_names)
+    masks.flush()
 
     return data
 
@@ -810,8 +815,9 @@ def model_coefs(datasets, model, mask_name=None, flat=True, exp_name=None):
         group mvpa datasets
     model : scikit-learn estimator
         decoding model
-    mask_name : string or None
-        string, unless datasets have `mask_name` field
+    mask_name : string, Mask, or None
+        string, unless datasets have `mask_name` field; a Mask
+        is used for every dataset
     flat : bool
         if False return in original data space (with voxels outside
         mask represented as NaN. otherwise return straight from model
@@ -828,7 +834,7 @@ def model_coefs(datasets, model, mask_name=None, flat=True, exp_name=None):
     if exp_name is None:
         exp_name = project["default_exp"]
 
-    mask_template = op.join(project["data_dir"], "%s/masks/%s.nii.gz")
+    masks = get_registry(project["data_dir"])
 
     out_coefs = []
 
@@ -852,14 +858,12 @@ def model_coefs(datasets, model, mask_name=None, flat=True, exp_name=None):
                     out_coefs.append(data)
 
         # Determine the mask
-        if "mask_name" in dset:
-            mask_name = dset["mask_name"]
-        mask_file = mask_template % (subj, mask_name)
-
-        # Load the mask file
-        mask_img = nib.load(mask_file)
-        mask = mask_img.get_data().astype(bool)
-        x, y, z = mask.shape
+        if isinstance(mask_name, Mask):
+            mask = mask_name
+        else:
+            if "mask_name" in dset:
+                mask_name = dset["mask_name"]
+            mask = masks.get(subj, mask_name)
 
         # Fit the model and extract the learned model weights
         model = model.fit(dset["X"], dset["y"])
@@ -867,14 +871,14 @@ def model_coefs(datasets, model, mask_name=None, flat=True, exp_name=None):
             coef = np.array([e.coef_.ravel() for e in model.estimators_])
         else:
             coef = model.coef_
-        coef_data = np.zeros((x, y, z, len(coef))) * np.nan
-        coef_data[mask] = coef.T
+        coef_data = mask.scatter(coef.T, np.nan)
 
         # Save the data both as a npz and nifti
         coef_dict = dict(data=coef, hash=decoder_hash)
         np.savez(coef_file, **coef_dict)
         coef_nifti = coef_file.strip(".npz") + ".nii.gz"
-        coef_img = nib.Nifti1Image(coef_data, mask_img.get_affine())
+        coef_img = nib.Nifti1Image(coef_data, mask.affine)
         nib.save(coef_img, coef_nifti)
 
+    masks.flush()
     return out_coefs
@@ -0,0 +1,277 @@
+import os
+import os.path as op
+import sys
+import shutil
+from tempfile import mkdtemp
+import numpy as np
+import pandas as pd
+
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from nose.tools import assert_equal, assert_true, assert_raises
+
+from .. import evoked
+
+n_tp = 40
+onsets = [4, 16, 28, 10, 22, 34]
+conditions = ["a", "a", "a", "b", "b", "b"]
+
+
+def make_data(n_subj=3, n_runs=2, n_vox=None, seed=0):
+    """Make simulated datasets and event files with known responses."""
+    rs = np.random.RandomState(seed)
+    data, events = [], []
+    for i in range(n_subj):
+        run_data = []
+        for run in range(n_runs):
+            shape = (n_tp,) if n_vox is None else (n_tp, n_vox)
+            run_data.append(100 + rs.randn(*shape))
+        data.append(dict(data=np.array(run_data), subj="subj%d" % i))
+        events.append(pd.DataFrame(dict(onset=onsets * n_runs,
+                                        run=np.repeat(range(n_runs), 6),
+                                        condition=conditions * n_runs)))
+    return data, events
+
+
+def test_evoked_shape():
+    """Test the shape of the group evoked array."""
+    data, events = make_data()
+    out = evoked.calculate_evoked(data, 5, events=events, tr=1,
+                                  calc_method="eta")
+    assert_equal(out.shape, (3, 2, 5))
+
+    data, events = make_data(n_vox=4)
+    out = evoked.calculate_evoked(data, 5, events=events, tr=1,
+                                  calc_method="eta")
+    assert_equal(out.shape, (3, 2, 5, 4))
+
+
+def test_evoked_voxel_counts():
+    """Test subjects with different numbers of voxels."""
+    data, events = make_data(n_subj=2, n_vox=3)
+    data[1]["data"] = data[1]["data"][..., :2]
+    out = evoked.calculate_evoked(data, 5, events=events, tr=1, n_jobs=2)
+    assert_equal([o.shape for o in out], [(2, 5, 3), (2, 5, 2)])
+    single = evoked.calculate_evoked(data[1:], 5, events=events[1:], tr=1)
+    assert_array_almost_equal(out[1], single)
+
+    # All runs of a subject must have the same voxels
+    data[1]["data"] = [data[0]["data"][0], data[1]["data"][1]]
+    assert_raises(ValueError, evoked.calculate_evoked, data, 5,
+                  events=events, tr=1)
+
+
+def test_evoked_events_unchanged():
+    """Make sure that the event onsets are not modified in place."""
+    data, events = make_data()
+    orig_onsets = [e.onset.copy() for e in events]
+    evoked.calculate_evoked(data, 5, events=events, tr=1, offset=2)
+    for e, o in zip(events, orig_onsets):
+        assert_array_equal(e.onset, o)
+
+
+def test_evoked_missing_condition():
+    """Test that absent conditions are filled with NaN."""
+    data, events = make_data(n_subj=2)
+    events[1] = events[1][events[1].condition == "a"]
+    out = evoked.calculate_evoked(data, 5, events=events, tr=1,
+                                  calc_method="eta")
+    assert_equal(out.shape, (2, 2, 5))
+    assert np.isnan(out[1, 1]).all()
+    assert not np.isnan(out[0]).any()
+
+
+def test_evoked_parallel():
+    """Test that a process pool gives the same answer as serial."""
+    data, events = make_data(n_subj=4)
+    serial = evoked.calculate_evoked(data, 5, events=events, tr=1)
+    parallel = evoked.calculate_evoked(data, 5, events=events, tr=1,
+                                       n_jobs=2)
+    assert_array_almost_equal(serial, parallel)
+
+
+def test_bootstrap_evoked():
+    """Test the shape and coverage of bootstrapped intervals."""
+    rs = np.random.RandomState(0)
+    data = rs.randn(20, 2, 5, 3) + 1
+    ci = evoked.bootstrap_evoked(data, 1000, random_seed=0)
+    assert_equal(ci.shape, (2, 2, 5, 3))
+    assert (ci[0] < data.mean(axis=0)).all()
+    assert (ci[1] > data.mean(axis=0)).all()
+
+    ci_chunk = evoked.bootstrap_evoked(data, 1000, random_seed=0,
+                                       block_size=300, chunk_size=7)
+    assert_array_almost_equal(ci, ci_chunk)
+
+
+def test_bootstrap_evoked_dist():
+    """Test that bootstrapped means match explicit resampling."""
+    rs = np.random.RandomState(0)
+    data = rs.randn(10, 2, 5)
+    _, dist = evoked.bootstrap_evoked(data, 50, random_seed=1,
+                                      return_dist=True)
+    assert_equal(dist.shape, (50, 2, 5))
+
+    rs = np.random.RandomState(1)
+    idx = rs.randint(0, 10, (50, 10))
+    assert_array_almost_equal(dist, data[idx].mean(axis=1))
+
+
+def test_permute_evoked():
+    """Test the sign-flipping permutation test."""
+    rs = np.random.RandomState(0)
+    data = rs.randn(20, 2, 5)
+    data[:, 0] += 3
+    p = evoked.permute_evoked(data, 1000, random_seed=0)
+    assert_equal(p.shape, (2, 5))
+    assert (p[0] < .01).all()
+    assert (p[1] > .01).all()
+
+    p_chunk = evoked.permute_evoked(data, 1000, random_seed=0, chunk_size=3)
+    assert_array_almost_equal(p, p_chunk)
+
+
+def test_fir_design():
+    """Test that FIR windows are truncated at the end of a run."""
+    event_id = np.array([0, 1, 0, 0, 2, 0])
+    X = evoked._fir_design(event_id, 2, 3)
+    assert_equal(X.shape, (6, 6))
+    assert_array_equal(X[1:4, :3], np.eye(3))
+    assert_array_equal(X[4:, 3:5], np.eye(2))
+    assert_equal(X[:, 5].sum(), 0)
+
+
+def test_evoked_runwise():
+    """Test that runwise FIR matches the concatenated estimate."""
+    data, events = make_data(n_vox=3)
+    full = evoked.calculate_evoked(data, 5, events=events, tr=1)
+    runwise = evoked.calculate_evoked(data, 5, events=events, tr=1,
+                                      runwise=True)
+    assert_equal(runwise.shape, full.shape)
+    assert_array_almost_equal(full, runwise)
+
+
+def test_evoked_runwise_boundary():
+    """Test that an event at the end of a run does not see the next run."""
+    # Concatenating these runs would put 1000s in the last three bins
+    run_data = np.zeros((2, n_tp))
+    run_data[1, :5] = 1000
+    data = [dict(data=run_data, subj="subj0")]
+    events = [pd.DataFrame(dict(onset=[4, n_tp - 2, 10], run=[0, 0, 1],
+                                condition=["a", "a", "a"]))]
+    for method in ["FIR", "eta"]:
+        out = evoked.calculate_evoked(data, 5, events=events, tr=1,
+                                      calc_method=method, runwise=True,
+                                      percent_change=False,
+                                      correct_baseline=False)
+        assert_array_almost_equal(out, np.zeros(5))
+
+
+def test_evoked_cache():
+    """Test that evoked results are cached keyed on their inputs."""
+    test_dir = mkdtemp()
+    lyman_dir = os.environ.get("LYMAN_DIR")
+    os.environ["LYMAN_DIR"] = test_dir
+    sys.modules.pop("project", None)
+    with open(op.join(test_dir, "project.py"), "w") as f:
+        f.write("analysis_dir = %r\ndefault_exp = 'exp'\n" % test_dir)
+
+    try:
+        data, events = make_data(n_subj=2)
+        out = evoked.calculate_evoked(data, 5, events=events,
+                                      tr=1, cache=True)
+        cache_dir = op.join(test_dir, "exp", "subj0", "evoked")
+        assert_equal(len(os.listdir(cache_dir)), 1)
+
+        cached = evoked.calculate_evoked(data, 5, events=events,
+                                         tr=1, cache=True)
+        assert_array_equal(out, cached)
+        assert_equal(len(os.listdir(cache_dir)), 1)
+
+        evoked.calculate_evoked(data, 4, events=events, tr=1, cache=True)
+        assert_equal(len(os.listdir(cache_dir)), 2)
+
+        # New data replace the cached result for the same parameters
+        data[0]["data"] = data[0]["data"] + 1
+        changed = evoked.calculate_evoked(data, 5, events=events,
+                                          tr=1, cache=True)
+        assert_equal(len(os.listdir(cache_dir)), 2)
+        assert_true(not np.allclose(changed, out))
+        assert_array_almost_equal(changed, evoked.calculate_evoked(
+            data, 5, events=events, tr=1))
+
+        # Nothing is written unless caching is requested
+        evoked.calculate_evoked(data, 3, events=events, tr=1)
+        assert_equal(len(os.listdir(cache_dir)), 2)
+
+        # The same bytes in a different shape are different data
+        sched = np.zeros(1, evoked.event_dtype)
+        run_data = np.arange(12.).reshape(2, 6)
+        hashes = [evoked._hash_evoked(d, sched, ["a"], ())[1]
+                  for d in [run_data, run_data.reshape(2, 3, 2)]]
+        assert_true(hashes[0] != hashes[1])
+    finally:
+        sys.modules.pop("project", None)
+        if lyman_dir is None:
+            os.environ.pop("LYMAN_DIR")
+        else:
+            os.environ["LYMAN_DIR"] = lyman_dir
+        shutil.rmtree(test_dir)
+
+
+def test_evoked_runwise_eta():
+    """Test that runwise averaging matches the concatenated estimate."""
+    data, events = make_data(n_vox=3)
+    full = evoked.calculate_evoked(data, 5, events=events, tr=1,
+                                   calc_method="eta")
+    runwise = evoked.calculate_evoked(data, 5, events=events, tr=1,
+                                      calc_method="eta", runwise=True)
+    assert_array_almost_equal(full, runwise)
+
+
+def test_accumulator_chunks():
+    """Test that streaming chunks of frames matches whole runs."""
+    rs = np.random.RandomState(0)
+    runs = [100 + rs.randn(n_tp, 4) for _ in range(3)]
+    event_id = np.zeros(n_tp, int)
+    event_id[onsets[:3]] = 1
+    event_id[onsets[3:]] = 2
+
+    whole = evoked.EvokedAccumulator(2, 6)
+    for data in runs:
+        whole.add_run(data, event_id)
+
+    chunked = evoked.EvokedAccumulator(2, 6)
+    for data in runs:
+        chunked.start_run()
+        for chunk in np.array_split(np.arange(n_tp), 7):
+            chunked.update(data[chunk], event_id[chunk])
+    chunked.end_run()
+
+    for method in ["FIR", "eta"]:
+        assert_array_almost_equal(whole.result(method),
+                                  chunked.result(method))
+
+
+def test_accumulator_empty():
+    """Test that asking for a result before adding data is an error."""
+    acc = evoked.EvokedAccumulator(2, 6)
+    assert_raises(ValueError, acc.result)
+    acc.start_run()
+    assert_raises(ValueError, acc.result, "eta")
+
+
+def test_accumulator_eta():
+    """Test the event-triggered average against explicit windows."""
+    rs = np.random.RandomState(0)
+    data = rs.randn(n_tp)
+    event_id = np.zeros(n_tp, int)
+    event_id[[3, 12, 37]] = 1
+
+    acc = evoked.EvokedAccumulator(1, 4, percent_change=False)
+    acc.add_run(data, event_id)
+    eta = acc.result("eta", correct_baseline=False)
+
+    windows = [data[3:7], data[12:16]]
+    want = np.mean(windows, axis=0)
+    want[:3] = (want[:3] * 2 + data[37:40]) / 3
+    assert_array_almost_equal(eta[0], want)
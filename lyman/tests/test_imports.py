@@ -0,0 +1,70 @@
+"""Check that importing lyman stays cheap.
+
+Running this module as a script prints the import cost of the lyman
+entry points alongside the heavy dependencies they used to pull in.
+
+"""
+import sys
+import json
+import subprocess
+from nose.tools import assert_equal, assert_true
+
+heavy_modules = ["nipype", "networkx", "IPython", "matplotlib", "pandas"]
+
+entry_points = ["import lyman",
+                "import lyman.tools",
+                "import lyman.workflows",
+                "from lyman.tools.commandline import parser",
+                "from lyman import tools; "
+                "import lyman.workflows as wf; wf.spaces"]
+
+
+def import_report(statement):
+    """Execute an import in a fresh interpreter and report what it cost.
+
+    Returns
+    -------
+    elapsed : float
+        Wall time in seconds spent executing the import statement.
+    loaded : list of strings
+        Heavy modules present in sys.modules afterwards.
+
+    """
+    code = ("import sys, time, json\n"
+            "start = time.time()\n"
+            "%s\n"
+            "elapsed = time.time() - start\n"
+            "loaded = [m for m in %r if m in sys.modules]\n"
+            "print json.dumps([elapsed, loaded])\n"
+            % (statement, heavy_modules))
+    out = subprocess.check_output([sys.executable, "-c", code])
+    elapsed, loaded = json.loads(out.strip().split("\n")[-1])
+    return elapsed, loaded
+
+
+def test_lazy_imports():
+
+    for statement in entry_points:
+        elapsed, loaded = import_report(statement)
+        yield assert_equal, loaded, []
+
+
+def test_lazy_attributes():
+
+    code = ("import lyman\n"
+            "assert lyman.gather_project_info is "
+            "lyman.tools.main.gather_project_info\n"
+            "assert lyman.tools.write_workflow_report.__module__ == "
+            "'lyman.tools.reports'\n"
+            "print 'networkx' in __import__('sys').modules\n")
+    out = subprocess.check_output([sys.executable, "-c", code])
+    yield assert_true, out.strip().endswith("True")
+
+
+if __name__ == "__main__":
+
+    statements = entry_points + ["import numpy", "import nipype",
+                                 "import lyman.tools.main"]
+    for statement in statements:
+        elapsed, loaded = import_report(statement)
+        print "%7.3fs  %-50s %s" % (elapsed, statement, ", ".join(loaded))
@@ -1,2 +1,20 @@
-from main import *
-from maskfactory import MaskFactory
+from .lazy import lazy_package
+
+lazy_package(__name__, {"main": None,
+                        "reports": None,
+                        "clusters": None,
+                        "atlas": None,
+                        "commandline": None,
+                        "console": None,
+                        "maskfactory": None,
+                        "masks": None,
+                        "resources": None,
+                        "profiling": None,
+                        "provenance": None,
+                        "write_workflow_report": ".reports",
+                        "render_deferred_reports": ".reports",
+                        "ProvenanceStore": ".provenance",
+                        "MaskFactory": ".maskfactory",
+                        "Mask": ".masks",
+                        "MaskRegistry": ".masks"},
+             default=".main")
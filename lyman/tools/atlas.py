@@ -0,0 +1,174 @@
+"""Fast lookup of anatomical labels in the HarvardOxford atlases.
+
+The FSL probabilistic atlases are large compressed 4D images, but the
+peak table only needs to know the most probable region (and that
+probability) at each voxel. This module reduces each atlas to those two
+3D volumes once, stores them uncompressed so they can be memory-mapped,
+and keeps a single loaded copy per process for vectorized lookups.
+
+"""
+import os
+import os.path as op
+import json
+
+import numpy as np
+import nibabel as nib
+
+
+atlas_names = ["cort", "sub"]
+
+_atlas = None
+
+
+def atlas_files():
+    """Return paths to the 2mm HarvardOxford probability images."""
+    at_dir = op.join(os.environ["FSLDIR"], "data", "atlases", "HarvardOxford")
+    return dict([(name, op.join(at_dir, "HarvardOxford-%s-prob-2mm.nii.gz"
+                                % name)) for name in atlas_names])
+
+
+def default_cache_dir():
+    """Return the directory where the reduced atlases are stored."""
+    if "LYMAN_ATLAS_DIR" in os.environ:
+        return os.environ["LYMAN_ATLAS_DIR"]
+    return op.join(op.expanduser("~"), ".lyman", "atlases")
+
+
+def build_atlas_cache(source_files=None, cache_dir=None):
+    """Reduce the probability atlases to label and probability volumes.
+
+    Parameters
+    ----------
+    source_files : dict, optional
+        maps "cort" and "sub" to 4D probability images; uses the
+        FSL HarvardOxford atlases if absent
+    cache_dir : string, optional
+        directory to write the cache; uses ``default_cache_dir()``
+        if absent
+
+    Returns
+    -------
+    cache_dir : string
+        directory containing the reduced atlases
+
+    """
+    if source_files is None:
+        source_files = atlas_files()
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    if not op.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    for name in atlas_names:
+        prob_data = nib.load(source_files[name]).get_data()
+        label = np.argmax(prob_data, axis=-1).astype(np.int16)
+        prob = np.max(prob_data, axis=-1)
+        _save_atomic(op.join(cache_dir, "%s_label.npy" % name), label)
+        _save_atomic(op.join(cache_dir, "%s_prob.npy" % name), prob)
+
+        # Record the source so a changed atlas triggers a rebuild
+        source_record = op.join(cache_dir, "%s_source.json" % name)
+        temp_record = "%s.%d.tmp" % (source_record, os.getpid())
+        with open(temp_record, "w") as f:
+            json.dump(dict(fname=source_files[name],
+                           mtime=op.getmtime(source_files[name])), f)
+        os.rename(temp_record, source_record)
+
+    return cache_dir
+
+
+def _save_atomic(fname, arr):
+    """Save an array so concurrent readers never see a partial file."""
+    temp_fname = "%s.%d.tmp" % (fname, os.getpid())
+    with open(temp_fname, "wb") as f:
+        np.save(f, arr)
+    os.rename(temp_fname, fname)
+
+
+def cache_is_current(source_files=None, cache_dir=None):
+    """Return True if the reduced atlases match their source images."""
+    if source_files is None:
+        source_files = atlas_files()
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    for name in atlas_names:
+        source_record = op.join(cache_dir, "%s_source.json" % name)
+        try:
+            with open(source_record) as f:
+                record = json.load(f)
+            fname, mtime = record["fname"], record["mtime"]
+        except (IOError, ValueError, KeyError, TypeError):
+            # A missing or unreadable record means the cache is rebuilt
+            return False
+        source = source_files[name]
+        if fname != source or mtime != op.getmtime(source):
+            return False
+    return True
+
+
+class HarvardOxfordAtlas(object):
+    """Memory-mapped most-probable-region lookup for both atlases."""
+    def __init__(self, cache_dir=None):
+
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = cache_dir
+
+        for name in atlas_names:
+            for kind in ["label", "prob"]:
+                fname = op.join(cache_dir, "%s_%s.npy" % (name, kind))
+                setattr(self, "%s_%s" % (name, kind),
+                        np.load(fname, mmap_mode="r"))
+
+    def lookup(self, vox_coords):
+        """Find most probable region and its probability for voxels.
+
+        Parameters
+        ----------
+        vox_coords : n x 3 int array
+            voxel coordinates in the 2mm MNI space
+
+        Returns
+        -------
+        names : n array of strings
+            full name of the most probable region, or "Unknown"
+        probs : n array
+            probability (percent) for that region
+
+        """
+        from lyman.tools.main import (harvard_oxford_sub_names,
+                                      harvard_oxford_ctx_names)
+        vox_coords = np.asarray(vox_coords, int).reshape(-1, 3)
+        i, j, k = vox_coords.T
+
+        ctx_index = np.asarray(self.cort_label[i, j, k])
+        ctx_prob = np.asarray(self.cort_prob[i, j, k])
+        sub_index = np.asarray(self.sub_label[i, j, k])
+        sub_prob = np.asarray(self.sub_prob[i, j, k])
+
+        # Prefer cortex unless the subcortical atlas is more informative
+        # about something other than generic white matter or cortex
+        use_sub = ((ctx_prob == 0) & np.in1d(sub_index, [0, 11]) |
+                   (sub_prob > ctx_prob) &
+                   ~np.in1d(sub_index, [0, 1, 11, 12]))
+        unknown = (sub_prob == 0) & (ctx_prob == 0)
+
+        sub_names = np.array(harvard_oxford_sub_names, object)
+        ctx_names = np.array(harvard_oxford_ctx_names, object)
+        names = np.where(use_sub, sub_names[sub_index], ctx_names[ctx_index])
+        probs = np.where(use_sub, sub_prob, ctx_prob)
+        names[unknown] = "Unknown"
+        probs[unknown] = 0
+
+        return names, probs
+
+
+def get_atlas():
+    """Return the process-wide atlas, building the cache if needed."""
+    global _atlas
+    if _atlas is None:
+        if not cache_is_current():
+            build_atlas_cache()
+        _atlas = HarvardOxfordAtlas()
+    return _atlas
@@ -0,0 +1,206 @@
+"""Find clusters and local maxima in thresholded statistical images.
+
+The peaks are collected in a structured array that can be rendered as
+an RST table for the reports, as HTML, or as CSV for later analysis.
+
+"""
+import csv
+
+import numpy as np
+from scipy import ndimage
+import nibabel as nib
+
+
+peak_dtype = [("peak", int), ("cluster", int), ("size", int),
+              ("value", float), ("i", int), ("j", int), ("k", int),
+              ("x", float), ("y", float), ("z", float),
+              ("region", object), ("prob", float)]
+
+peak_columns = [("Peak", "peak", "%d"), ("Cluster", "cluster", "%d"),
+                ("Size", "size", "%d"), ("Value", "value", "%.2f"),
+                ("x", "x", "%d"), ("y", "y", "%d"), ("z", "z", "%d"),
+                ("MaxProb Region", "region", "%s"), ("Prob", "prob", "%d")]
+
+
+def find_clusters(stat_data, thresh=0):
+    """Label 26-connected clusters of voxels above a threshold.
+
+    Parameters
+    ----------
+    stat_data : 3D array
+        statistical image
+    thresh : float
+        voxels must exceed this value to be included in a cluster
+
+    Returns
+    -------
+    labels : 3D int array
+        cluster index for each voxel (0 outside clusters), with the
+        largest cluster labeled 1
+    sizes : array
+        number of voxels in each cluster, in label order
+
+    """
+    structure = ndimage.generate_binary_structure(3, 3)
+    labels, n_clusters = ndimage.label(stat_data > thresh, structure)
+    sizes = np.bincount(labels.ravel())[1:]
+
+    # Relabel so that the clusters are sorted by size
+    order = np.argsort(-sizes, kind="mergesort")
+    relabel = np.zeros(n_clusters + 1, int)
+    relabel[order + 1] = np.arange(1, n_clusters + 1)
+
+    return relabel[labels], sizes[order]
+
+
+def local_maxima(stat_data, labels, n_peaks=6):
+    """Find the largest local maxima within each cluster.
+
+    Parameters
+    ----------
+    stat_data : 3D array
+        statistical image
+    labels : 3D int array
+        cluster labels from ``find_clusters``
+    n_peaks : int
+        maximum number of peaks to report for each cluster
+
+    Returns
+    -------
+    coords : n x 3 int array
+        voxel coordinates of the peaks, sorted by cluster and then
+        by descending value
+    cluster : n int array
+        cluster label for each peak
+
+    """
+    in_cluster = labels > 0
+    masked = np.where(in_cluster, stat_data, -np.inf)
+    neighborhood = ndimage.maximum_filter(masked, size=3, mode="constant",
+                                          cval=-np.inf)
+    is_peak = in_cluster & (masked == neighborhood)
+
+    coords = np.argwhere(is_peak)
+    cluster = labels[is_peak.nonzero()]
+    values = stat_data[is_peak.nonzero()]
+
+    # Sort by cluster, then by value, and keep the top peaks in each
+    order = np.lexsort((-values, cluster))
+    coords, cluster = coords[order], cluster[order]
+    rank = np.arange(len(cluster))
+    first = np.searchsorted(cluster, cluster)
+    keep = rank - first < n_peaks
+
+    return coords[keep], cluster[keep]
+
+
+def cluster_table(stat_file, thresh=0, n_peaks=6, label_peaks=True):
+    """Build a table of cluster peaks from a thresholded statistic image.
+
+    Parameters
+    ----------
+    stat_file : string
+        path to a (cluster-thresholded) statistical image
+    thresh : float
+        voxels must exceed this value to be included in a cluster
+    n_peaks : int
+        maximum number of peaks to report for each cluster
+    label_peaks : boolean
+        if True, find the most probable HarvardOxford region for each
+        peak (assumes the image is in 2mm MNI space)
+
+    Returns
+    -------
+    table : structured array
+        one row per peak with fields defined by ``peak_dtype``
+
+    """
+    from lyman.tools import vox_to_world
+
+    stat_data = nib.load(stat_file).get_data().squeeze()
+    labels, sizes = find_clusters(stat_data, thresh)
+    coords, cluster = local_maxima(stat_data, labels, n_peaks)
+
+    table = np.zeros(len(coords), peak_dtype)
+    table["peak"] = np.arange(1, len(coords) + 1)
+    table["cluster"] = cluster
+    table["size"] = sizes[cluster - 1]
+    table["value"] = stat_data[tuple(coords.T)]
+    for ax, field in enumerate("ijk"):
+        table[field] = coords[:, ax]
+    world_coords = vox_to_world(coords, stat_file)
+    for ax, field in enumerate("xyz"):
+        table[field] = world_coords[:, ax]
+    table["region"] = ""
+    if label_peaks and len(coords):
+        from lyman.tools.atlas import get_atlas
+        table["region"], table["prob"] = get_atlas().lookup(coords)
+
+    return table
+
+
+def _table_strings(table):
+    """Format the columns of a peak table as lists of strings."""
+    rows = [[name for name, _, _ in peak_columns]]
+    for row in table:
+        rows.append([fmt % row[field] for _, field, fmt in peak_columns])
+    return rows
+
+
+def table_to_rst(table):
+    """Render a peak table as an RST simple table."""
+    if not len(table):
+        return ""
+    rows = _table_strings(table)
+    widths = [max([len(row[j]) for row in rows]) for j in range(len(rows[0]))]
+
+    def format_row(row):
+        return " ".join([w.ljust(n) for w, n in zip(row, widths)]).rstrip()
+
+    rule = " ".join(["=" * n for n in widths])
+    lines = [rule, format_row(rows[0]), rule]
+    lines.extend([format_row(row) for row in rows[1:]])
+    lines.append(rule)
+    return "\n".join(lines) + "\n"
+
+
+def table_to_html(table):
+    """Render a peak table as an HTML table."""
+    from cgi import escape
+    rows = _table_strings(table)
+    lines = ["<table>"]
+    lines.append("<tr>%s</tr>" % "".join(["<th>%s</th>" % escape(c)
+                                          for c in rows[0]]))
+    for row in rows[1:]:
+        lines.append("<tr>%s</tr>" % "".join(["<td>%s</td>" % escape(c)
+                                              for c in row]))
+    lines.append("</table>")
+    return "\n".join(lines) + "\n"
+
+
+def table_to_csv(table, fname):
+    """Write a peak table with all fields to a CSV file."""
+    fields = [field for field, _ in peak_dtype]
+    with open(fname, "wb") as fid:
+        writer = csv.writer(fid)
+        writer.writerow(fields)
+        for row in table:
+            writer.writerow([row[field] for field in fields])
+
+
+def write_peak_tables(zstat_file):
+    """Find cluster peaks in a zstat image and write RST and CSV tables."""
+    from os.path import abspath
+    from lyman.tools.clusters import (cluster_table, table_to_rst,
+                                      table_to_csv)
+
+    table = cluster_table(zstat_file)
+
+    rst_file = abspath("peak_table.txt")
+    with open(rst_file, "w") as fid:
+        fid.write(table_to_rst(table))
+
+    csv_file = abspath("peak_table.csv")
+    table_to_csv(table, csv_file)
+
+    return rst_file, csv_file
@@ -7,6 +7,15 @@ parser.add_argument("-s", "-subjects", nargs="*", dest="subjects",
 parser.add_argument("-plugin", default="multiproc",
                     choices=["linear", "multiproc", "ipython", "torque", "sge"],
                     help="worklow execution plugin to use")
-parser.add_argument("-nprocs", default=4, type=int,
-                    help="number of MultiProc processes to use")
+parser.add_argument("-nprocs", type=int,
+                    help="maximum MultiProc processes (default: host cores)")
+parser.add_argument("-memory", type=float,
+                    help="MultiProc memory budget in GB "
+                         "(default: 90%% of available memory)")
 parser.add_argument("-queue", help="which queue for PBS/SGE execution")
+parser.add_argument("-profile", metavar="dir",
+                    help="write node timing and resource profiles to dir")
+parser.add_argument("-rerun", action="store_true",
+                    help="run subjects whose outputs are already current")
+parser.add_argument("-defer_pdf", action="store_true",
+                    help="convert reports to pdf in a batch after the run")
@@ -0,0 +1,65 @@
+"""Deferred imports for the public names of the lyman packages.
+
+The package namespaces expose functions that live in modules with heavy
+dependencies (nipype, networkx, IPython.parallel). Replacing the package
+module with a LazyModule means those dependencies are only imported when
+one of the names is actually used, which keeps command-line startup and
+cluster job startup fast.
+
+"""
+import sys
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    """Package module that imports its public attributes on first access.
+
+    Parameters
+    ----------
+    module : module
+        The package module this object replaces in ``sys.modules``.
+    attrs : dict
+        Maps public attribute names to the module (relative to the package)
+        that defines them. A value of None means the name is a submodule.
+    default : string, optional
+        Module searched for public names that are not in ``attrs``.
+
+    """
+    def __init__(self, module, attrs, default=None):
+        super(LazyModule, self).__init__(module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+
+        # Python 2 clears a module's globals when it is deallocated,
+        # so hold on to the original package module
+        self._lazy_module = module
+        self._lazy_attrs = attrs
+        self._lazy_default = default
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        source = self._lazy_attrs.get(name, self._lazy_default)
+        if name not in self._lazy_attrs and source is None:
+            raise AttributeError("'%s' module has no attribute '%s'"
+                                 % (self.__name__, name))
+
+        if source is None:
+            value = importlib.import_module("." + name, self.__name__)
+        else:
+            module = importlib.import_module(source, self.__name__)
+            try:
+                value = getattr(module, name)
+            except AttributeError:
+                raise AttributeError("'%s' module has no attribute '%s'"
+                                     % (self.__name__, name))
+
+        setattr(self, name, value)
+        return value
+
+
+def lazy_package(name, attrs, default=None):
+    """Replace the named package in sys.modules with a LazyModule."""
+    module = sys.modules[name]
+    sys.modules[name] = LazyModule(module, attrs, default)
@@ -1,8 +1,10 @@
 import os
 import re
-import sys
 import imp
+import types
+import numbers
 import os.path as op
+from copy import deepcopy
 
 import numpy as np
 import networkx as nx
@@ -10,7 +12,17 @@ import networkx as nx
 import nipype
 from nipype.pipeline.engine import Workflow, MapNode, Node
 from nipype.interfaces.base import isdefined
+from nipype.utils.misc import str2bool
 from nipype.interfaces.utility import IdentityInterface
+from nipype.interfaces import io as nio
+from nipype import logging
+
+from .resources import (plan_resources, request_node_memory,
+                        ResourceMultiProcPlugin)
+from .profiling import WorkflowProfiler
+from .reports import set_pdf_deferral
+
+iflogger = logging.getLogger("interface")
 
 
 class InputWrapper(object):
@@ -52,15 +64,9 @@ class OutputWrapper(object):
     def set_mapnode_substitutions(self, n_runs):
         """Find mapnode names and add datasink substitutions to sort by run."""
 
-        # First determine top-level mapnode names
+        # Find mapnodes at any level of workflow nesting
         mapnode_names = find_mapnodes(self.wf)
 
-        # Then determine mapnode names for each nested workflow
-        # Note that this currently only works for one level of nesting
-        nested_workflows = find_nested_workflows(self.wf)
-        for wf in nested_workflows:
-            mapnode_names.extend(find_mapnodes(wf))
-
         # Build a list of substitution tuples
         substitutions = []
         for r in reversed(range(n_runs)):
@@ -106,12 +112,100 @@ class OutputWrapper(object):
                             self.sink_node, prefix + field)
 
 
+_substitution_cache = {}
+
+
+def _substitution_regex(keys):
+    """Compile a regex matching any of the keys, preferring the longest.
+
+    The keys are arranged in a trie so that matching at each position of
+    a path costs at most the length of the longest key, however many
+    keys there are.
+
+    """
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(node[char])
+                    for char in sorted(node) if char]
+        if "" in node:
+            branches.append("")
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:%s)" % "|".join(branches)
+
+    return re.compile(build(trie))
+
+
+class DataSink(nio.DataSink):
+    """DataSink that applies its plain substitutions in a single pass.
+
+    nipype applies each substitution to each path in turn, which gets
+    slow for the run-sorting substitutions generated for workflows with
+    many runs and mapnodes. Here the substitution keys are compiled
+    once into a single regex. Where keys overlap at the same position,
+    the longest one is used, and replacements are never substituted
+    again. Regexp substitutions are applied afterwards, as in nipype.
+
+    """
+    _compiled_subs = None
+
+    def _list_outputs(self):
+        # Compile the substitutions once for all of the sunk paths
+        self._compiled_subs = self._compile_substitutions()
+        try:
+            return super(DataSink, self)._list_outputs()
+        finally:
+            self._compiled_subs = None
+
+    def _compile_substitutions(self):
+        """Return the pattern and lookup table for the plain substitutions."""
+        if not isdefined(self.inputs.substitutions):
+            return None
+        subs = tuple((key, val) for key, val in self.inputs.substitutions
+                     if key)
+        if not subs:
+            return None
+        if subs not in _substitution_cache:
+            lookup = {}
+            for key, val in subs:
+                lookup.setdefault(key, val)
+            _substitution_cache[subs] = _substitution_regex(lookup), lookup
+        return _substitution_cache[subs]
+
+    def _substitute(self, pathstr):
+        orig_pathstr = pathstr
+
+        compiled = self._compiled_subs
+        if compiled is None:
+            compiled = self._compile_substitutions()
+        if compiled is not None:
+            pattern, lookup = compiled
+            pathstr = pattern.sub(lambda m: lookup[m.group(0)], pathstr)
+
+        if isdefined(self.inputs.regexp_substitutions):
+            for key, val in self.inputs.regexp_substitutions:
+                pathstr = re.sub(key, val, pathstr)
+
+        if pathstr != orig_pathstr:
+            iflogger.info("sub: %s -> %s" % (orig_pathstr, pathstr))
+        return pathstr
+
+
 def find_mapnodes(workflow):
-    """Given a workflow, return a list of MapNode names."""
+    """Given a workflow, return a list of MapNode names.
+
+    Nested workflows are searched recursively. Each name is listed once.
+
+    """
     mapnode_names = []
-    wf_nodes = nx.nodes(workflow._graph)
-    for node in wf_nodes:
-        if isinstance(node, MapNode):
+    for node in workflow._get_all_nodes():
+        if isinstance(node, MapNode) and node.name not in mapnode_names:
             mapnode_names.append(node.name)
 
     return mapnode_names
@@ -128,34 +222,87 @@ def find_nested_workflows(workflow):
     return nested_workflows
 
 
-def gather_project_info():
-    """Import project information based on environment settings."""
+class LymanConfig(dict):
+    """Immutable dictionary of project or experiment information.
+
+    Values can be accessed either as items or as attributes. Pickling
+    reduces the object to a plain dictionary of its contents, so it is
+    cheap to send to worker processes.
+
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("%s object is immutable" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+
+_config_cache = {}
+
+
+def _load_config(module_name, fname, process_func=None, copy=False):
+    """Load a config module, caching the result on path and mtime.
+
+    The cached config is shared by every caller. Nested values (e.g. the
+    contrasts list) are not frozen, so callers that will modify them
+    should ask for a deep copy with ``copy=True``.
+
+    """
+    key = (module_name, op.abspath(fname), op.getmtime(fname))
+    if key in _config_cache:
+        config = _config_cache[key]
+        return deepcopy(config) if copy else config
+
+    module = imp.load_source(module_name, fname)
+
+    # Create a dict stripping the OOP hooks and imported modules
+    config = dict([(k, v) for k, v in module.__dict__.items()
+                   if not (re.match("__.*__", k) or
+                           isinstance(v, types.ModuleType))])
+    if process_func is not None:
+        config = process_func(config, module)
+
+    config = LymanConfig(config)
+    _config_cache[key] = config
+    return deepcopy(config) if copy else config
+
+
+def gather_project_info(copy=False):
+    """Import project information based on environment settings.
+
+    Pass ``copy=True`` to get a private copy that is safe to modify.
+
+    """
     proj_file = op.join(os.environ["LYMAN_DIR"], "project.py")
-    try:
-        project = sys.modules["project"]
-    except KeyError:
-        project = imp.load_source("project", proj_file)
-    return dict(
-        [(k, v) for k, v in project.__dict__.items()
-            if not re.match("__.*__", k)])
+    return _load_config("project", proj_file, copy=copy)
+
+
+def gather_experiment_info(experiment_name, altmodel=None, copy=False):
+    """Import an experiment module and add some formatted information.
 
+    Pass ``copy=True`` to get a private copy that is safe to modify.
 
-def gather_experiment_info(experiment_name, altmodel=None):
-    """Import an experiment module and add some formatted information."""
+    """
     if altmodel is None:
         module_name = experiment_name
     else:
         module_name = "-".join([experiment_name, altmodel])
     exp_file = op.join(os.environ["LYMAN_DIR"], module_name + ".py")
-    try:
-        exp = sys.modules[module_name]
-    except KeyError:
-        exp = imp.load_source(module_name, exp_file)
+    return _load_config(module_name, exp_file, _process_experiment_info,
+                        copy)
 
-    # Create an experiment dict stripping the OOP hooks
-    exp_dict = dict(
-        [(k, v) for k, v in exp.__dict__.items() if not re.match("__.*__", k)])
 
+def _process_experiment_info(exp_dict, exp):
+    """Validate the experiment dict and add the derived fields."""
     # Verify some experiment dict attributes
     verify_experiment_info(exp_dict)
 
@@ -196,6 +343,16 @@ def verify_experiment_info(exp_dict):
             and exp_dict["slice_order"] not in ["up", "down"]):
         raise ValueError("slice_order must be 'up' or 'down'")
 
+    for key in ["TR", "hpf_cutoff"]:
+        try:
+            float(exp_dict[key])
+        except (TypeError, ValueError):
+            raise ValueError("%s must be a number" % key)
+
+    if ("n_runs" in exp_dict
+            and not isinstance(exp_dict["n_runs"], numbers.Integral)):
+        raise ValueError("n_runs must be an integer")
+
 
 def determine_subjects(subject_arg):
     """Given list of names or file with list of names, return the list."""
@@ -205,7 +362,13 @@ def determine_subjects(subject_arg):
 
 
 def determine_engine(args):
-    """Read command line args and return Workflow.run() args."""
+    """Read command line args and return Workflow.run() args.
+
+    For local MultiProc execution, the number of processes defaults to
+    the host core count and a memory budget is taken from the memory the
+    host has available, unless -nprocs or -memory were given.
+
+    """
     plugin_dict = dict(linear="Linear", multiproc="MultiProc",
                        ipython="IPython", torque="PBS", sge="SGE")
 
@@ -215,7 +378,10 @@ def determine_engine(args):
     qsub_args = ""
 
     if plugin == "MultiProc":
-        plugin_args['n_procs'] = args.nprocs
+        n_procs, memory_gb = plan_resources(getattr(args, "nprocs", None),
+                                            getattr(args, "memory", None))
+        plugin_args["n_procs"] = n_procs
+        plugin_args["memory_gb"] = memory_gb
     elif plugin in ["SGE", "PBS"]:
         qsub_args += "-V -e /dev/null -o /dev/null "
 
@@ -244,11 +410,91 @@ def crashdump_config(wf, dump_dir):
         wf.config = dict(crashdump_dir=dump_dir)
 
 
-def run_workflow(wf, name=None, args=None):
-    """Run a workflow, if we asked to do so on the command line."""
-    plugin, plugin_args = determine_engine(args)
+class StatusCallbacks(object):
+    """Plugin status callback that forwards to several callbacks."""
+    def __init__(self, callbacks):
+        self.callbacks = list(callbacks)
+
+    def __call__(self, node, status):
+        for callback in self.callbacks:
+            callback(node, status)
+
+
+def run_workflow(wf, name=None, args=None, stage=None, subj_source=None):
+    """Run a workflow, if we asked to do so on the command line.
+
+    When ``args.profile`` names a directory, the run is instrumented and
+    a node timing table and summary are written there as
+    ``<workflow>_profile.csv`` and ``<workflow>_profile.json``.
+
+    When a provenance ``stage`` is given along with the subject source
+    node, subjects whose sunk outputs are already current are left out
+    of the run (unless ``args.rerun`` is set), and the subjects that
+    complete are recorded afterwards.
+
+    Report nodes are told whether to defer PDF conversion according to
+    ``args.defer_pdf``.
+
+    """
     if name is None or name in args.workflows:
-        wf.run(plugin, plugin_args)
+        plugin, plugin_args = determine_engine(args)
+        set_pdf_deferral(wf, getattr(args, "defer_pdf", False))
+        callbacks = []
+
+        if stage is not None:
+            subjects = list(subj_source.iterables[1])
+            if getattr(args, "rerun", False):
+                todo = subjects
+            else:
+                todo = stage.outdated(subjects)
+            if not todo:
+                print "All subjects are current for %s" % stage.name
+                return None
+            subj_source.iterables = ("subject_id", todo)
+            callbacks.append(stage)
+
+        profile_dir = getattr(args, "profile", None)
+        if profile_dir is not None:
+            profiler = WorkflowProfiler(in_process=plugin == "Linear")
+            callbacks.append(profiler)
+            if plugin == "MultiProc":
+                plugin_args["profiler"] = profiler
+
+        if callbacks:
+            plugin_args["status_callback"] = StatusCallbacks(callbacks)
+
+        if plugin == "MultiProc":
+            plugin = ResourceMultiProcPlugin(plugin_args)
+        elif plugin in ["SGE", "PBS"]:
+            request_node_memory(wf, plugin)
+
+        try:
+            graph = wf.run(plugin, plugin_args)
+        except RuntimeError:
+            # Nodes crashed, but unless the run stopped at the first crash
+            # the other subjects ran to completion and can be recorded
+            stop_early = wf.config["execution"].get(
+                "stop_on_first_crash",
+                nipype.config.get("execution", "stop_on_first_crash"))
+            if stage is not None and not str2bool(stop_early):
+                stage.record(todo)
+            raise
+        else:
+            if stage is not None:
+                stage.record(todo)
+        finally:
+            if stage is not None:
+                subj_source.iterables = ("subject_id", subjects)
+
+        if profile_dir is not None:
+            try:
+                os.makedirs(profile_dir)
+            except OSError:
+                pass
+            fname_base = op.join(profile_dir, wf.name + "_profile")
+            profiler.write(fname_base, graph)
+
+        return graph
 
 
 def find_contrast_number(contrast_name, contrast_names):
@@ -272,144 +518,13 @@ def reg_template_args(contrast, mask_args, model_args):
     return mask_args if contrast == "_mask" else model_args
 
 
-def write_workflow_report(workflow_name, report_template, report_dict):
-    """Generic function to take write .rst files and convert to pdf/html.
-
-    Accepts a report template and dictionary. Writes rst once with
-    full paths for image files and generates a pdf, then strips
-    leading path components and writes again, generating an html
-    file that exepects to live in the same directory as report images.
-
-    """
-    from os.path import exists, basename
-    from subprocess import check_output
-
-    # Plug the values into the template for the pdf file
-    report_rst_text = report_template % report_dict
-
-    # Write the rst file and convert to pdf
-    report_pdf_rst_file = "%s_pdf.rst" % workflow_name
-    report_pdf_file = op.abspath("%s_report.pdf" % workflow_name)
-    open(report_pdf_rst_file, "w").write(report_rst_text)
-    check_output(["rst2pdf", report_pdf_rst_file, "-o", report_pdf_file])
-    if not exists(report_pdf_file):
-        raise RuntimeError
-
-    # For images going into the html report, we want the path to be relative
-    # (We expect to read the html page from within the datasink directory
-    # containing the images.  So iteratate through and chop off leading path.
-    for k, v in report_dict.items():
-        if isinstance(v, str) and v.endswith(".png"):
-            report_dict[k] = basename(v)
-
-    # Write the another rst file and convert it to html
-    report_html_rst_file = "%s_html.rst" % workflow_name
-    report_html_file = op.abspath("%s_report.html" % workflow_name)
-    report_rst_text = report_template % report_dict
-    open(report_html_rst_file, "w").write(report_rst_text)
-    check_output(["rst2html.py", report_html_rst_file, report_html_file])
-    if not exists(report_html_file):
-        raise RuntimeError
-
-    # Return both report files as a list
-    return [report_pdf_file, report_html_file]
-
-
-def cluster_to_rst(localmax_file):
-    """Convert the localmax text file from Cluster to RST formatting.
-
-    Also convert the voxel coordinates to MNI coordinates and add in
-    the most likely location and probability from Harvard Oxford atlas.
-
-    """
-    from os.path import abspath
-    import numpy as np
-    from lyman.tools import vox_to_mni, locate_peaks
-
-    out_file = abspath("localmax_table.txt")
-    # Localmax files seem to be badly formed
-    # So geting them into array form is pretty annoying
-    with open(localmax_file) as f:
-        clust_head = f.readline().split()
-        _ = clust_head.pop(1)
-    clust_a = np.loadtxt(localmax_file, str,
-                         delimiter="\t", skiprows=1)
-    if not clust_a.size:
-        with open(out_file, "w") as f:
-            f.write("")
-        return out_file
-    clust_a = np.vstack((clust_head, clust_a))
-    index_v = np.atleast_2d(np.array(
-        ["Peak"] + range(1, clust_a.shape[0]))).T
-    clust_a = np.hstack((index_v, clust_a))
-
-    # Find out where the peaks most likely are
-    loc_a = np.array(locate_peaks(clust_a[1:, 3:6].astype(int)))
-    peak_a = np.hstack((clust_a, loc_a))
-
-    # Convert the voxel coordinates to MNI
-    vox_coords = peak_a[1:, 3:6]
-    peak_a[1:, 3:6] = vox_to_mni(vox_coords)
-
-    # Insert the column-defining dash rows
-    len_a = np.array([[len(c) for c in r] for r in peak_a])
-    max_lens = len_a.max(axis=0)
-    hyphen_v = ["".join(["=" for i in range(l)]) for l in max_lens]
-    peak_l = peak_a.tolist()
-    for pos in [0, 2]:
-        peak_l.insert(pos, hyphen_v)
-    peak_l.append(hyphen_v)
-    peak_a = np.array(peak_l)
-
-    # Write the rows out to a text file with padding
-    len_a = np.array([[len(c) for c in r] for r in peak_a])
-    len_diff = max_lens - len_a
-    pad_a = np.array(
-        [["".join([" " for i in range(l)]) for l in row] for row in len_diff])
-    with open(out_file, "w") as f:
-        for i, row in enumerate(peak_a):
-            for j, word in enumerate(row):
-                f.write("%s%s " % (word, pad_a[i, j]))
-            f.write("\n")
-
-    return out_file
-
-
 def locate_peaks(vox_coords):
     """Find most probable region in HarvardOxford Atlas of a vox coord."""
-    from os import environ
-    import os.path as op
-    import numpy as np
-    from nibabel import load
-    from lyman.tools.main import (harvard_oxford_sub_names,
-                              harvard_oxford_ctx_names)
-    sub_names = harvard_oxford_sub_names
-    ctx_names = harvard_oxford_ctx_names
-    at_dir = op.join(environ["FSLDIR"], "data", "atlases")
-    ctx_data = load(op.join(at_dir, "HarvardOxford",
-                            "HarvardOxford-cort-prob-2mm.nii.gz")).get_data()
-    sub_data = load(op.join(at_dir, "HarvardOxford",
-                            "HarvardOxford-sub-prob-2mm.nii.gz")).get_data()
+    from lyman.tools.atlas import get_atlas
+    names, probs = get_atlas().lookup(vox_coords)
 
     loc_list = [("MaxProb Region", "Prob")]
-    for coord in vox_coords:
-        coord = tuple(coord)
-        ctx_index = np.argmax(ctx_data[coord])
-        ctx_prob = ctx_data[coord][ctx_index]
-        sub_index = np.argmax(sub_data[coord])
-        sub_prob = sub_data[coord][sub_index]
-
-        if not max(sub_prob, ctx_prob):
-            loc_list.append(("Unknown", 0))
-            continue
-        if not ctx_prob and sub_index in [0, 11]:
-            loc_list.append((sub_names[sub_index], sub_prob))
-            continue
-        if sub_prob > ctx_prob and sub_index not in [0, 1, 11, 12]:
-            loc_list.append((sub_names[sub_index], sub_prob))
-            continue
-        loc_list.append((ctx_names[ctx_index], ctx_prob))
-
+    loc_list.extend(zip(names.tolist(), probs.tolist()))
     return loc_list
 
 
@@ -433,17 +548,47 @@ def vox_to_mni(vox_coords):
 
     """
     import numpy as np
-    from nibabel import load
     from nipype.interfaces.fsl import Info
+    from lyman.tools import vox_to_world
 
     mni_file = Info.standard_image("avg152T1.nii.gz")
-    aff = load(mni_file).get_affine()
+    vox_coords = np.asarray(vox_coords)
     mni_coords = np.zeros_like(vox_coords)
-    for i, coord in enumerate(vox_coords):
-        coord = coord.astype(float)
-        mni_coords[i] = np.dot(aff, np.r_[coord, 1])[:3].astype(int)
+    mni_coords[:] = vox_to_world(vox_coords.astype(float),
+                                 mni_file).astype(int)
     return mni_coords
 
+
+_affine_cache = {}
+
+
+def image_affine(fname):
+    """Return the affine for an image, reading each file only once."""
+    from nibabel import load
+    key = (op.abspath(fname), op.getmtime(fname))
+    if key not in _affine_cache:
+        _affine_cache[key] = load(fname).get_affine()
+    return _affine_cache[key]
+
+
+def apply_affine(aff, coords):
+    """Transform an n x 3 array of coordinates with a 4 x 4 affine."""
+    coords = np.atleast_2d(coords).astype(float)
+    coords = np.column_stack([coords, np.ones(len(coords))])
+    return np.dot(coords, np.transpose(aff))[:, :3]
+
+
+def vox_to_world(vox_coords, image_file):
+    """Convert n x 3 ijk voxel coordinates to xyz coordinates for an image."""
+    return apply_affine(image_affine(image_file), vox_coords)
+
+
+def world_to_vox(world_coords, image_file):
+    """Convert n x 3 xyz coordinates to (rounded) ijk voxel coordinates."""
+    inv_aff = np.linalg.inv(image_affine(image_file))
+    vox_coords = apply_affine(inv_aff, world_coords)
+    return np.round(vox_coords).astype(int)
+
 harvard_oxford_sub_subs = [
     ("Left", "L"),
     ("Right", "R"),
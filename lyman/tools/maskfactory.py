@@ -1,13 +1,580 @@
 """Defines a class for flexible functional mask generation."""
 import os
 import os.path as op
+import csv
+import copy
+import json
+import time
 import shutil
-from tempfile import mkdtemp
-from subprocess import check_output
-from IPython.parallel import Client
-from IPython.parallel.error import TimeoutError
+import hashlib
+import functools
+import threading
+from tempfile import mkdtemp, TemporaryFile
+from subprocess import Popen, STDOUT, check_output
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nib
 
 from . import main
+from .resources import host_resources
+from .provenance import _file_stats
+
+# Shortcuts for the mri_label2vol --proj arguments
+projection_samples = dict(white=["frac", "0", "0", "0"],
+                          graymid=["frac", ".5", ".5", "0"],
+                          pial=["frac", "1", "1", "0"],
+                          cortex=["frac", "0", "1", ".1"])
+
+roi_types = ["fsaverage_label", "native_label", "index_volume", "stat_volume"]
+
+# Upper bound on the default size of the local pool; each command reads
+# and writes whole volumes, so more than this tends to saturate the
+# (often shared) filesystem rather than use the extra cores
+max_local_procs = 16
+
+
+class CommandError(RuntimeError):
+    """Raised when external commands fail or time out.
+
+    Parameters
+    ----------
+    failures : list of dicts
+        One entry per failed command with ``cmd``, ``returncode`` (None
+        if the command timed out or could not start), ``output`` and the
+        ``args`` (e.g. ``subj`` and ``hemi``) the command was built from.
+
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        lines = ["%d command(s) failed:" % len(failures)]
+        for failure in failures:
+            label = ", ".join("%s %s" % item
+                              for item in sorted(failure["args"].items()))
+            if failure["returncode"] is None:
+                status = failure["output"]
+            else:
+                status = "exited with status %d" % failure["returncode"]
+            lines.append("  %s: %s %s" % (label or "command",
+                                          failure["cmd"][0], status))
+            tail = failure["output"].strip().splitlines()[-5:]
+            lines.extend("    " + line for line in tail
+                         if failure["returncode"] is not None)
+        super(CommandError, self).__init__("\n".join(lines))
+
+
+def run_commands(cmd_list, cmd_args=None, n_procs=None, timeout=None,
+                 poll_interval=.05):
+    """Run external commands in a pool of local processes.
+
+    Parameters
+    ----------
+    cmd_list : list of argument lists
+        Commands to execute.
+    cmd_args : list of dicts, optional
+        Labels for each command (e.g. subject and hemisphere) used to
+        report failures.
+    n_procs : int, optional
+        Maximum number of commands to run at once. Defaults to the number
+        of cores, up to ``max_local_procs``.
+    timeout : float, optional
+        Seconds after which a command is killed and counted as failed.
+    poll_interval : float, optional
+        Seconds to wait between checks on the running commands.
+
+    Returns
+    -------
+    outputs : list of strings
+        Combined stdout and stderr of each command.
+
+    Raises
+    ------
+    CommandError
+        If any command failed; the others are still run to completion.
+
+    """
+    if cmd_args is None:
+        cmd_args = [{} for cmd in cmd_list]
+    if n_procs is None:
+        n_procs = min(host_resources()[0], max_local_procs)
+    n_procs = max(1, n_procs)
+
+    queue = list(enumerate(cmd_list))[::-1]
+    outputs = [None] * len(cmd_list)
+    running = {}
+    failures = []
+
+    def fail(i, returncode, output):
+        failures.append(dict(cmd=cmd_list[i], args=cmd_args[i],
+                             returncode=returncode, output=output))
+
+    while queue or running:
+
+        # Top up the pool
+        while queue and len(running) < n_procs:
+            i, cmd = queue.pop()
+            # Write output to a file so a chatty command can't fill a pipe
+            out_fid = TemporaryFile()
+            try:
+                proc = Popen(cmd, stdout=out_fid, stderr=STDOUT)
+            except OSError as err:
+                out_fid.close()
+                fail(i, None, "could not be started (%s)" % err.strerror)
+                continue
+            running[i] = proc, out_fid, time.time()
+
+        time.sleep(poll_interval)
+
+        # Collect finished or overdue commands
+        for i, (proc, out_fid, start) in running.items():
+            returncode = proc.poll()
+            timed_out = False
+            if returncode is None:
+                if timeout is None or time.time() - start < timeout:
+                    continue
+                proc.kill()
+                proc.wait()
+                timed_out = True
+            out_fid.seek(0)
+            outputs[i] = out_fid.read()
+            out_fid.close()
+            del running[i]
+            if timed_out:
+                fail(i, None, "timed out after %g seconds" % timeout)
+            elif returncode:
+                fail(i, returncode, outputs[i])
+
+    if failures:
+        raise CommandError(failures)
+    return outputs
+
+
+def run_functions(func, func_args, cmd_args=None, n_procs=None):
+    """Call a function on each set of arguments in a pool of threads.
+
+    This is the in-process counterpart of :func:`run_commands` for steps
+    that are plain array operations. The work is dominated by NumPy and
+    by (de)compressing images, both of which release the GIL.
+
+    Parameters
+    ----------
+    func : callable
+        Function to call.
+    func_args : list of tuples
+        Positional arguments for each call.
+    cmd_args : list of dicts, optional
+        Labels for each call used to report failures.
+    n_procs : int, optional
+        Number of threads; defaults as in :func:`run_commands`.
+
+    Returns
+    -------
+    results : list
+        Return value of each call.
+
+    Raises
+    ------
+    CommandError
+        If any call raised; the others are still run to completion.
+        Failures of commands run within a call are reported individually.
+
+    """
+    if cmd_args is None:
+        cmd_args = [{} for args in func_args]
+    if n_procs is None:
+        n_procs = min(host_resources()[0], max_local_procs)
+
+    def call(args):
+        try:
+            return func(*args), None
+        except Exception as err:
+            return None, err
+
+    pool = ThreadPool(max(1, min(n_procs, len(func_args))))
+    try:
+        results = pool.map(call, func_args)
+    finally:
+        pool.close()
+
+    failures = []
+    for (result, err), label in zip(results, cmd_args):
+        if isinstance(err, CommandError):
+            failures.extend(dict(failure, args=dict(label, **failure["args"]))
+                            for failure in err.failures)
+        elif err is not None:
+            failures.append(dict(cmd=[func.__name__], args=label,
+                                 returncode=None,
+                                 output="%s: %s" % (type(err).__name__, err)))
+    if failures:
+        raise CommandError(failures)
+    return [result for result, err in results]
+
+
+def ram_scratch_dir():
+    """Return a RAM-backed directory for scratch files, or None."""
+    for path in ["/dev/shm", "/run/shm"]:
+        if op.isdir(path) and os.access(path, os.W_OK):
+            return path
+
+
+def _save_mask(mask, img, out_file):
+    """Write a boolean array as a nifti mask in the space of img."""
+    hdr = None
+    if isinstance(img, nib.Nifti1Image):
+        hdr = img.get_header().copy()
+        hdr.set_data_dtype(np.uint8)
+    mask_img = nib.Nifti1Image(mask.astype(np.uint8), img.get_affine(), hdr)
+    nib.save(mask_img, out_file)
+
+
+def read_tkreg(reg_file):
+    """Read the matrix from a tkregister-style registration file."""
+    with open(reg_file) as fid:
+        lines = fid.read().splitlines()
+    return np.array([line.split() for line in lines[4:8]], np.float)
+
+
+def tkr_vox2ras(img):
+    """Return the tkregister vox2ras matrix for an image.
+
+    This is the scanner vox2ras with the center of the volume moved to
+    the origin, as Freesurfer computes it.
+
+    """
+    vox2ras = img.get_affine().copy()
+    center = np.array(img.shape[:3]) / 2.
+    vox2ras[:3, 3] = -vox2ras[:3, :3].dot(center)
+    return vox2ras
+
+
+def project_label(label_file, white_file, pial_file, reg, epi_img,
+                  proj_args):
+    """Project a surface label into a functional volume.
+
+    Each label vertex is sampled between its white and pial surface
+    positions at the cortical depth fractions given by ``proj_args``
+    (``["frac", start, stop, delta]``, as for ``mri_label2vol --proj``),
+    and the voxels containing any sample are included in the mask.
+
+    Parameters
+    ----------
+    label_file, white_file, pial_file : strings
+        Freesurfer label and the subject's surfaces for its hemisphere.
+    reg : 4 x 4 array
+        tkregister matrix from anatomical to functional surface RAS.
+    epi_img : nibabel image
+        Defines the functional volume.
+    proj_args : list
+        Projection type (only "frac" is supported) and range.
+
+    Returns
+    -------
+    mask : boolean array
+
+    """
+    proj_type, start, stop, delta = proj_args
+    if proj_type != "frac":
+        raise ValueError("Only fractional projections can be done natively")
+    start, stop, delta = float(start), float(stop), float(delta)
+    if delta:
+        fracs = np.arange(start, stop + delta / 2, delta)
+    else:
+        fracs = np.array([start])
+
+    vertices = nib.freesurfer.read_label(label_file)
+    white = nib.freesurfer.read_geometry(white_file)[0][vertices]
+    pial = nib.freesurfer.read_geometry(pial_file)[0][vertices]
+
+    # Sample at each depth for all vertices at once
+    points = white + fracs[:, np.newaxis, np.newaxis] * (pial - white)
+    points = points.reshape(-1, 3)
+    points = np.column_stack([points, np.ones(len(points))])
+
+    # Map into (rounded) functional voxel coordinates
+    xfm = np.linalg.inv(tkr_vox2ras(epi_img)).dot(reg)
+    ijk = np.floor(xfm.dot(points.T)[:3].T + .5).astype(int)
+    shape = epi_img.shape[:3]
+    ijk = ijk[np.all((ijk >= 0) & (ijk < shape), axis=1)]
+
+    mask = np.zeros(shape, bool)
+    mask[tuple(ijk.T)] = True
+    return mask
+
+
+def mask_mosaic(bg_data, mask_data, width=750, alpha=.6):
+    """Draw the axial slices of a mask over a background image.
+
+    Parameters
+    ----------
+    bg_data, mask_data : 3D arrays
+        Background (e.g. mean functional) and mask in the same space.
+    width : int, optional
+        Approximate width of the mosaic in pixels; slices are enlarged
+        by an integer factor to get close to this.
+    alpha : float, optional
+        Opacity of the mask color.
+
+    Returns
+    -------
+    mosaic : uint8 array (rows x columns x 3)
+        RGB image with inferior slices first and anterior up.
+
+    """
+    bg = np.asarray(bg_data, np.float)
+    bg = bg.reshape(bg.shape[:3])
+    mask = np.asarray(mask_data).reshape(bg.shape) > 0
+
+    # Scale the background to a robust maximum
+    vmax = np.percentile(bg[bg > 0], 98) if (bg > 0).any() else 1
+    bg = np.clip(bg / vmax, 0, 1)
+
+    # Color the masked voxels red
+    rgb = np.repeat(bg[..., np.newaxis], 3, axis=-1)
+    rgb[mask] *= 1 - alpha
+    rgb[mask, 0] += alpha
+
+    # Stack the axial slices with anterior up and tile them
+    slices = rgb.transpose(2, 1, 0, 3)[:, ::-1]
+    n_slices, n_y, n_x, _ = slices.shape
+    n_col = int(np.ceil(np.sqrt(n_slices)))
+    n_row = int(np.ceil(float(n_slices) / n_col))
+    tiles = np.zeros((n_row * n_col, n_y, n_x, 3))
+    tiles[:n_slices] = slices
+    mosaic = (tiles.reshape(n_row, n_col, n_y, n_x, 3)
+                   .transpose(0, 2, 1, 3, 4)
+                   .reshape(n_row * n_y, n_col * n_x, 3))
+
+    scale = max(1, width // (n_col * n_x))
+    mosaic = mosaic.repeat(scale, axis=0).repeat(scale, axis=1)
+    return (mosaic * 255).astype(np.uint8)
+
+
+def write_mask_png(bg_file, mask_file, out_file):
+    """Write a mosaic of a mask over its background image."""
+    from matplotlib.image import imsave
+    mosaic = mask_mosaic(nib.load(bg_file).get_data(),
+                         nib.load(mask_file).get_data())
+    imsave(out_file, mosaic)
+
+
+def write_contact_sheet(png_files, titles, out_file, n_col=None):
+    """Tile a set of png images with titles into one image.
+
+    Missing files are drawn as empty panels.
+
+    """
+    from matplotlib.image import imread
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    n_img = len(png_files)
+    if n_col is None:
+        n_col = int(np.ceil(np.sqrt(n_img)))
+    n_row = int(np.ceil(float(n_img) / n_col))
+
+    fig = Figure(figsize=(2 * n_col, 2.2 * n_row), facecolor="k")
+    FigureCanvasAgg(fig)
+    for i, (png_file, title) in enumerate(zip(png_files, titles)):
+        ax = fig.add_subplot(n_row, n_col, i + 1)
+        if op.exists(png_file):
+            ax.imshow(imread(png_file), interpolation="nearest")
+        ax.set_title(title, color="w", fontsize=10)
+        ax.set_axis_off()
+    fig.subplots_adjust(0, 0, 1, .95, .02, .1)
+    fig.savefig(out_file, facecolor="k", dpi=100)
+
+
+def threshold_image(in_file, thresh, out_file):
+    """Binarize an image at a threshold (as ``fslmaths -thr -bin``).
+
+    Returns
+    -------
+    mask : boolean array
+
+    """
+    img = nib.load(in_file)
+    data = img.get_data()
+    mask = (data >= float(thresh)) & (data != 0)
+    _save_mask(mask, img, out_file)
+    return mask
+
+
+def binarize_labels(in_file, label_ids, out_file):
+    """Mask the voxels with any of the given labels (as mri_binarize)."""
+    img = nib.load(in_file)
+    mask = np.isin(img.get_data(), list(label_ids))
+    _save_mask(mask, img, out_file)
+
+
+def read_roi_table(fname):
+    """Read a csv file specifying a batch of ROIs.
+
+    The file has a header and one row per ROI with the columns
+
+    - ``roi``: name of the output mask.
+    - ``type``: one of ``fsaverage_label``, ``native_label``,
+      ``index_volume``, or ``stat_volume``.
+    - ``source``: path template for the original image or label, with
+      ``subj`` and ``hemi`` format keys. For labels this can be just
+      the label name in the Freesurfer hierarchy; for index volumes it
+      can be ``aseg``.
+    - ``hemi``: ``lh`` or ``rh`` for a unilateral label, otherwise empty.
+    - ``param``: projection for labels (a key of ``projection_samples``
+      or four mri_label2vol --proj arguments), space-separated region
+      ids for index volumes, or the threshold for stat volumes.
+
+    Returns
+    -------
+    rois : list of dicts
+
+    """
+    with open(fname) as fid:
+        rois = [dict((k.strip(), (v or "").strip()) for k, v in row.items())
+                for row in csv.DictReader(fid)]
+    for roi in rois:
+        if roi.get("type") not in roi_types:
+            raise ValueError("ROI %s has unknown type '%s'"
+                             % (roi.get("roi"), roi.get("type")))
+        if not roi.get("param"):
+            raise ValueError("ROI %s needs a param" % roi["roi"])
+    return rois
+
+
+stats_columns = ["subject", "roi", "voxels", "volume_mm3",
+                 "func_mask_voxels", "func_mask_fraction",
+                 "mni_voxels", "mni_dice"]
+
+
+class MaskStatistics(object):
+    """Accumulate summary statistics for masks as they are made.
+
+    Statistics are computed from mask arrays that are already in memory,
+    and masks from different threads can be added concurrently.
+
+    """
+    def __init__(self):
+        self.rows = {}
+        self._lock = threading.Lock()
+
+    def add(self, subj, roi, mask, zooms, func_mask=None):
+        """Count the voxels in a mask and its overlap with the brain.
+
+        Parameters
+        ----------
+        subj, roi : strings
+        mask : boolean array
+        zooms : sequence
+            Voxel size in mm.
+        func_mask : boolean array, optional
+            Functional brain mask in the same space.
+
+        """
+        voxels = int(mask.sum())
+        stats = dict(voxels=voxels,
+                     volume_mm3=voxels * float(np.prod(zooms[:3])),
+                     func_mask_voxels=np.nan, func_mask_fraction=np.nan)
+        if func_mask is not None:
+            overlap = int((mask & func_mask).sum())
+            stats["func_mask_voxels"] = overlap
+            stats["func_mask_fraction"] = (float(overlap) / voxels
+                                           if voxels else np.nan)
+        with self._lock:
+            self._row(subj, roi).update(stats)
+
+    def _row(self, subj, roi):
+        """Return the (possibly new) row for a subject and roi."""
+        if (subj, roi) not in self.rows:
+            row = dict((col, np.nan) for col in stats_columns)
+            row.update(subject=subj, roi=roi)
+            self.rows[subj, roi] = row
+        return self.rows[subj, roi]
+
+    def add_mni_overlap(self, roi, subjects, masks):
+        """Compare masks for one roi across subjects in a common space.
+
+        Parameters
+        ----------
+        roi : string
+        subjects : list of strings
+        masks : boolean array (subjects x voxels)
+
+        Returns
+        -------
+        prob : float array
+            Fraction of subjects including each voxel.
+
+        """
+        masks = np.asarray(masks, bool)
+        prob = masks.mean(axis=0)
+
+        # Pairwise Dice coefficients over the voxels in any mask
+        used = masks[:, masks.any(axis=0)].astype(np.float)
+        sizes = used.sum(axis=1)
+        overlap = used.dot(used.T)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            dice = 2 * overlap / (sizes[:, np.newaxis] + sizes)
+        np.fill_diagonal(dice, np.nan)
+
+        with self._lock:
+            for i, subj in enumerate(subjects):
+                row = self._row(subj, roi)
+                row["mni_voxels"] = int(sizes[i])
+                if len(subjects) > 1:
+                    row["mni_dice"] = np.nanmean(dice[i])
+        return prob
+
+    def write(self, fname):
+        """Write a csv table with one row per subject and roi."""
+        with open(fname, "wb") as fid:
+            writer = csv.writer(fid)
+            writer.writerow(stats_columns)
+            for key in sorted(self.rows, key=lambda k: (k[1], k[0])):
+                writer.writerow([self.rows[key][col]
+                                 for col in stats_columns])
+
+
+def _skip_current(method):
+    """Run a mask-making method only for subjects with an outdated mask.
+
+    The first argument of the method is the template for its source
+    file, which is fingerprinted along with the functional template and
+    registration of each subject and the rest of the arguments. The
+    outdated subjects are then streamed through the method one at a time
+    (see ``MaskFactory._stream``). Calls made from within another
+    tracked method are not filtered again.
+
+    """
+    @functools.wraps(method)
+    def wrapper(self, source_template, *args, **kwargs):
+        if self._tracking:
+            return method(self, source_template, *args, **kwargs)
+
+        params = [method.__name__, args, kwargs]
+        fingerprints = dict((subj, self._mask_fingerprint(subj,
+                                                          [source_template],
+                                                          params))
+                            for subj in self.subject_list)
+        subjects = self.subject_list
+        todo = [subj for subj in subjects
+                if not self.mask_is_current(subj, self.roi_name,
+                                            fingerprints[subj][0])]
+        if self.debug:
+            print "Masks are current for %d subjects" % (len(subjects)
+                                                         - len(todo))
+        self.updated_subjects = todo
+        if not todo:
+            return
+
+        def run(factory):
+            method(factory, source_template, *args, **kwargs)
+            for subj in factory.subject_list:
+                factory.record_mask(subj, self.roi_name, *fingerprints[subj])
+                if (subj, self.roi_name) not in factory.stats.rows:
+                    factory.add_stats(subj, self.roi_name)
+
+        self._stream(run, todo)
+
+    return wrapper
 
 
 class MaskFactory(object):
@@ -17,9 +584,32 @@ class MaskFactory(object):
     FSL) command-line programs to take ROIs defined in a variety of
     sources and generate binary mask images in native EPI space.
 
+    Commands run on the engines of an IPython cluster if one is
+    available; otherwise (or if ``n_procs`` is given) they run in a pool
+    of local processes sized to the host.
+
+    Each mask has a ``.sources.json`` sidecar recording the source file,
+    functional template, and registration it was made from. Masks whose
+    sidecar still matches are not remade unless ``force`` is True.
+
+    Surface labels are projected with ``mri_label2vol``. If
+    ``native_projection`` is True, fractional projections are instead
+    computed in-process from the white and pial surfaces. That samples
+    along the line from white to pial rather than along the surface
+    normal scaled by thickness, so the masks can differ slightly from
+    the ``mri_label2vol`` ones.
+
+    When running locally, each subject goes through all of the steps on
+    its own in a scratch directory that is removed as soon as its mask is
+    written (in debug mode, the scratch directories of failed subjects
+    are kept). Scratch directories are made under ``scratch_dir``, which
+    can be "ram" to use a memory-backed filesystem where available.
+
     """
     def __init__(self, subject_list, experiment, roi_name,
-                 orig_type, force_serial=False, debug=False):
+                 orig_type, force_serial=False, debug=False,
+                 n_procs=None, timeout=None, force=False,
+                 native_projection=False, scratch_dir=None):
 
         # Set up basic info
         self.subject_list = main.determine_subjects(subject_list)
@@ -28,6 +618,12 @@ class MaskFactory(object):
         self.roi_name = roi_name
         self.orig_type = orig_type
         self.debug = debug
+        self.force = force
+        self.native_projection = native_projection
+        self.updated_subjects = list(self.subject_list)
+        self.updated_rois = {}
+        self.stats = MaskStatistics()
+        self._tracking = False
         if debug:
             print "Setting up for %d subjects" % len(subject_list)
             print "Experiment name:", experiment
@@ -41,16 +637,23 @@ class MaskFactory(object):
         self.anal_dir = project["analysis_dir"]
 
         # Set up temporary output
-        self.temp_dir = mkdtemp()
+        if scratch_dir == "ram":
+            scratch_dir = ram_scratch_dir()
+        self.temp_dir = mkdtemp(prefix="lyman_masks_", dir=scratch_dir)
+        self._owns_temp = True
+        if debug:
+            print "Scratch directory:", self.temp_dir
 
         # Set the SUBJECTS_DIR variable for Freesurfer
         os.environ["SUBJECTS_DIR"] = self.data_dir
 
         # Set up parallel execution
         self.parallel = False
-        if force_serial:
-            self.map = map
-        else:
+        self.n_procs = 1 if force_serial else n_procs
+        self.timeout = timeout
+        if not force_serial and n_procs is None:
+            from IPython.parallel import Client
+            from IPython.parallel.error import TimeoutError
             try:
                 rc = Client()
                 self.dv = rc[:]
@@ -62,10 +665,16 @@ class MaskFactory(object):
                 self.parallel = True
 
             except (TimeoutError, IOError):
-                self.map = map
+                pass
         if debug:
-            print "Set to run in %s" % (
-                "parallel" if self.parallel else "serial")
+            if self.parallel:
+                print "Set to run on IPython cluster"
+            elif self.n_procs == 1:
+                print "Set to run in serial"
+            else:
+                print "Set to run in local pool of %d processes" % (
+                    self.n_procs or min(host_resources()[0],
+                                        max_local_procs))
 
         # Set up some persistent templates
         self.epi_template = op.join(self.anal_dir, self.experiment,
@@ -74,9 +683,18 @@ class MaskFactory(object):
         self.reg_template = op.join(self.anal_dir, self.experiment,
                                     "%(subj)s",
                                     "preproc/run_1/func2anat_tkreg.dat")
-        self.out_template = op.join(self.data_dir,
-                                    "%(subj)s",
-                                    "masks/%s.nii.gz" % self.roi_name)
+        self.func_mask_template = op.join(self.anal_dir, self.experiment,
+                                          "%(subj)s", "preproc/run_1",
+                                          "functional_mask.nii.gz")
+        self.mask_template = op.join(self.data_dir,
+                                     "%(subj)s",
+                                     "masks/%(roi)s.nii.gz")
+        self.out_template = self.mask_template.replace("%(roi)s",
+                                                       str(self.roi_name))
+        self.sidecar_template = self.mask_template.replace(".nii.gz",
+                                                           ".sources.json")
+        self.surf_template = op.join(self.data_dir, "%(subj)s", "surf",
+                                     "%(hemi)s.%(surf)s")
         if debug:
             print "EPI template: %s" % self.epi_template
             print "Reg template: %s" % self.reg_template
@@ -88,14 +706,140 @@ class MaskFactory(object):
             if not op.exists(mask_dir):
                 os.mkdir(mask_dir)
 
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.cleanup()
+
     def __del__(self):
 
-        if self.debug:
-            print "Debug mode: not removing output directory:"
+        if hasattr(self, "temp_dir"):
+            self.cleanup()
+
+    def cleanup(self):
+        """Remove the scratch directory."""
+        if not self._owns_temp or not op.exists(self.temp_dir):
+            return
+        if self.debug and os.listdir(self.temp_dir):
+            print "Debug mode: not removing scratch directory:"
             print self.temp_dir
         else:
-            shutil.rmtree(self.temp_dir)
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _stream(self, func, subjects=None):
+        """Run each subject through a processing function on its own.
+
+        Locally, every subject gets a copy of the factory limited to that
+        subject, with a single process and its own scratch directory
+        that is removed as soon as the subject is finished. Subjects run
+        concurrently in the thread pool, so the scratch space in use is
+        bounded by the number of processes rather than the batch size.
+        On an IPython cluster, the function is called once with all of
+        the subjects.
 
+        Returns
+        -------
+        factories : list
+            The factory objects the function was called with.
+
+        """
+        if subjects is None:
+            subjects = self.subject_list
+        if self.parallel:
+            state = self.subject_list, self._tracking
+            self.subject_list, self._tracking = subjects, True
+            try:
+                func(self)
+            finally:
+                self.subject_list, self._tracking = state
+            return [self]
+
+        func_args = [(func, subj) for subj in subjects]
+        return run_functions(self._run_subject, func_args,
+                             self._subject_args(subjects), self.n_procs)
+
+    def _run_subject(self, func, subj):
+        """Call a processing function for one subject in its own scratch."""
+        factory = copy.copy(self)
+        factory.subject_list = [subj]
+        factory.n_procs = 1
+        factory._tracking = True
+        factory._owns_temp = False
+        factory.temp_dir = mkdtemp(prefix=subj + "_", dir=self.temp_dir)
+        try:
+            func(factory)
+        except Exception:
+            if self.debug:
+                print "Keeping scratch directory for %s:" % subj
+                print factory.temp_dir
+            else:
+                shutil.rmtree(factory.temp_dir, ignore_errors=True)
+            raise
+        shutil.rmtree(factory.temp_dir, ignore_errors=True)
+        return factory
+
+    def _mask_fingerprint(self, subj, source_templates, params):
+        """Fingerprint the inputs to one subject's mask.
+
+        Masks made from surface labels also depend on the subject's
+        surfaces and on how the projection is done.
+
+        Returns
+        -------
+        fingerprint : string
+            Hash of the parameters and the input file stats.
+        inputs : dict
+            Size and modification time of each input file.
+
+        """
+        templates = list(source_templates) + [self.epi_template,
+                                              self.reg_template]
+        if any(temp.endswith(".label") for temp in source_templates):
+            templates.extend(self.surf_template.replace("%(surf)s", surf)
+                             for surf in ["white", "pial", "thickness"])
+            params = [params, dict(native_projection=self.native_projection)]
+        fnames = []
+        for temp in templates:
+            for hemi in ["lh", "rh"]:
+                fname = temp % dict(subj=subj, hemi=hemi)
+                if fname not in fnames:
+                    fnames.append(fname)
+        inputs = _file_stats(fnames)
+        hasher = hashlib.sha1()
+        hasher.update(json.dumps(params, sort_keys=True, default=repr))
+        hasher.update(json.dumps(sorted(inputs.items())))
+        return hasher.hexdigest(), inputs
+
+    def mask_is_current(self, subj, roi, fingerprint):
+        """True if a mask was made from these inputs and is unchanged."""
+        if self.force:
+            return False
+        try:
+            with open(self.sidecar_template % dict(subj=subj, roi=roi)) as fid:
+                record = json.load(fid)
+        except (IOError, ValueError):
+            return False
+        if record["fingerprint"] != fingerprint:
+            return False
+        for fname, stat in record["outputs"].items():
+            if _file_stats([fname]).get(fname) != stat:
+                return False
+        return True
+
+    def record_mask(self, subj, roi, fingerprint, inputs):
+        """Write the sidecar describing how a mask was made."""
+        args = dict(subj=subj, roi=roi)
+        mask_file = self.mask_template % args
+        record = dict(fingerprint=fingerprint, inputs=inputs,
+                      outputs=_file_stats([mask_file]),
+                      created=time.asctime())
+        with open(self.sidecar_template % args, "w") as fid:
+            json.dump(record, fid, sort_keys=True, indent=2)
+
+    @_skip_current
     def from_common_label(self, label_template, hemis, proj_args,
                           save_native=False):
         """Reverse normalize possibly bilateral labels to native space."""
@@ -103,10 +847,11 @@ class MaskFactory(object):
                                     "%(hemi)s.%(subj)s_native_label.label")
 
         # Transform by subject and hemi
-        warp_cmds = []
+        warp_cmds, warp_args = [], []
         for subj in self.subject_list:
             for hemi in hemis:
                 args = dict(hemi=hemi, subj=subj)
+                warp_args.append(args)
                 cmd = ["mri_label2label",
                        "--srcsubject", "fsaverage",
                        "--trgsubject", subj,
@@ -117,7 +862,7 @@ class MaskFactory(object):
                 warp_cmds.append(cmd)
 
         # Execute the transformation
-        self.execute(warp_cmds, native_label_temp)
+        self.execute(warp_cmds, native_label_temp, warp_args)
 
         # Possibly copy the resulting native space label to
         # the subject's label directory
@@ -132,15 +877,24 @@ class MaskFactory(object):
         # Carry on with the native label stage
         self.from_native_label(native_label_temp, hemis, proj_args)
 
+    @_skip_current
     def from_native_label(self, label_template, hemis, proj_args):
         """Given possibly bilateral native labels, make epi masks."""
+        if self._project_natively(proj_args):
+            func_args = [(subj, label_template, hemis, proj_args)
+                         for subj in self.subject_list]
+            self.execute_local(self._write_label_mask, func_args,
+                               self.out_template)
+            return
+
         indiv_mask_temp = op.join(self.temp_dir,
                                   "%(hemi)s.%(subj)s_mask.nii.gz")
         # Command list for this step
-        proj_cmds = []
+        proj_cmds, proj_args_list = [], []
         for subj in self.subject_list:
             for hemi in hemis:
                 args = dict(hemi=hemi, subj=subj)
+                proj_args_list.append(args)
                 cmd = ["mri_label2vol",
                        "--label", label_template % args,
                        "--temp", self.epi_template % args,
@@ -153,7 +907,7 @@ class MaskFactory(object):
                 proj_cmds.append(cmd)
 
         # Execute the projection from a surface label
-        self.execute(proj_cmds, indiv_mask_temp)
+        self.execute(proj_cmds, indiv_mask_temp, proj_args_list)
 
         # Combine the bilateral masks into the final mask
         combine_cmds = []
@@ -167,27 +921,51 @@ class MaskFactory(object):
             combine_cmds.append(cmd)
 
         # Execute the final step
-        self.execute(combine_cmds, self.out_template)
+        self.execute(combine_cmds, self.out_template,
+                     self._subject_args())
+
+    def _project_natively(self, proj_args):
+        """True if a label projection can be done in-process."""
+        return self.native_projection and proj_args[0] == "frac"
+
+    def _project_labels(self, subj, label_template, hemis, proj_args):
+        """Project labels for one subject and combine the hemispheres."""
+        epi_img = nib.load(self.epi_template % dict(subj=subj))
+        reg = read_tkreg(self.reg_template % dict(subj=subj))
+        mask = np.zeros(epi_img.shape[:3], bool)
+        for hemi in hemis:
+            args = dict(subj=subj, hemi=hemi)
+            white_file = self.surf_template % dict(args, surf="white")
+            pial_file = self.surf_template % dict(args, surf="pial")
+            mask |= project_label(label_template % args, white_file,
+                                  pial_file, reg, epi_img, proj_args)
+        return mask, epi_img
+
+    def _write_label_mask(self, subj, label_template, hemis, proj_args):
+        """Write the bilateral mask for one subject's labels."""
+        mask, epi_img = self._project_labels(subj, label_template,
+                                             hemis, proj_args)
+        _save_mask(mask, epi_img, self.out_template % dict(subj=subj))
+        self.add_stats(subj, self.roi_name, mask, epi_img.get_header())
 
+    @_skip_current
     def from_hires_atlas(self, hires_atlas_template, region_ids):
         """Create epi space mask from index volume (e.g. aseg.mgz"""
         hires_mask_template = op.join(self.temp_dir,
                                       "%(subj)s_hires_mask.nii.gz")
 
-        # First run mri_binarize
-        bin_cmds = []
+        # First binarize the atlas; only the transformation to
+        # functional space needs Freesurfer
+        bin_args = []
         for subj in self.subject_list:
             args = dict(subj=subj)
-            cmd_list = ["mri_binarize",
-                        "--i", hires_atlas_template % args,
-                        "--o", hires_mask_template % args]
-            for id in region_ids:
-                cmd_list.extend(["--match", str(id)])
-            bin_cmds.append(cmd_list)
-        self.execute(bin_cmds, hires_mask_template)
+            bin_args.append((hires_atlas_template % args, region_ids,
+                             hires_mask_template % args))
+        self.execute_local(binarize_labels, bin_args, hires_mask_template)
 
         self.from_hires_mask(hires_mask_template)
 
+    @_skip_current
     def from_hires_mask(self, hires_mask_template):
         """Create epi space mask from hires mask (binary) volume."""
         xfm_cmds = []
@@ -202,72 +980,412 @@ class MaskFactory(object):
                        "--reg", self.reg_template % args,
                        "--no-save-reg",
                        "--nearest"])
-        self.execute(xfm_cmds, self.out_template)
+        self.execute(xfm_cmds, self.out_template, self._subject_args())
 
+    @_skip_current
     def from_statistical_file(self, stat_file_temp, thresh):
         """Create a mask by binarizing an epi-space fixed effects zstat map."""
-        bin_cmds = []
+        bin_args = []
         for subj in self.subject_list:
             args = dict(subj=subj)
-            cmd = ["fslmaths",
-                   stat_file_temp % args,
-                   "-thr", thresh,
-                   "-bin",
-                   self.out_template % args]
-            bin_cmds.append(cmd)
-
-        self.execute(bin_cmds, self.out_template)
-
-    def write_png(self):
-        """Write a mosiac png showing the masked voxels."""
-        overlay_temp = op.join(self.temp_dir, "%(subj)s_overlay.nii.gz")
-        slices_temp = op.join(self.data_dir, "%(subj)s/masks",
-                              self.roi_name + ".png")
-
-        overlay_cmds = []
+            bin_args.append((stat_file_temp % args, thresh,
+                             self.out_template % args))
+
+        masks = self.execute_local(threshold_image, bin_args,
+                                   self.out_template)
+        for subj, mask in zip(self.subject_list, masks):
+            self.add_stats(subj, self.roi_name, mask)
+
+    def from_roi_table(self, rois, label_volume=False):
+        """Create masks for a batch of ROIs in one pass.
+
+        Each subject is taken through every ROI in one job, and the jobs
+        for all subjects share one execution queue. Index volumes are
+        brought into functional space once per subject and atlas, and
+        then binarized for each region in-process.
+
+        Parameters
+        ----------
+        rois : list of dicts or filename
+            ROI specifications, see :func:`read_roi_table`.
+        label_volume : bool, optional
+            If True, also write an integer volume named for the factory's
+            roi_name, where each voxel holds the 1-based row of the ROI
+            that contains it (earlier rows win where ROIs overlap), and a
+            text file listing the ROI for each value.
+
+        """
+        if isinstance(rois, basestring):
+            rois = read_roi_table(rois)
+
+        factories = self._stream(lambda factory:
+                                 factory._from_roi_table(rois, label_volume))
+        updated_rois = {}
+        for factory in factories:
+            updated_rois.update(factory.updated_rois)
+        self.updated_rois = updated_rois
+        self.updated_subjects = [subj for subj in self.subject_list
+                                 if updated_rois.get(subj)]
+
+    def _from_roi_table(self, rois, label_volume):
+        """Make the masks in an ROI table for the current subjects."""
+        native_label_temp = op.join(self.temp_dir, "%(roi)s.%(hemi)s."
+                                    "%(subj)s_native_label.label")
+        indiv_mask_temp = op.join(self.temp_dir,
+                                  "%(roi)s.%(hemi)s.%(subj)s_mask.nii.gz")
+        atlas_temp = op.join(self.temp_dir, "%(subj)s_atlas%(index)d.nii.gz")
+
+        # Fill in the specifications
+        specs, atlases = [], []
+        for roi in rois:
+            spec = dict(roi=roi["roi"], type=roi["type"])
+            source = roi["source"]
+            if "label" in roi["type"]:
+                if os.sep not in source:
+                    subj = ("fsaverage" if roi["type"] == "fsaverage_label"
+                            else "%(subj)s")
+                    source = op.join(self.data_dir, subj, "label",
+                                     "%(hemi)s." + source + ".label")
+                spec["hemis"] = [roi["hemi"]] if roi["hemi"] else ["lh", "rh"]
+                spec["proj"] = projection_samples.get(roi["param"],
+                                                      roi["param"].split())
+            elif roi["type"] == "index_volume":
+                if source == "aseg":
+                    source = op.join(self.data_dir, "%(subj)s",
+                                     "mri", "aseg.mgz")
+                if source not in atlases:
+                    atlases.append(source)
+                spec["index"] = atlases.index(source)
+                spec["ids"] = [int(id) for id in roi["param"].split()]
+            elif roi["type"] == "stat_volume":
+                spec["thresh"] = float(roi["param"])
+            spec["source"] = source
+            specs.append(spec)
+        label_specs = [s for s in specs if "label" in s["type"]]
+
+        # Find the masks that are out of date
+        fingerprints, todo = {}, {}
         for subj in self.subject_list:
-            args = dict(subj=subj)
-            overlay_cmds.append(
-                          ["overlay", "1", "0",
-                           self.epi_template % args, "-a",
-                           self.out_template % args, "0.6", "2",
-                           overlay_temp % args])
-        self.execute(overlay_cmds, overlay_temp)
-
-        slicer_cmds = []
+            todo[subj] = []
+            for spec in specs:
+                params = dict((k, v) for k, v in spec.items() if k != "index")
+                fingerprint = self._mask_fingerprint(subj, [spec["source"]],
+                                                     params)
+                fingerprints[subj, spec["roi"]] = fingerprint
+                if not self.mask_is_current(subj, spec["roi"],
+                                            fingerprint[0]):
+                    todo[subj].append(spec["roi"])
+        self.updated_rois = todo
+        self.updated_subjects = [subj for subj in self.subject_list
+                                 if todo[subj]]
+
+        # Warp common space labels and resample atlases into epi space
+        cmds, outs, cmd_args = [], [], []
         for subj in self.subject_list:
-            args = dict(subj=subj)
-            slicer_cmds.append(
-                          ["slicer",
-                           overlay_temp % args,
-                           "-A", "750",
-                           slices_temp % args])
-        self.execute(slicer_cmds, slices_temp)
-
-    def execute(self, cmd_list, out_temp):
+            for index, atlas in enumerate(atlases):
+                if not [s for s in specs if s.get("index") == index
+                        and s["roi"] in todo[subj]]:
+                    continue
+                args = dict(subj=subj, index=index, atlas=op.basename(atlas))
+                cmds.append(["mri_vol2vol",
+                             "--mov", self.epi_template % args,
+                             "--targ", atlas % args,
+                             "--inv",
+                             "--o", atlas_temp % args,
+                             "--reg", self.reg_template % args,
+                             "--no-save-reg",
+                             "--nearest"])
+                outs.append(atlas_temp)
+                cmd_args.append(args)
+            for spec in label_specs:
+                if (spec["type"] != "fsaverage_label"
+                        or spec["roi"] not in todo[subj]):
+                    continue
+                for hemi in spec["hemis"]:
+                    args = dict(subj=subj, hemi=hemi, roi=spec["roi"])
+                    cmds.append(["mri_label2label",
+                                 "--srcsubject", "fsaverage",
+                                 "--trgsubject", subj,
+                                 "--hemi", hemi,
+                                 "--srclabel", spec["source"] % args,
+                                 "--trglabel", native_label_temp % args,
+                                 "--regmethod", "surface"])
+                    outs.append(native_label_temp)
+                    cmd_args.append(args)
+        if cmds:
+            self.execute(cmds, outs, cmd_args)
+
+        # Project all labels into epi space
+        cmds, cmd_args = [], []
+        for subj in self.subject_list:
+            for spec in label_specs:
+                if (spec["roi"] not in todo[subj]
+                        or self._project_natively(spec["proj"])):
+                    continue
+                for hemi in spec["hemis"]:
+                    args = dict(subj=subj, hemi=hemi, roi=spec["roi"])
+                    label_temp = (native_label_temp
+                                  if spec["type"] == "fsaverage_label"
+                                  else spec["source"])
+                    cmds.append(["mri_label2vol",
+                                 "--label", label_temp % args,
+                                 "--temp", self.epi_template % args,
+                                 "--reg", self.reg_template % args,
+                                 "--hemi", hemi,
+                                 "--subject", subj,
+                                 "--o", indiv_mask_temp % args,
+                                 "--proj"] + list(spec["proj"]))
+                    cmd_args.append(args)
+        if cmds:
+            self.execute(cmds, indiv_mask_temp, cmd_args)
+
+        # Write the masks for each subject in-process
+        subjects = [subj for subj in self.subject_list
+                    if todo[subj] or label_volume
+                    and not op.exists(self.out_template % dict(subj=subj))]
+        func_args = [(subj, specs, todo[subj], native_label_temp,
+                      indiv_mask_temp, atlas_temp, label_volume)
+                     for subj in subjects]
+        run_functions(self._write_roi_masks, func_args,
+                      self._subject_args(subjects), self.n_procs)
+        check_args = [dict(subj=subj, roi=roi)
+                      for subj in self.subject_list for roi in todo[subj]]
+        self.check_exists(self.mask_template, check_args)
+
+        for subj in self.subject_list:
+            for roi in todo[subj]:
+                self.record_mask(subj, roi, *fingerprints[subj, roi])
+
+    def _write_roi_masks(self, subj, specs, todo, native_label_temp,
+                         indiv_mask_temp, atlas_temp, label_volume):
+        """Combine the epi space images for one subject into masks."""
+        epi_img = nib.load(self.epi_template % dict(subj=subj))
+        labels = np.zeros(epi_img.shape[:3], np.int16)
+        func_mask = self._load_func_mask(subj)
+        atlas_data = {}
+        for value, spec in enumerate(specs, 1):
+            args = dict(subj=subj, roi=spec["roi"])
+            if spec["roi"] not in todo:
+                # Current masks only matter for the label volume
+                if label_volume:
+                    mask_img = nib.load(self.mask_template % args)
+                    labels[(labels == 0) & (mask_img.get_data() > 0)] = value
+                continue
+            native = ("label" in spec["type"]
+                      and self._project_natively(spec["proj"]))
+            if native:
+                label_temp = (native_label_temp
+                              if spec["type"] == "fsaverage_label"
+                              else spec["source"])
+                label_temp = label_temp.replace("%(roi)s", spec["roi"])
+                mask, _ = self._project_labels(subj, label_temp,
+                                               spec["hemis"], spec["proj"])
+            elif "label" in spec["type"]:
+                mask = np.zeros(labels.shape, bool)
+                for hemi in spec["hemis"]:
+                    args["hemi"] = hemi
+                    hemi_img = nib.load(indiv_mask_temp % args)
+                    mask |= hemi_img.get_data().reshape(mask.shape) > 0
+            elif spec["type"] == "index_volume":
+                index = spec["index"]
+                if index not in atlas_data:
+                    atlas_file = atlas_temp % dict(subj=subj, index=index)
+                    atlas_data[index] = nib.load(atlas_file).get_data()
+                mask = np.isin(atlas_data[index], spec["ids"])
+            else:
+                stat_data = nib.load(spec["source"] % args).get_data()
+                mask = (stat_data >= spec["thresh"]) & (stat_data != 0)
+            _save_mask(mask, epi_img, self.mask_template % args)
+            self.stats.add(subj, spec["roi"], mask,
+                           epi_img.get_header().get_zooms(), func_mask)
+            labels[(labels == 0) & mask] = value
+
+        if label_volume:
+            out_file = self.out_template % dict(subj=subj)
+            hdr = epi_img.get_header().copy()
+            hdr.set_data_dtype(np.int16)
+            nib.save(nib.Nifti1Image(labels, epi_img.get_affine(), hdr),
+                     out_file)
+            with open(out_file.replace(".nii.gz", ".txt"), "w") as fid:
+                for value, spec in enumerate(specs, 1):
+                    fid.write("%d\t%s\n" % (value, spec["roi"]))
+
+    def write_png(self, rois=None, sheet_dir=None):
+        """Write a mosiac png showing the masked voxels.
+
+        Mosaics are drawn in-process for the subjects whose mask was
+        just made (or whose png is missing), in parallel across subjects.
+
+        Parameters
+        ----------
+        rois : list of strings, optional
+            Masks to draw; defaults to the factory's roi_name.
+        sheet_dir : string, optional
+            If given, also write ``<roi>.png`` in this directory with the
+            mosaics of every subject on one contact sheet.
+
+        """
+        if rois is None:
+            rois = [self.roi_name]
+        png_temp = self.mask_template.replace(".nii.gz", ".png")
+
+        func_args, png_args = [], []
+        for roi in rois:
+            for subj in self.subject_list:
+                args = dict(subj=subj, roi=roi)
+                if self.updated_rois:
+                    updated = roi in self.updated_rois.get(subj, [])
+                else:
+                    updated = subj in self.updated_subjects
+                if updated or not op.exists(png_temp % args):
+                    func_args.append((self.epi_template % args,
+                                      self.mask_template % args,
+                                      png_temp % args))
+                    png_args.append(args)
+        if func_args:
+            run_functions(write_mask_png, func_args, png_args, self.n_procs)
+            self.check_exists(png_temp, png_args)
+
+        if sheet_dir is not None:
+            try:
+                os.makedirs(sheet_dir)
+            except OSError:
+                pass
+            for roi in rois:
+                png_files = [png_temp % dict(subj=subj, roi=roi)
+                             for subj in self.subject_list]
+                write_contact_sheet(png_files, self.subject_list,
+                                    op.join(sheet_dir, roi + ".png"))
+
+    def _subject_args(self, subjects=None):
+        """Command labels for steps that run once per subject."""
+        if subjects is None:
+            subjects = self.subject_list
+        return [dict(subj=subj) for subj in subjects]
+
+    def execute(self, cmd_list, out_temp, cmd_args=None):
         """Exceute a list of commands and verify output file existence."""
-        res = self.map(check_output, cmd_list)
         if self.parallel:
+            res = self.dv.map_async(check_output, cmd_list)
             if self.debug:
                 res.wait_interactive()
             else:
                 res.wait()
-        if self.parallel:
             if not res.successful():
                 raise RuntimeError(res.pyerr)
         else:
-            self.check_exists(out_temp)
+            run_commands(cmd_list, cmd_args, self.n_procs, self.timeout)
+            self.check_exists(out_temp, cmd_args)
 
-    def check_exists(self, fpath_temp):
-        """Ensure that output files exist on disk."""
-        fail_list = []
-        for hemi in ["lh", "rh"]:
+    def execute_local(self, func, func_args, out_temp):
+        """Run an in-process step for each subject and verify its output."""
+        results = run_functions(func, func_args, self._subject_args(),
+                                self.n_procs)
+        self.check_exists(out_temp, self._subject_args())
+        return results
+
+    def _load_func_mask(self, subj):
+        """Load the functional brain mask for a subject, if it exists."""
+        fname = self.func_mask_template % dict(subj=subj)
+        if op.exists(fname):
+            return nib.load(fname).get_data().astype(bool)
+
+    def add_stats(self, subj, roi, mask=None, header=None):
+        """Add the statistics for a mask, loading what isn't given."""
+        mask_file = self.mask_template % dict(subj=subj, roi=roi)
+        if mask is None or header is None:
+            mask_img = nib.load(mask_file)
+            header = mask_img.get_header()
+            if mask is None:
+                mask = mask_img.get_data() > 0
+        self.stats.add(subj, roi, mask, header.get_zooms(),
+                       self._load_func_mask(subj))
+
+    def mni_overlap(self, rois=None, prob_dir=None):
+        """Compare each roi across subjects after warping masks to MNI.
+
+        Masks are warped with the func2anat affine and the anatomical
+        warpfield, as in the mni registration. Each subject's mean Dice
+        coefficient with the other subjects is added to the statistics.
+
+        Parameters
+        ----------
+        rois : list of strings, optional
+            Masks to compare; defaults to the factory's roi_name.
+        prob_dir : string, optional
+            If given, write ``<roi>_mni_prob.nii.gz`` here, with the
+            fraction of subjects including each voxel.
+
+        """
+        if rois is None:
+            rois = [self.roi_name]
+        target = op.join(os.environ["FSLDIR"], "data", "standard",
+                         "avg152T1_brain.nii.gz")
+        xfm_temp = op.join(self.anal_dir, self.experiment, "%(subj)s",
+                           "preproc/run_1/func2anat_flirt.mat")
+        warp_temp = op.join(self.data_dir, "%(subj)s",
+                            "normalization/warpfield.nii.gz")
+        mni_temp = op.join(self.temp_dir, "%(roi)s.%(subj)s_mni.nii.gz")
+
+        cmds, cmd_args = [], []
+        for roi in rois:
             for subj in self.subject_list:
-                args = dict(hemi=hemi, subj=subj)
-                f_want = fpath_temp % args
-                if not op.exists(f_want):
-                    fail_list.append(f_want)
+                args = dict(subj=subj, roi=roi)
+                cmds.append(["applywarp",
+                             "-i", self.mask_template % args,
+                             "-r", target,
+                             "-w", warp_temp % args,
+                             "--premat=%s" % (xfm_temp % args),
+                             "-o", mni_temp % args,
+                             "--interp=nn"])
+                cmd_args.append(args)
+        self.execute(cmds, mni_temp, cmd_args)
+
+        target_img = nib.load(target)
+        for roi in rois:
+            masks = [nib.load(mni_temp % dict(subj=subj, roi=roi))
+                     .get_data().ravel() > 0 for subj in self.subject_list]
+            prob = self.stats.add_mni_overlap(roi, self.subject_list, masks)
+            if prob_dir is not None:
+                prob_img = nib.Nifti1Image(prob.reshape(target_img.shape),
+                                           target_img.get_affine())
+                nib.save(prob_img, op.join(prob_dir, roi + "_mni_prob.nii.gz"))
+
+    def write_stats(self, fname, rois=None):
+        """Write the mask statistics for the batch to a csv file.
+
+        Masks that were current, and so not made in this run, are
+        loaded to fill in their rows.
+
+        """
+        if rois is None:
+            rois = [self.roi_name]
+        for roi in rois:
+            for subj in self.subject_list:
+                row = self.stats.rows.get((subj, roi))
+                if row is None or np.isnan(row["voxels"]):
+                    self.add_stats(subj, roi)
+        self.stats.write(fname)
+
+    def check_exists(self, fpath_temp, cmd_args=None):
+        """Ensure that output files exist on disk.
+
+        The template (or list of templates, one per command) is filled
+        with the arguments of each command, or with every subject and
+        hemisphere if those are not given.
+
+        """
+        if cmd_args is None:
+            cmd_args = [dict(hemi=hemi, subj=subj)
+                        for hemi in ["lh", "rh"]
+                        for subj in self.subject_list]
+        if isinstance(fpath_temp, basestring):
+            fpath_temp = [fpath_temp] * len(cmd_args)
+        fail_list = []
+        for temp, args in zip(fpath_temp, cmd_args):
+            f_want = temp % args
+            if not op.exists(f_want) and f_want not in fail_list:
+                fail_list.append(f_want)
         if fail_list:
-            print "Failed to write files:"
-            print "\n".join(fail_list)
-            raise RuntimeError
+            raise RuntimeError("Failed to write files:\n"
+                               + "\n".join(fail_list))
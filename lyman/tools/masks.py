@@ -0,0 +1,425 @@
+"""Index and cache the masks in the lyman data hierarchy.
+
+Masks live at ``<data_dir>/<subj>/masks/<name>.nii.gz``. Group analyses
+load the same mask for every subject, often many times in a session, and
+each load decodes the whole compressed volume only to keep the voxels
+inside it. A MaskRegistry indexes which masks exist for which subjects,
+keeps the voxel count of each mask in an index file next to the data,
+and holds recently used masks in memory as Mask objects. Each lookup
+still checks the size and modification time of the mask file, so a
+remade mask is always noticed; only the decoding is saved.
+
+A Mask stores the sorted flat indices of its voxels rather than a full
+boolean volume, so it is small to keep and to send to other processes,
+and it can pull the voxels out of (or put values back into) any array
+whose leading dimensions match the mask.
+
+"""
+import os
+import os.path as op
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from tempfile import mkstemp
+
+import numpy as np
+
+from .provenance import _file_stats
+
+mask_ext = ".nii.gz"
+index_fname = ".mask_index.json"
+
+
+class Mask(object):
+    """A set of voxels held as sorted flat indices into a volume.
+
+    Indices refer to the C-order raveled volume, so gathering with a
+    Mask returns voxels in the same order as indexing with the
+    equivalent boolean array.
+
+    Parameters
+    ----------
+    indices : array of ints
+        Flat voxel indices; they are sorted and deduplicated.
+    shape : sequence of 3 ints
+        Shape of the volume the mask lives in.
+    affine : 4 x 4 array, optional
+        Voxel to world transform of that volume.
+    name : string, optional
+        Name of the mask in the data hierarchy.
+
+    """
+    def __init__(self, indices, shape, affine=None, name=None):
+        self.indices = np.unique(indices).astype(np.int32)
+        self.shape = tuple(int(n) for n in shape)
+        self.affine = affine
+        self.name = name
+
+    @classmethod
+    def from_array(cls, data, affine=None, name=None):
+        """Make a Mask from the nonzero voxels of a 3D array."""
+        data = np.asarray(data)
+        return cls(np.flatnonzero(data), data.shape, affine, name)
+
+    @classmethod
+    def from_file(cls, fname, name=None):
+        """Read a Mask from a NIfTI image or a file written by save()."""
+        if fname.endswith(".npz"):
+            with np.load(fname) as mask_obj:
+                affine = mask_obj["affine"]
+                return cls(mask_obj["indices"], mask_obj["shape"],
+                           affine if affine.shape else None, name)
+        import nibabel as nib
+        img = nib.load(fname)
+        shape = img.shape[:3]
+        return cls.from_array(img.get_data().reshape(shape),
+                              img.get_affine(), name)
+
+    def save(self, fname):
+        """Write the indices, shape, and affine to an npz file."""
+        affine = np.nan if self.affine is None else self.affine
+        np.savez(fname, indices=self.indices, shape=self.shape,
+                 affine=affine)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __repr__(self):
+        return "<Mask %s: %d voxels in %s>" % (self.name, len(self),
+                                               "x".join(map(str, self.shape)))
+
+    @property
+    def coords(self):
+        """Tuple of index arrays for the voxels, one per dimension."""
+        return np.unravel_index(self.indices, self.shape)
+
+    def digest(self):
+        """Return a hash of the voxels and shape, for cache keys."""
+        hasher = hashlib.sha1()
+        hasher.update(str(self.shape))
+        hasher.update(self.indices.data)
+        return hasher.hexdigest()
+
+    def to_array(self):
+        """Return the mask as a boolean volume."""
+        data = np.zeros(self.shape, bool)
+        data.flat[self.indices] = True
+        return data
+
+    def to_image(self, dtype=np.uint8):
+        """Return the mask as a NIfTI image."""
+        import nibabel as nib
+        affine = np.eye(4) if self.affine is None else self.affine
+        return nib.Nifti1Image(self.to_array().astype(dtype), affine)
+
+    def gather(self, data):
+        """Pull the mask voxels out of an array.
+
+        Parameters
+        ----------
+        data : array
+            Its first three dimensions must match the mask shape.
+
+        Returns
+        -------
+        values : n_voxels x ... array
+
+        """
+        if data.shape[:3] != self.shape:
+            raise ValueError("Data shape %s does not match mask shape %s"
+                             % (data.shape[:3], self.shape))
+        return data[self.coords]
+
+    def scatter(self, values, fill=0):
+        """Put values for the mask voxels back into a volume.
+
+        Parameters
+        ----------
+        values : n_voxels x ... array
+        fill : scalar, optional
+            Value for voxels outside the mask.
+
+        Returns
+        -------
+        data : array
+            Mask shape followed by the trailing dimensions of ``values``.
+
+        """
+        values = np.asarray(values)
+        if len(values) != len(self):
+            raise ValueError("Got %d values for a mask with %d voxels"
+                             % (len(values), len(self)))
+        data = np.empty(self.shape + values.shape[1:], values.dtype)
+        data.fill(fill)
+        data[self.coords] = values
+        return data
+
+    def _check_compatible(self, other):
+        if self.shape != other.shape:
+            raise ValueError("Masks with shapes %s and %s are not "
+                             "compatible" % (self.shape, other.shape))
+
+    def union(self, other):
+        """Return a Mask of the voxels in either mask."""
+        self._check_compatible(other)
+        return Mask(np.union1d(self.indices, other.indices),
+                    self.shape, self.affine)
+
+    def intersection(self, other):
+        """Return a Mask of the voxels in both masks."""
+        self._check_compatible(other)
+        return Mask(np.intersect1d(self.indices, other.indices, True),
+                    self.shape, self.affine)
+
+    def difference(self, other):
+        """Return a Mask of the voxels in this mask but not the other."""
+        self._check_compatible(other)
+        return Mask(np.setdiff1d(self.indices, other.indices, True),
+                    self.shape, self.affine)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def __eq__(self, other):
+        return (isinstance(other, Mask) and self.shape == other.shape
+                and np.array_equal(self.indices, other.indices))
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def as_mask(mask, affine=None):
+    """Return a Mask for a Mask or a boolean volume.
+
+    Raises
+    ------
+    ValueError
+        If ``mask`` is an array that is not boolean.
+
+    """
+    if isinstance(mask, Mask):
+        return mask
+    mask = np.asarray(mask)
+    if mask.dtype != np.bool:
+        raise ValueError("Mask must be boolean array")
+    return Mask.from_array(mask, affine)
+
+
+class MaskRegistry(object):
+    """Searchable index of subject masks with a lazy, cached loader.
+
+    Parameters
+    ----------
+    data_dir : string
+        Root of the data hierarchy.
+    cache_size : int, optional
+        Number of masks to keep in memory; the least recently used mask
+        is dropped first.
+    index_file : string or None, optional
+        Where voxel counts are kept between sessions. Defaults to a file
+        in ``data_dir``; pass None to keep the index in memory only.
+
+    """
+    def __init__(self, data_dir, cache_size=64, index_file="default"):
+        self.data_dir = data_dir
+        self.cache_size = cache_size
+        if index_file == "default":
+            index_file = op.join(data_dir, index_fname)
+        self.index_file = index_file
+
+        self._files = {}
+        self._counts = self._read_index()
+        self._dirty = False
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _read_index(self):
+        if self.index_file is None:
+            return {}
+        try:
+            with open(self.index_file) as fid:
+                return json.load(fid)
+        except (IOError, ValueError):
+            return {}
+
+    def flush(self):
+        """Write the voxel counts found since the last write."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            counts = dict(self._counts)
+        if self.index_file is None:
+            return
+        try:
+            fd, tmp_fname = mkstemp(dir=op.dirname(self.index_file))
+            with os.fdopen(fd, "w") as fid:
+                json.dump(counts, fid, sort_keys=True, indent=2)
+            os.rename(tmp_fname, self.index_file)
+        except (IOError, OSError):
+            # A read-only data directory just means no persistent counts
+            pass
+
+    def mask_file(self, subj, name):
+        """Return the path where a subject's mask would live."""
+        return op.join(self.data_dir, subj, "masks", name + mask_ext)
+
+    def refresh(self, subjects=None):
+        """Rescan the masks directories of some or all subjects."""
+        if subjects is None:
+            subjects = [s for s in sorted(os.listdir(self.data_dir))
+                        if op.isdir(op.join(self.data_dir, s, "masks"))]
+        for subj in subjects:
+            mask_dir = op.join(self.data_dir, subj, "masks")
+            try:
+                fnames = [op.join(mask_dir, f) for f in os.listdir(mask_dir)
+                          if f.endswith(mask_ext)]
+            except OSError:
+                fnames = []
+            stats = _file_stats(fnames)
+            self._files[subj] = dict((op.basename(f)[:-len(mask_ext)], stat)
+                                     for f, stat in stats.items())
+
+    def _subject_files(self, subj):
+        if subj not in self._files:
+            self.refresh([subj])
+        return self._files[subj]
+
+    def stat(self, subj, name):
+        """Return the current [size, mtime] of a mask file.
+
+        Raises
+        ------
+        IOError
+            If the subject has no mask with this name.
+
+        """
+        fname = self.mask_file(subj, name)
+        stat = _file_stats([fname]).get(fname)
+        if stat is None:
+            self._files.get(subj, {}).pop(name, None)
+            raise IOError("No mask named '%s' for subject %s (%s)"
+                          % (name, subj, fname))
+        if subj in self._files:
+            self._files[subj][name] = stat
+        return stat
+
+    def mtime(self, subj, name):
+        """Return the modification time of a mask."""
+        return self.stat(subj, name)[1]
+
+    def names(self, subjects=None):
+        """Return the sorted mask names present for any of the subjects."""
+        if subjects is None:
+            if not self._files:
+                self.refresh()
+            subjects = self._files
+        names = set()
+        for subj in subjects:
+            names.update(self._subject_files(subj))
+        return sorted(names)
+
+    def subjects(self, name):
+        """Return the indexed subjects that have a mask."""
+        if not self._files:
+            self.refresh()
+        return sorted(s for s, files in self._files.items() if name in files)
+
+    def query(self, name, subjects):
+        """Split a group of subjects by whether they have a mask.
+
+        The subjects' masks directories are rescanned, so the answer
+        reflects the filesystem at the time of the call.
+
+        Returns
+        -------
+        found, missing : lists of strings
+            Subjects with and without the mask, in the order given.
+
+        """
+        self.refresh(subjects)
+        found = [s for s in subjects if name in self._files[s]]
+        missing = [s for s in subjects if name not in self._files[s]]
+        return found, missing
+
+    def require(self, name, subjects):
+        """Raise an IOError naming every subject without a mask."""
+        found, missing = self.query(name, subjects)
+        if missing:
+            raise IOError("No mask named '%s' for subjects: %s"
+                          % (name, ", ".join(missing)))
+        return found
+
+    def get(self, subj, name):
+        """Return a subject's mask as a Mask object.
+
+        Voxel counts of newly loaded masks are kept in memory until
+        flush() is called, so a group load writes the index file once.
+
+        """
+        stat = self.stat(subj, name)
+        key = subj, name
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] == stat:
+                self._cache[key] = self._cache.pop(key)
+                return entry[1]
+
+        mask = Mask.from_file(self.mask_file(subj, name), name)
+
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = stat, mask
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            count_key = "%s/%s" % key
+            if self._counts.get(count_key) != stat + [len(mask)]:
+                self._counts[count_key] = stat + [len(mask)]
+                self._dirty = True
+        return mask
+
+    def load(self, subj, name):
+        """Return a mask as a boolean volume."""
+        return self.get(subj, name).to_array()
+
+    def voxel_count(self, subj, name):
+        """Return the number of voxels in a mask.
+
+        Counts recorded in the index file are used while the mask is
+        unchanged; otherwise the mask is loaded to count it.
+
+        """
+        stat = self.stat(subj, name)
+        entry = self._counts.get("%s/%s" % (subj, name))
+        if entry is not None and entry[:2] == stat:
+            return entry[2]
+        return len(self.get(subj, name))
+
+    def counts(self, name, subjects=None):
+        """Map each subject with a mask to its voxel count."""
+        if subjects is None:
+            subjects = self.subjects(name)
+        else:
+            subjects, _ = self.query(name, subjects)
+        counts = dict((s, self.voxel_count(s, name)) for s in subjects)
+        self.flush()
+        return counts
+
+    def clear(self):
+        """Drop the cached masks and the file index."""
+        with self._lock:
+            self._cache.clear()
+        self._files = {}
+
+
+_registries = {}
+
+
+def get_registry(data_dir):
+    """Return the shared registry for a data directory."""
+    data_dir = op.abspath(data_dir)
+    if data_dir not in _registries:
+        _registries[data_dir] = MaskRegistry(data_dir)
+    return _registries[data_dir]
@@ -0,0 +1,336 @@
+"""Record where the time goes when lyman workflows execute.
+
+A WorkflowProfiler is attached to a workflow run through the plugin
+status callback. It records wall time and the size of the input and
+output files for every node and for each MapNode iteration the plugin
+submits separately (the Linear plugin runs them inside the MapNode,
+so they are profiled together). CPU time and peak
+memory are recorded when the nodes run in a process the profiler can
+measure: either in-process with the Linear plugin, or in the worker
+processes of the lyman MultiProc plugin. Peak memory is sampled while
+each node runs (see MemorySampler), because the getrusage high-water
+mark covers the whole life of a process and would charge every node
+with the largest one that ran before it. The profile is written as a
+CSV table with one row per node, plus a JSON summary that includes the
+critical path through the execution graph.
+
+"""
+import os
+import os.path as op
+import csv
+import json
+import time
+import resource
+import threading
+
+import numpy as np
+import networkx as nx
+
+profile_columns = ["node", "interface", "status", "start", "end",
+                   "wall_time", "cpu_time", "peak_rss_mb",
+                   "input_mb", "output_mb", "directory"]
+
+
+def _cpu_time():
+    """Return CPU seconds used by this process and its children."""
+    usage = [resource.getrusage(who) for who in
+             (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def _rss_mb(pid):
+    """Return the resident memory of a process in MB, or 0 if it is gone."""
+    try:
+        with open("/proc/%d/statm" % pid) as fid:
+            pages = int(fid.read().split()[1])
+    except (IOError, ValueError, IndexError):
+        return 0.
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024. ** 2
+
+
+def _descendants(pid):
+    """Return the pids of all processes below a process."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as fid:
+                stat = fid.read()
+        except IOError:
+            continue
+        # The command name can contain spaces, so split after it
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    found, todo = [], [pid]
+    while todo:
+        below = children.get(todo.pop(), [])
+        found.extend(below)
+        todo.extend(below)
+    return found
+
+
+class MemorySampler(object):
+    """Measure the peak memory used while a node runs.
+
+    A thread periodically adds up the resident memory of this process and
+    of the processes started below it since sampling began (the commands
+    a node runs). This process is counted relative to its size when
+    sampling started, so memory a worker inherited when it was forked, or
+    that the parent held before the node ran, is not charged to the node.
+    Commands that start and finish between two samples are missed, so the
+    peak is a lower bound. Without ``/proc`` the peak is NaN.
+
+    Parameters
+    ----------
+    interval : float, optional
+        Seconds between samples.
+
+    """
+    def __init__(self, interval=.1):
+        self.interval = interval
+        self.peak = np.nan
+        self._thread = None
+
+    def start(self):
+        """Start sampling and return the sampler."""
+        if not op.isdir("/proc"):
+            return self
+        self._pid = os.getpid()
+        self._base = _rss_mb(self._pid)
+        self._existing = set(_descendants(self._pid))
+        self.peak = 0.
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        rss = _rss_mb(self._pid) - self._base
+        rss += sum(_rss_mb(pid) for pid in _descendants(self._pid)
+                   if pid not in self._existing)
+        self.peak = max(self.peak, rss)
+
+    def _run(self):
+        while not self._done.is_set():
+            self._sample()
+            self._done.wait(self.interval)
+
+    def stop(self):
+        """Stop sampling and return the peak memory in MB."""
+        if self._thread is not None:
+            self._done.set()
+            self._thread.join()
+            self._thread = None
+            self._sample()
+        return self.peak
+
+
+def run_node_profiled(node, updatehash):
+    """Run a node in a worker process and measure its resource usage.
+
+    This mirrors the MultiProc worker function, adding a ``usage`` entry
+    to the result dictionary.
+
+    """
+    from nipype.pipeline.plugins.multiproc import run_node
+    start_cpu = _cpu_time()
+    sampler = MemorySampler().start()
+    try:
+        result = run_node(node, updatehash)
+    finally:
+        peak_rss = sampler.stop()
+    result["usage"] = dict(cpu_time=_cpu_time() - start_cpu,
+                           peak_rss_mb=peak_rss)
+    return result
+
+
+def _file_megabytes(value):
+    """Total size in MB of the existing files named in a trait value."""
+    if isinstance(value, (list, tuple)):
+        return sum(_file_megabytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_file_megabytes(v) for v in value.values())
+    if isinstance(value, basestring) and op.isfile(value):
+        return op.getsize(value) / 1024. ** 2
+    return 0.
+
+
+class WorkflowProfiler(object):
+    """Collect per-node timing and resource records for a workflow run.
+
+    The profiler is itself the status callback for the plugin arguments.
+
+    Parameters
+    ----------
+    in_process : bool, optional
+        If True, nodes execute in this process one at a time (Linear
+        plugin), so CPU time and peak memory can be measured around
+        each node from the status callback.
+
+    """
+    def __init__(self, in_process=False):
+        self.in_process = in_process
+        self.records = {}
+        self._start_usage = {}
+        self._samplers = {}
+
+    def __call__(self, node, status):
+        self.status_callback(node, status)
+
+    def __getstate__(self):
+        # Executed MapNodes carry the plugin arguments, so a copy of the
+        # profiler travels with every node sent to a worker; keep it light
+        return dict(in_process=self.in_process, records={}, _start_usage={},
+                    _samplers={})
+
+    def _record(self, node):
+        key = node.output_dir()
+        if key not in self.records:
+            self.records[key] = dict(node=node.fullname,
+                                     interface=type(node._interface).__name__,
+                                     status="pending",
+                                     start=np.nan, end=np.nan,
+                                     wall_time=np.nan, cpu_time=np.nan,
+                                     peak_rss_mb=np.nan,
+                                     input_mb=np.nan, output_mb=np.nan,
+                                     directory=key)
+        return self.records[key]
+
+    def status_callback(self, node, status):
+        """Update the record for a node when the plugin reports on it."""
+        record = self._record(node)
+        now = time.time()
+
+        if status == "start":
+            record["start"] = now
+            record["status"] = "running"
+            if self.in_process:
+                self._start_usage[record["directory"]] = _cpu_time()
+                self._samplers[record["directory"]] = MemorySampler().start()
+            return
+
+        record["end"] = now
+        record["wall_time"] = now - record["start"]
+        record["status"] = "ok" if status == "end" else "crashed"
+
+        if self.in_process and record["directory"] in self._start_usage:
+            start_cpu = self._start_usage.pop(record["directory"])
+            record["cpu_time"] = _cpu_time() - start_cpu
+            sampler = self._samplers.pop(record["directory"])
+            record["peak_rss_mb"] = sampler.stop()
+
+        record["input_mb"] = _file_megabytes(node.inputs.get())
+        if status == "end":
+            try:
+                outputs = node.result.outputs
+                if outputs is not None:
+                    record["output_mb"] = _file_megabytes(outputs.get())
+            except Exception:
+                pass
+
+    def add_usage(self, directory, usage):
+        """Attach CPU time and peak RSS measured in a worker process."""
+        record = self.records.setdefault(directory, dict(directory=directory))
+        record.update(usage)
+
+    def _node_times(self, graph):
+        """Map each graph node to its start, end, and busy time."""
+        times = {}
+        for node in graph.nodes():
+            node_dir = node.output_dir()
+            records = [r for d, r in self.records.items()
+                       if d == node_dir
+                       or d.startswith(op.join(node_dir, "mapflow") + os.sep)]
+            starts = [r.get("start", np.nan) for r in records]
+            ends = [r.get("end", np.nan) for r in records]
+            if records and not np.all(np.isnan(starts + ends)):
+                start, end = np.nanmin(starts), np.nanmax(ends)
+                times[node] = (start, end, end - start)
+            else:
+                times[node] = (np.nan, np.nan, 0.)
+        return times
+
+    def critical_path(self, graph):
+        """Find the chain of dependent nodes with the largest total time.
+
+        Parameters
+        ----------
+        graph : networkx DiGraph
+            Execution graph returned by ``Workflow.run()``.
+
+        Returns
+        -------
+        path : list of (fullname, seconds) tuples
+        total : float
+            Seconds spent along the path.
+
+        """
+        times = self._node_times(graph)
+        best = {}
+        for node in nx.topological_sort(graph):
+            preds = [best[p] for p in graph.predecessors(node)]
+            total, path = max(preds) if preds else (0., [])
+            busy = times[node][2]
+            best[node] = total + busy, path + [(node.fullname, busy)]
+        if not best:
+            return [], 0.
+        total, path = max(best.values())
+        return path, total
+
+    def summary(self, graph=None):
+        """Summarize the run overall and by interface."""
+        records = [r for r in self.records.values() if "node" in r]
+        starts = [r["start"] for r in records if not np.isnan(r["start"])]
+        ends = [r["end"] for r in records if not np.isnan(r["end"])]
+
+        by_interface = {}
+        for r in records:
+            entry = by_interface.setdefault(r["interface"],
+                                            dict(n_nodes=0, wall_time=0.,
+                                                 cpu_time=0., peak_rss_mb=0.))
+            entry["n_nodes"] += 1
+            entry["wall_time"] += np.nan_to_num(r["wall_time"])
+            entry["cpu_time"] += np.nan_to_num(r["cpu_time"])
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"],
+                                       np.nan_to_num(r["peak_rss_mb"]))
+
+        summary = dict(n_nodes=len(records),
+                       n_crashed=sum(r["status"] == "crashed"
+                                     for r in records),
+                       wall_time=max(ends) - min(starts) if ends else 0.,
+                       cpu_time=float(np.nansum([r["cpu_time"]
+                                                 for r in records])),
+                       by_interface=by_interface)
+
+        if graph is not None:
+            path, total = self.critical_path(graph)
+            summary["critical_path"] = [dict(node=n, seconds=s)
+                                        for n, s in path]
+            summary["critical_path_time"] = total
+
+        return summary
+
+    def write(self, fname_base, graph=None):
+        """Write the node table and run summary.
+
+        Returns
+        -------
+        csv_file, json_file : strings
+
+        """
+        records = sorted([r for r in self.records.values() if "node" in r],
+                         key=lambda r: r["start"])
+        csv_file = fname_base + ".csv"
+        with open(csv_file, "wb") as fid:
+            writer = csv.writer(fid)
+            writer.writerow(profile_columns)
+            for r in records:
+                writer.writerow([r[col] for col in profile_columns])
+
+        json_file = fname_base + ".json"
+        with open(json_file, "w") as fid:
+            json.dump(self.summary(graph), fid, sort_keys=True, indent=4)
+
+        return csv_file, json_file
@@ -0,0 +1,230 @@
+"""Persistent provenance records for incremental workflow execution.
+
+nipype decides whether a node needs to rerun from hashes kept in the
+working directory, so that knowledge is lost when the working directory
+is removed. The records kept here live with the analysis outputs. Each
+record notes, for one subject and one workflow, a fingerprint of the
+parameters and input files that produced the sunk outputs, along with the
+size and modification time of those outputs. A subject is current when
+its fingerprint is unchanged and its outputs have not been touched, and
+run_workflow can then leave that subject out of the run.
+
+"""
+import os
+import os.path as op
+import re
+import json
+import time
+import hashlib
+from glob import glob
+from fnmatch import fnmatch
+from tempfile import mkstemp
+
+
+class ProvenanceStore(object):
+    """Directory of per-subject provenance records for workflow stages.
+
+    Records are written to ``<store_dir>/<stage>/<subject>.json``, so
+    workflows running for different subjects never contend for a file.
+
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def _record_file(self, stage, subject):
+        return op.join(self.store_dir, stage, subject + ".json")
+
+    def load(self, stage, subject):
+        """Return the record for a subject, or None if there isn't one."""
+        try:
+            with open(self._record_file(stage, subject)) as fid:
+                return json.load(fid)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, stage, subject, record):
+        """Atomically write the record for a subject."""
+        fname = self._record_file(stage, subject)
+        try:
+            os.makedirs(op.dirname(fname))
+        except OSError:
+            pass
+        fd, tmp_fname = mkstemp(dir=op.dirname(fname))
+        with os.fdopen(fd, "w") as fid:
+            json.dump(record, fid, sort_keys=True, indent=2)
+        os.rename(tmp_fname, fname)
+
+    def stage(self, name, params, input_templates=(),
+              output_template=None, upstream=None, output_filter=None):
+        """Return a WorkflowStage that keeps its records in this store."""
+        return WorkflowStage(self, name, params, input_templates,
+                             output_template, upstream, output_filter)
+
+
+def _file_stats(fnames):
+    """Map each file to its size and modification time."""
+    stats = {}
+    for fname in fnames:
+        try:
+            st = os.stat(fname)
+        except OSError:
+            continue
+        stats[fname] = [st.st_size, st.st_mtime]
+    return stats
+
+
+def _subject_glob(template, subject):
+    """Fill a file template for one subject, leaving other fields as *.
+
+    Both positional (``%s``) and named (``%(subject_id)s``) templates are
+    accepted; named fields other than the subject become wildcards.
+
+    """
+    if "%(" in template:
+        template = re.sub(r"%\((?!subject_id\))\w+\)\w", "*", template)
+        return template % dict(subject_id=subject)
+    return template % subject
+
+
+def _walk_files(root):
+    """List all files below a directory."""
+    fnames = []
+    for dirpath, _, files in os.walk(root):
+        fnames.extend(op.join(dirpath, f) for f in files)
+    return sorted(fnames)
+
+
+class WorkflowStage(object):
+    """Track which subjects are current for one workflow.
+
+    An instance is also a plugin status callback. During a run it notes
+    the subjects whose DataSink finished and the subjects with a crashed
+    node, so only complete subjects are recorded afterwards.
+
+    Parameters
+    ----------
+    store : ProvenanceStore
+        Where the records are kept.
+    name : string
+        Identifier for the workflow stage, e.g. "exp/model/smoothed".
+    params : dict
+        Parameters that determine the outputs; anything json cannot
+        encode is fingerprinted through its repr.
+    input_templates : sequence of strings
+        Glob patterns for the input files, with a ``%s`` or
+        ``%(subject_id)s`` for the subject.
+    output_template : string
+        Directory holding the sunk outputs, with a ``%s`` for the subject.
+    upstream : string, optional
+        Name of the stage that produced this stage's inputs. Its record
+        becomes part of the fingerprint, so rerunning it invalidates this
+        stage too.
+    output_filter : (include, exclude) tuple, optional
+        Filename patterns (or None) selecting the files below the output
+        directory that belong to this stage, for stages that share an
+        output directory.
+
+    """
+    def __init__(self, store, name, params, input_templates=(),
+                 output_template=None, upstream=None, output_filter=None):
+        self.store = store
+        self.name = name
+        self.params = params
+        self.input_templates = list(input_templates)
+        self.output_template = output_template
+        self.upstream = upstream
+        self.output_filter = output_filter
+        self.sunk = set()
+        self.crashed = set()
+        self._fingerprints = {}
+
+    def fingerprint(self, subject):
+        """Hash the parameters, inputs and upstream record for a subject."""
+        hasher = hashlib.sha1()
+        hasher.update(json.dumps(self.params, sort_keys=True, default=repr))
+
+        input_files = []
+        for template in self.input_templates:
+            input_files.extend(sorted(glob(_subject_glob(template,
+                                                          subject))))
+        stats = _file_stats(input_files)
+        hasher.update(json.dumps(sorted(stats.items())))
+
+        if self.upstream is not None:
+            record = self.store.load(self.upstream, subject)
+            hasher.update(record["fingerprint"] if record else "none")
+
+        return hasher.hexdigest()
+
+    def outputs(self, subject):
+        """Return the current stats of the sunk outputs for a subject."""
+        if self.output_template is None:
+            return {}
+        fnames = _walk_files(self.output_template % subject)
+        if self.output_filter is not None:
+            include, exclude = self.output_filter
+            fnames = [f for f in fnames
+                      if (include is None or fnmatch(op.basename(f), include))
+                      and (exclude is None
+                           or not fnmatch(op.basename(f), exclude))]
+        return _file_stats(fnames)
+
+    def is_current(self, subject):
+        """True if the recorded outputs for a subject are up to date."""
+        record = self.store.load(self.name, subject)
+        if record is None:
+            return False
+        if record["fingerprint"] != self.fingerprint(subject):
+            return False
+        for fname, stat in record["outputs"].items():
+            if _file_stats([fname]).get(fname) != stat:
+                return False
+        return True
+
+    def outdated(self, subjects):
+        """Return the subjects that need to be run.
+
+        The fingerprints of these subjects are kept, so the records saved
+        after the run describe the inputs as they were when it started.
+
+        """
+        todo = [s for s in subjects if not self.is_current(s)]
+        self._fingerprints = dict((s, self.fingerprint(s)) for s in todo)
+        return todo
+
+    def __call__(self, node, status):
+        match = re.search(r"_subject_id_([^/]+)", node.output_dir())
+        if match is None:
+            return
+        subject = match.group(1)
+        if status == "exception":
+            self.crashed.add(subject)
+        elif status == "end" and hasattr(node._interface, "_substitute"):
+            # This is a DataSink, so the subject's outputs are in place
+            self.sunk.add(subject)
+
+    def record(self, subjects):
+        """Save records for the subjects that ran to completion.
+
+        Returns
+        -------
+        recorded : list of strings
+            Subjects with a new record.
+
+        """
+        recorded = []
+        for subject in subjects:
+            if subject not in self.sunk or subject in self.crashed:
+                continue
+            fingerprint = self._fingerprints.get(subject)
+            if fingerprint is None:
+                fingerprint = self.fingerprint(subject)
+            record = dict(fingerprint=fingerprint,
+                          outputs=self.outputs(subject),
+                          created=time.asctime())
+            self.store.save(self.name, subject, record)
+            recorded.append(subject)
+        self.sunk.clear()
+        self.crashed.clear()
+        self._fingerprints = {}
+        return recorded
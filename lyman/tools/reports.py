@@ -0,0 +1,196 @@
+"""Render workflow reports from RST templates to HTML and PDF.
+
+HTML is rendered in-process with docutils. PDF conversion with rst2pdf
+is much slower, so it can be deferred: report nodes take a ``defer_pdf``
+input (set on every report node in a workflow by ``set_pdf_deferral``),
+and when it is True they write an RST file alongside the HTML, and
+``render_deferred_reports`` converts all of them at the end of a run
+with a pool of worker processes. Because the setting is a node input, it
+is part of the node hash, so cached reports are rerun when it changes.
+
+"""
+import os
+import re
+import hashlib
+import os.path as op
+from subprocess import check_output
+from multiprocessing import Pool
+
+
+def set_pdf_deferral(wf, defer_pdf):
+    """Set the ``defer_pdf`` input of every report node in a workflow.
+
+    Parameters
+    ----------
+    wf : nipype Workflow
+        Workflow whose nodes (including nested workflows) are updated.
+    defer_pdf : bool
+        Whether report nodes should leave PDF conversion for
+        ``render_deferred_reports``.
+
+    """
+    for node in wf._get_all_nodes():
+        if hasattr(node.inputs, "defer_pdf"):
+            node.inputs.defer_pdf = bool(defer_pdf)
+
+
+def write_workflow_report(workflow_name, report_template, report_dict,
+                          defer_pdf=False):
+    """Generic function to take write .rst files and convert to pdf/html.
+
+    Accepts a report template and dictionary. Writes rst once with
+    full paths for image files and generates a pdf, then strips
+    leading path components and writes again, generating an html
+    file that exepects to live in the same directory as report images.
+
+    If ``defer_pdf`` is True, the second rst file is returned in
+    place of the pdf so that it will be sunk with the images and can be
+    converted later by ``render_deferred_reports``.
+
+    """
+    from os.path import exists, basename, abspath
+    from lyman.tools.reports import render_pdf, render_html
+
+    if not defer_pdf:
+        # Plug the values into the template for the pdf file
+        report_rst_text = report_template % report_dict
+
+        # Write the rst file and convert to pdf
+        report_pdf_rst_file = "%s_pdf.rst" % workflow_name
+        report_pdf_file = abspath("%s_report.pdf" % workflow_name)
+        open(report_pdf_rst_file, "w").write(report_rst_text)
+        render_pdf(report_pdf_rst_file, report_pdf_file)
+        if not exists(report_pdf_file):
+            raise RuntimeError
+
+    # For images going into the html report, we want the path to be relative
+    # (We expect to read the html page from within the datasink directory
+    # containing the images.  So iteratate through and chop off leading path.
+    image_files = []
+    for k, v in report_dict.items():
+        if isinstance(v, str) and v.endswith(".png"):
+            image_files.append(v)
+            report_dict[k] = basename(v)
+
+    # Write the another rst file and convert it to html
+    report_html_rst_file = abspath("%s_report.rst" % workflow_name)
+    report_html_file = abspath("%s_report.html" % workflow_name)
+    report_rst_text = report_template % report_dict
+    open(report_html_rst_file, "w").write(report_rst_text)
+    render_html(report_html_rst_file, report_html_file, image_files)
+    if not exists(report_html_file):
+        raise RuntimeError
+
+    # Return both report files as a list
+    if defer_pdf:
+        return [report_html_rst_file, report_html_file]
+    return [report_pdf_file, report_html_file]
+
+
+def report_hash(rst_file, image_files=None):
+    """Hash the text of a report and the contents of its images.
+
+    If the image files are not given, they are found from the image
+    directives in the rst, relative to the directory it lives in.
+
+    """
+    rst_text = open(rst_file).read()
+    if image_files is None:
+        rst_dir = op.dirname(op.abspath(rst_file))
+        image_files = re.findall(r"\.\. image:: (\S+)", rst_text)
+        image_files = [op.join(rst_dir, f) for f in image_files]
+
+    report_hash = hashlib.sha1()
+    report_hash.update(rst_text)
+    for image_file in sorted(image_files):
+        if op.exists(image_file):
+            report_hash.update(open(image_file, "rb").read())
+    return report_hash.hexdigest()
+
+
+def _is_current(out_file, rst_hash):
+    """Check the hash stored alongside a rendered report."""
+    hash_file = out_file + ".sha1"
+    if not (op.exists(out_file) and op.exists(hash_file)):
+        return False
+    return open(hash_file).read().strip() == rst_hash
+
+
+def _stamp(out_file, rst_hash):
+    """Store the hash of the inputs to a rendered report."""
+    with open(out_file + ".sha1", "w") as f:
+        f.write(rst_hash + "\n")
+
+
+def render_html(rst_file, html_file, image_files=None):
+    """Convert an rst file to html with docutils unless it is current."""
+    from docutils.core import publish_file
+
+    rst_hash = report_hash(rst_file, image_files)
+    if _is_current(html_file, rst_hash):
+        return html_file
+    publish_file(source_path=rst_file, destination_path=html_file,
+                 writer_name="html", settings_overrides={"report_level": 5})
+    _stamp(html_file, rst_hash)
+    return html_file
+
+
+def render_pdf(rst_file, pdf_file, image_files=None):
+    """Convert an rst file to pdf with rst2pdf unless it is current."""
+    rst_hash = report_hash(rst_file, image_files)
+    if _is_current(pdf_file, rst_hash):
+        return pdf_file
+
+    # Run from the rst directory so relative image paths resolve
+    rst_dir = op.dirname(op.abspath(rst_file))
+    check_output(["rst2pdf", op.abspath(rst_file),
+                  "-o", op.abspath(pdf_file)], cwd=rst_dir)
+    _stamp(pdf_file, rst_hash)
+    return pdf_file
+
+
+def _render_pdf_star(args):
+    """Unpack an argument tuple; allows a process pool to map over it."""
+    return render_pdf(*args)
+
+
+def find_deferred_reports(root_dir):
+    """Find report rst files that are waiting for pdf conversion."""
+    rst_files = []
+    for dirpath, _, filenames in os.walk(root_dir):
+        for fname in filenames:
+            if fname.endswith("_report.rst"):
+                rst_files.append(op.join(dirpath, fname))
+    return sorted(rst_files)
+
+
+def render_deferred_reports(root_dir, n_procs=1):
+    """Convert all deferred report rst files under a directory to pdf.
+
+    Parameters
+    ----------
+    root_dir : string
+        directory to search (e.g. the analysis directory for an
+        experiment); each rst file is converted in place
+    n_procs : int
+        number of worker processes for the conversion
+
+    Returns
+    -------
+    pdf_files : list of strings
+        paths to the pdf reports
+
+    """
+    rst_files = find_deferred_reports(root_dir)
+    args = [(f, f[:-len(".rst")] + ".pdf") for f in rst_files]
+
+    if n_procs > 1 and len(args) > 1:
+        pool = Pool(n_procs)
+        try:
+            pdf_files = pool.map(_render_pdf_star, args)
+        finally:
+            pool.close()
+    else:
+        pdf_files = map(_render_pdf_star, args)
+
+    return pdf_files
@@ -0,0 +1,301 @@
+"""Plan local workflow execution around the memory and cores of the host.
+
+The MultiProc plugin treats every node as one slot, so a handful of FNIRT
+or FLAMEO processes can push a machine into swap while lighter nodes leave
+cores idle. Here each interface gets an estimate of its peak memory, and
+a MultiProc subclass only starts a node when the memory budget has room
+for it. The pool can then be as large as the core count without
+oversubscribing memory. The interfaces lyman uses run single-threaded,
+so each running node counts as one core.
+
+"""
+import os
+from copy import deepcopy
+from itertools import count
+from multiprocessing import cpu_count
+
+import numpy as np
+from nipype import logging
+from nipype.pipeline.engine import MapNode, str2bool
+from nipype.pipeline.plugins import MultiProcPlugin
+from nipype.pipeline.plugins.multiproc import NonDaemonPool
+
+from .profiling import run_node_profiled
+
+logger = logging.getLogger("workflow")
+
+# Approximate peak memory (GB) of the interfaces in the lyman
+# workflows, for typical EPI and 1mm anatomical images
+interface_memory = dict(FNIRT=4.,
+                        FLAMEO=2.5,
+                        FILMGLS=2.,
+                        SUSAN=1.5,
+                        BBRegister=1.5,
+                        GLMFit=1.5,
+                        MCFLIRT=1.,
+                        ApplyWarp=1.,
+                        FLIRT=1.,
+                        TemporalFilter=1.,
+                        FilterRegressor=1.,
+                        SliceTimer=1.,
+                        Merge=1.,
+                        Concatenate=1.,
+                        ApplyVolTransform=1.,
+                        Function=1.)
+default_memory = .5
+
+
+def host_resources():
+    """Return the number of cores and the GB of memory available on the host.
+
+    Available memory is read from /proc/meminfo when possible, so memory
+    used by other jobs on a shared machine is not counted. Otherwise the
+    total physical memory is reported, or None if it cannot be determined.
+
+    """
+    n_cores = cpu_count()
+
+    mem_gb = None
+    try:
+        with open("/proc/meminfo") as fid:
+            for line in fid:
+                if line.startswith("MemAvailable:"):
+                    mem_gb = float(line.split()[1]) / 1024 ** 2
+                    break
+    except IOError:
+        pass
+
+    if mem_gb is None:
+        try:
+            n_pages = os.sysconf("SC_PHYS_PAGES")
+            page_size = os.sysconf("SC_PAGE_SIZE")
+            mem_gb = float(n_pages * page_size) / 1024 ** 3
+        except (AttributeError, ValueError, OSError):
+            pass
+
+    return n_cores, mem_gb
+
+
+def node_memory(node):
+    """Return the peak memory estimate in GB for a nipype node."""
+    name = node._interface.__class__.__name__
+    return interface_memory.get(name, default_memory)
+
+
+def plan_resources(n_procs=None, memory_gb=None, mem_fraction=.9):
+    """Determine the cores and memory a local run should schedule against.
+
+    Parameters
+    ----------
+    n_procs : int, optional
+        Upper limit on concurrent processes; defaults to the host cores.
+    memory_gb : float, optional
+        Memory budget in GB; defaults to ``mem_fraction`` of the memory
+        currently available on the host.
+    mem_fraction : float, optional
+        Share of available memory to use, leaving headroom for the
+        scheduler and page cache.
+
+    Returns
+    -------
+    n_procs : int
+    memory_gb : float or None
+
+    """
+    host_cores, host_mem = host_resources()
+    if n_procs is None:
+        n_procs = host_cores
+    if memory_gb is None and host_mem is not None:
+        memory_gb = host_mem * mem_fraction
+    return n_procs, memory_gb
+
+
+class ResourceMultiProcPlugin(MultiProcPlugin):
+    """MultiProc plugin that starts nodes only when cores and memory allow.
+
+    In addition to the MultiProc options, the plugin_args can contain
+
+    - memory_gb : memory budget in GB (None for no limit)
+    - profiler : WorkflowProfiler that receives the CPU time and peak
+                 memory of each node, measured in single-use workers
+
+    At most ``n_procs`` nodes run at once. Ready nodes are started oldest
+    first; when the oldest one does not fit, its memory is set aside and
+    later nodes can only use what is left, so a large node is not starved
+    by a stream of small ones. A node that alone exceeds the budget is
+    run once nothing else is running, so oversized estimates cannot stall
+    the workflow.
+
+    """
+    def __init__(self, plugin_args=None):
+        super(ResourceMultiProcPlugin, self).__init__(plugin_args=plugin_args)
+        plugin_args = {} if plugin_args is None else plugin_args
+        self.n_procs = plugin_args.get("n_procs", cpu_count())
+        self.memory_gb = plugin_args.get("memory_gb")
+        self._task_memory = {}
+        self._ready_order = {}
+        self._ready_count = count()
+
+        self._profiler = plugin_args.get("profiler")
+        self._task_dirs = {}
+        if self._profiler is not None:
+            # Peak memory is only attributable to a node in a fresh worker
+            self.pool.close()
+            self.pool = NonDaemonPool(processes=self.n_procs,
+                                      maxtasksperchild=1)
+
+    def __getstate__(self):
+        # Executed MapNodes keep a reference to the plugin, so it is copied
+        # and pickled along with them; leave out the pool and job graph
+        return dict(n_procs=self.n_procs, memory_gb=self.memory_gb,
+                    max_jobs=self.max_jobs, _task_memory={},
+                    _ready_order={}, _profiler=None, _task_dirs={})
+
+    def _memory_used(self):
+        return sum(self._task_memory.values())
+
+    def _fits(self, mem, used_mem, n_running):
+        """True if a node can start alongside what is running or reserved."""
+        if n_running >= self.n_procs:
+            return False
+        if self.memory_gb is None or not n_running and not used_mem:
+            return True
+        return used_mem + mem <= self.memory_gb
+
+    def _ready_jobs(self):
+        """Return the jobs whose inputs are ready, oldest first."""
+        jobids = np.flatnonzero((self.proc_done == False) &
+                                (self.depidx.sum(axis=0) == 0).__array__())
+        for jobid in jobids:
+            if jobid not in self._ready_order:
+                self._ready_order[jobid] = next(self._ready_count)
+        return sorted(jobids, key=self._ready_order.get)
+
+    def _send_procs_to_workers(self, updatehash=False, slots=None, graph=None):
+        """Start the ready jobs that fit, and leave the others waiting.
+
+        This replaces the MultiProc submission pass, so that jobs are
+        only marked as started, reported to the status callback, and
+        copied for submission once they have room to run.
+
+        """
+        n_running = len(self._task_memory)
+        used_mem = self._memory_used()
+        reserved = False
+        n_sent = 0
+        for jobid in self._ready_jobs():
+            if len(self.pending_tasks) >= self.max_jobs:
+                break
+            if slots is not None and n_sent >= slots:
+                break
+            node = self.procs[jobid]
+
+            if isinstance(node, MapNode):
+                try:
+                    num_subnodes = node.num_subnodes()
+                except Exception:
+                    self._clean_queue(jobid, graph)
+                    self.proc_pending[jobid] = False
+                    continue
+                if num_subnodes > 1 and not self._submit_mapnode(jobid):
+                    # The subnodes are queued; the MapNode itself runs
+                    # to collect their results once they are done
+                    continue
+
+            mem = node_memory(node)
+            if not self._fits(mem, used_mem, n_running):
+                if not reserved:
+                    # Hold the oldest waiting node's share of memory
+                    used_mem += mem
+                    reserved = True
+                continue
+
+            self.proc_done[jobid] = True
+            self.proc_pending[jobid] = True
+            self._ready_order.pop(jobid, None)
+            logger.info("Executing: %s ID: %d" % (node._id, jobid))
+            if self._status_callback:
+                self._status_callback(node, "start")
+            if self._cached(jobid, graph):
+                continue
+            if node.run_without_submitting:
+                logger.debug("Running node %s on master thread" % node)
+                try:
+                    node.run()
+                except Exception:
+                    self._clean_queue(jobid, graph)
+                self._task_finished_cb(jobid)
+                self._remove_node_dirs()
+                continue
+
+            taskid = self._submit_job(deepcopy(node), updatehash=updatehash)
+            self.pending_tasks.insert(0, (taskid, jobid))
+            used_mem += mem
+            n_running += 1
+            n_sent += 1
+
+    def _cached(self, jobid, graph):
+        """Finish a job without running it if its results are current."""
+        node = self.procs[jobid]
+        if not str2bool(node.config["execution"]["local_hash_check"]):
+            return False
+        try:
+            hash_exists = node.hash_exists()[0]
+        except Exception:
+            self._clean_queue(jobid, graph)
+            self.proc_pending[jobid] = False
+            return True
+        if hash_exists and (node.overwrite is False
+                            or (node.overwrite is None
+                                and not node._interface.always_run)):
+            self._task_finished_cb(jobid)
+            self._remove_node_dirs()
+            return True
+        return False
+
+    def _submit_job(self, node, updatehash=False):
+        if self._profiler is None:
+            taskid = super(ResourceMultiProcPlugin, self)._submit_job(
+                node, updatehash)
+        else:
+            self._taskid += 1
+            taskid = self._taskid
+            self._taskresult[taskid] = self.pool.apply_async(
+                run_node_profiled, (node, updatehash))
+            self._task_dirs[taskid] = node.output_dir()
+
+        self._task_memory[taskid] = node_memory(node)
+        return taskid
+
+    def _get_result(self, taskid):
+        result = super(ResourceMultiProcPlugin, self)._get_result(taskid)
+        if result is not None and taskid in self._task_dirs:
+            self._profiler.add_usage(self._task_dirs.pop(taskid),
+                                     result["usage"])
+        return result
+
+    def _clear_task(self, taskid):
+        self._task_memory.pop(taskid, None)
+        super(ResourceMultiProcPlugin, self)._clear_task(taskid)
+
+
+def request_node_memory(wf, plugin):
+    """Add the memory estimate of each node to its batch submission args.
+
+    Parameters
+    ----------
+    wf : nipype Workflow
+        Workflow whose nodes (including nested workflows) are updated.
+    plugin : "SGE" or "PBS"
+        Batch plugin, which determines the resource request syntax.
+
+    """
+    request = dict(SGE="-l h_vmem=%.1fG", PBS="-l mem=%dmb")[plugin]
+    for node in wf._get_all_nodes():
+        mem = node_memory(node)
+        if plugin == "PBS":
+            mem = mem * 1024
+        node_args = node.plugin_args.get("qsub_args", "")
+        if "mem=" not in node_args:
+            node_args = (node_args + " " + request % mem).strip()
+            node.plugin_args["qsub_args"] = node_args
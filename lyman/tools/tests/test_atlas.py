@@ -0,0 +1,94 @@
+import os
+import shutil
+import os.path as op
+from tempfile import mkdtemp
+import numpy as np
+import nibabel as nib
+from nose.tools import assert_equal, assert_true, assert_false
+
+from .. import atlas
+from ..main import harvard_oxford_sub_names, harvard_oxford_ctx_names
+
+
+def make_atlas_files(test_dir):
+    """Write small random probability atlases."""
+    rs = np.random.RandomState(0)
+    files = {}
+    for name, n_regions in [("cort", 48), ("sub", 21)]:
+        data = rs.randint(0, 100, (4, 5, 6, n_regions)).astype(np.uint8)
+        data[0] = 0
+        data[1, :, :, 1:] = 0
+        files[name] = op.join(test_dir, "%s.nii.gz" % name)
+        nib.save(nib.Nifti1Image(data, np.eye(4)), files[name])
+    return files
+
+
+def reference_lookup(ctx_data, sub_data, coord):
+    """Find the most probable region with a simple loop over rules."""
+    ctx_index = np.argmax(ctx_data[coord])
+    ctx_prob = ctx_data[coord][ctx_index]
+    sub_index = np.argmax(sub_data[coord])
+    sub_prob = sub_data[coord][sub_index]
+
+    if not max(sub_prob, ctx_prob):
+        return ("Unknown", 0)
+    if not ctx_prob and sub_index in [0, 11]:
+        return (harvard_oxford_sub_names[sub_index], sub_prob)
+    if sub_prob > ctx_prob and sub_index not in [0, 1, 11, 12]:
+        return (harvard_oxford_sub_names[sub_index], sub_prob)
+    return (harvard_oxford_ctx_names[ctx_index], ctx_prob)
+
+
+def test_atlas_lookup():
+
+    test_dir = mkdtemp()
+    try:
+        files = make_atlas_files(test_dir)
+        cache_dir = op.join(test_dir, "cache")
+        yield assert_false, atlas.cache_is_current(files, cache_dir)
+        atlas.build_atlas_cache(files, cache_dir)
+        yield assert_true, atlas.cache_is_current(files, cache_dir)
+
+        ctx_data = nib.load(files["cort"]).get_data()
+        sub_data = nib.load(files["sub"]).get_data()
+        ho = atlas.HarvardOxfordAtlas(cache_dir)
+
+        coords = np.array(list(np.ndindex(4, 5, 6)))
+        names, probs = ho.lookup(coords)
+        for coord, name, prob in zip(coords, names, probs):
+            want = reference_lookup(ctx_data, sub_data, tuple(coord))
+            yield assert_equal, want, (name, prob)
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_atlas_empty_lookup():
+
+    test_dir = mkdtemp()
+    try:
+        files = make_atlas_files(test_dir)
+        atlas.build_atlas_cache(files, test_dir)
+        names, probs = atlas.HarvardOxfordAtlas(test_dir).lookup([])
+        assert_equal(len(names), 0)
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_atlas_cache_paths():
+
+    test_dir = mkdtemp()
+    try:
+        # Source paths with spaces are recorded faithfully
+        atlas_dir = op.join(test_dir, "FSL atlases")
+        os.makedirs(atlas_dir)
+        files = make_atlas_files(atlas_dir)
+        cache_dir = op.join(test_dir, "cache")
+        atlas.build_atlas_cache(files, cache_dir)
+        assert_true(atlas.cache_is_current(files, cache_dir))
+
+        # A garbled record makes the cache stale rather than failing
+        with open(op.join(cache_dir, "sub_source.json"), "w") as f:
+            f.write("not json")
+        assert_false(atlas.cache_is_current(files, cache_dir))
+    finally:
+        shutil.rmtree(test_dir)
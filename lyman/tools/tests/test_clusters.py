@@ -0,0 +1,82 @@
+import shutil
+import os.path as op
+from tempfile import mkdtemp
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from numpy.testing import assert_array_equal
+from nose.tools import assert_equal
+
+from .. import clusters
+
+
+def make_stat_data():
+    """Make an image with two clusters of different sizes."""
+    grid = np.indices((10, 10, 10)).transpose(1, 2, 3, 0)
+    data = np.zeros((10, 10, 10))
+    for center, height in [((6, 6, 6), 6), ((8, 8, 8), 4), ((1, 1, 1), 5)]:
+        dist = ((grid - center) ** 2).sum(axis=-1)
+        data += height * np.exp(-dist / 2.)
+    mask = np.zeros((10, 10, 10), bool)
+    mask[0:3, 0:3, 0:3] = True
+    mask[5:9, 5:9, 5:9] = True
+    return data * mask
+
+
+def test_find_clusters():
+
+    data = make_stat_data()
+    labels, sizes = clusters.find_clusters(data, .01)
+    assert_array_equal(sizes, [64, 27])
+    assert_equal(labels[6, 6, 6], 1)
+    assert_equal(labels[1, 1, 1], 2)
+    assert_equal(labels[4, 4, 4], 0)
+
+
+def test_local_maxima():
+
+    data = make_stat_data()
+    labels, sizes = clusters.find_clusters(data, .01)
+    coords, cluster = clusters.local_maxima(data, labels)
+    assert_array_equal(coords, [[6, 6, 6], [8, 8, 8], [1, 1, 1]])
+    assert_array_equal(cluster, [1, 1, 2])
+
+    coords, cluster = clusters.local_maxima(data, labels, n_peaks=1)
+    assert_array_equal(coords, [[6, 6, 6], [1, 1, 1]])
+
+
+def test_cluster_table():
+
+    test_dir = mkdtemp()
+    try:
+        stat_file = op.join(test_dir, "zstat.nii.gz")
+        aff = np.diag([2., 2., 2., 1.])
+        nib.save(nib.Nifti1Image(make_stat_data(), aff), stat_file)
+
+        table = clusters.cluster_table(stat_file, .01, label_peaks=False)
+        assert_equal(len(table), 3)
+        assert_array_equal(table["peak"], [1, 2, 3])
+        assert_array_equal(table["size"], [64, 64, 27])
+        assert_array_equal(table["value"].round(), [6, 4, 5])
+        assert_array_equal(table["x"], [12, 16, 2])
+
+        rst = clusters.table_to_rst(table).splitlines()
+        assert_equal(len(rst), 7)
+        assert rst[1].startswith("Peak Cluster Size Value")
+        assert_equal(rst[0], rst[2])
+
+        html = clusters.table_to_html(table)
+        assert_equal(html.count("<tr>"), 4)
+
+        csv_file = op.join(test_dir, "peaks.csv")
+        clusters.table_to_csv(table, csv_file)
+        df = pd.read_csv(csv_file)
+        assert_array_equal(df[["i", "j", "k"]].values[0], [6, 6, 6])
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_empty_table():
+
+    table = np.zeros(0, clusters.peak_dtype)
+    assert_equal(clusters.table_to_rst(table), "")
@@ -1,10 +1,16 @@
+import os
+import shutil
+import pickle
+import os.path as op
+from tempfile import mkdtemp
 import numpy as np
+import nibabel as nib
 from argparse import Namespace
-from nipype.testing import assert_equal, assert_true
+from nipype.testing import assert_equal, assert_true, assert_raises
 
 from nipype.pipeline.engine import Workflow, Node, MapNode
 from nipype.interfaces.utility import IdentityInterface
-from nipype.interfaces.io import DataGrabber
+from nipype.interfaces.io import DataGrabber, DataSink
 
 from .. import main
 
@@ -68,6 +74,53 @@ def test_find_mapnodes():
     yield assert_equal, mapnodes, ["node2"]
 
 
+def test_find_mapnodes_nested():
+
+    wf, node1, node2, node3 = make_simple_workflow()
+    inner_wf = make_simple_workflow()[0]
+    inner_wf.name = "inner"
+    inner_wf.add_nodes([MapNode(IdentityInterface(fields=["foo"]),
+                                name="node4", iterfield=["foo"])])
+    outer_wf = Workflow(name="outer")
+    outer_wf.add_nodes([inner_wf])
+    wf.connect(node3, "foo", outer_wf, "inner.node1.foo")
+
+    mapnodes = main.find_mapnodes(wf)
+    yield assert_equal, sorted(mapnodes), ["node2", "node4"]
+
+
+def test_datasink_substitutions():
+
+    subj_node = Node(IdentityInterface(fields=["subject_id"]),
+                     iterables=("subject_id", ["s1", "s2"]),
+                     name="subj_source")
+
+    paths = ["/a/_subject_id_s1/_node20/f.nii.gz",
+             "/a/_subject_id_s2/_node211/_node21/f.nii.gz",
+             "/a/_subject_id_s1/_node210/g_node2.nii.gz",
+             "/a/_node2/_node1/f.nii.gz"]
+
+    subbed = []
+    for sink in [DataSink(), main.DataSink()]:
+        wf = make_simple_workflow()[0]
+        sink_node = Node(sink, name="sink")
+        wrapper = main.OutputWrapper(wf, subj_node, sink_node, None)
+        wrapper.set_mapnode_substitutions(12)
+        wrapper.set_subject_container()
+        wrapper.add_regexp_substitutions([("f.nii", "func.nii")])
+        subbed.append([sink_node.interface._substitute(p) for p in paths])
+
+    yield assert_equal, subbed[1], subbed[0]
+    yield assert_equal, subbed[1][1], "/a/run_12/run_2/func.nii.gz"
+
+
+def test_substitution_regex():
+
+    pattern = main._substitution_regex(["_a1", "_a11", "_b", "x.y"])
+    yield assert_equal, pattern.findall("_a11/_a1/_a2_b/x.yxzy"), \
+        ["_a11", "_a1", "_b", "x.y"]
+
+
 def test_find_nested_workflows():
 
     wf, node1, node2, node3 = make_simple_workflow()
@@ -95,7 +148,14 @@ def test_determine_engine():
         yield assert_equal, plugin, plugin_str
 
         if arg == "multiproc":
-            yield assert_equal, plugin_args, dict(n_procs=4, qsub_args="")
+            yield assert_equal, plugin_args["n_procs"], 4
+            yield assert_equal, plugin_args["qsub_args"], ""
+            yield assert_true, plugin_args["memory_gb"] > 0
+
+    args = Namespace(plugin="multiproc", queue=None, nprocs=None, memory=8.)
+    plugin, plugin_args = main.determine_engine(args)
+    yield assert_true, plugin_args["n_procs"] >= 1
+    yield assert_equal, plugin_args["memory_gb"], 8.
 
 
 def test_find_contrast_number():
@@ -148,3 +208,96 @@ def test_vox_to_mni():
         vox = np.atleast_2d(vox)
         mni = np.atleast_2d(mni)
         yield assert_equal, mni, main.vox_to_mni(vox)
+
+
+def test_coordinate_transforms():
+
+    test_dir = mkdtemp()
+    try:
+        aff = np.array([[-2, 0, 0, 90],
+                        [0, 2, 0, -126],
+                        [0, 0, 2, -72],
+                        [0, 0, 0, 1]], float)
+        img_file = op.join(test_dir, "img.nii.gz")
+        nib.save(nib.Nifti1Image(np.zeros((4, 4, 4)), aff), img_file)
+
+        yield assert_equal, main.image_affine(img_file).tolist(), aff.tolist()
+
+        vox = np.array([(45, 63, 36), (0, 0, 0), (70, 38, 42)])
+        world = main.vox_to_world(vox, img_file)
+        yield assert_equal, world.shape, (3, 3)
+        yield assert_equal, world[0].tolist(), [0, 0, 0]
+        yield assert_equal, world[2].tolist(), [-50, -50, 12]
+
+        back = main.world_to_vox(world, img_file)
+        yield assert_equal, back.tolist(), vox.tolist()
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_verify_experiment_info():
+
+    exp = dict(units="secs", slice_time_correction=False, TR=2,
+               hpf_cutoff=128)
+    for n_runs in [2, 2L, np.int64(2)]:
+        main.verify_experiment_info(dict(exp, n_runs=n_runs))
+    yield (assert_raises, ValueError, main.verify_experiment_info,
+           dict(exp, n_runs=2.))
+    yield (assert_raises, ValueError, main.verify_experiment_info,
+           dict(exp, units="ms"))
+
+
+def test_experiment_info():
+
+    test_dir = mkdtemp()
+    orig_lyman_dir = os.environ.get("LYMAN_DIR")
+    os.environ["LYMAN_DIR"] = test_dir
+    exp_file = op.join(test_dir, "exp.py")
+
+    def write_exp(tr, mtime):
+        with open(exp_file, "w") as fid:
+            fid.write('"""Test experiment."""\nimport os\n'
+                      'TR = %r\nhpf_cutoff = 128\n'
+                      'hrf_model = "GammaDifferenceHRF"\nhrf_derivs = False\n'
+                      'units = "secs"\nslice_time_correction = False\n'
+                      'cont01 = ("a", ["a"], [1])\n' % tr)
+        os.utime(exp_file, (mtime, mtime))
+
+    try:
+        write_exp(2, 1000)
+        exp = main.gather_experiment_info("exp")
+        yield assert_equal, exp["TR"], 2.
+        yield assert_equal, exp.hpf_sigma, (128 / 2.35) / 2
+        yield assert_equal, exp["contrast_names"], ["a"]
+        yield assert_equal, exp["comments"], "Test experiment."
+        yield assert_true, "os" not in exp
+        yield assert_true, main.gather_experiment_info("exp") is exp
+
+        # Copies can be modified without touching the cached config
+        exp_copy = main.gather_experiment_info("exp", copy=True)
+        yield assert_equal, exp_copy, exp
+        exp_copy["contrasts"].append(("b", ["b"], [1]))
+        exp_copy["contrast_names"].append("b")
+        exp_again = main.gather_experiment_info("exp")
+        yield assert_equal, exp_again["contrast_names"], ["a"]
+        yield assert_equal, len(exp_again["contrasts"]), 1
+
+        yield assert_raises, TypeError, exp.__setitem__, "TR", 3
+        yield assert_raises, TypeError, exp.update, {"TR": 3}
+
+        exp_copy = pickle.loads(pickle.dumps(exp))
+        yield assert_equal, exp_copy, exp
+        yield assert_true, isinstance(exp_copy, main.LymanConfig)
+
+        write_exp(3, 2000)
+        exp = main.gather_experiment_info("exp")
+        yield assert_equal, exp["TR"], 3.
+
+        write_exp("fast", 3000)
+        yield assert_raises, ValueError, main.gather_experiment_info, "exp"
+    finally:
+        if orig_lyman_dir is None:
+            os.environ.pop("LYMAN_DIR")
+        else:
+            os.environ["LYMAN_DIR"] = orig_lyman_dir
+        shutil.rmtree(test_dir)
@@ -0,0 +1,587 @@
+import os
+import csv
+import sys
+import time
+import shutil
+import os.path as op
+from tempfile import mkdtemp
+import numpy as np
+import nibabel as nib
+from nipype.testing import assert_equal, assert_true, assert_raises
+
+from .. import maskfactory
+
+
+def test_run_commands():
+
+    cmds = [["echo", str(i)] for i in range(6)]
+    outputs = maskfactory.run_commands(cmds, n_procs=3)
+    yield assert_equal, outputs, ["%d\n" % i for i in range(6)]
+
+    # Commands overlap in the pool
+    start = time.time()
+    maskfactory.run_commands([["sleep", ".5"]] * 4, n_procs=4)
+    yield assert_true, time.time() - start < 1.5
+
+
+def test_run_commands_failures():
+
+    cmds = [["true"],
+            ["sh", "-c", "echo bad label >&2; exit 3"],
+            ["sleep", "10"],
+            ["not_a_lyman_command"]]
+    cmd_args = [dict(subj="s1", hemi="lh"), dict(subj="s1", hemi="rh"),
+                dict(subj="s2", hemi="lh"), dict(subj="s2", hemi="rh")]
+
+    start = time.time()
+    failures, message = [], ""
+    try:
+        maskfactory.run_commands(cmds, cmd_args, n_procs=4, timeout=.5)
+    except maskfactory.CommandError as err:
+        failures, message = err.failures, str(err)
+    yield assert_true, time.time() - start < 5
+
+    returncodes = dict(((f["args"]["subj"], f["args"]["hemi"]),
+                        f["returncode"]) for f in failures)
+    yield assert_equal, sorted(returncodes), [("s1", "rh"), ("s2", "lh"),
+                                              ("s2", "rh")]
+    yield assert_equal, returncodes[("s1", "rh")], 3
+    yield assert_equal, returncodes[("s2", "lh")], None
+    yield assert_true, "hemi rh, subj s1: sh exited with status 3" in message
+    yield assert_true, "bad label" in message
+    yield assert_true, "timed out" in message
+    yield assert_true, "could not be started" in message
+
+    yield assert_raises, maskfactory.CommandError, \
+        maskfactory.run_commands, [["false"]]
+
+
+def test_run_functions():
+
+    def divide(x, y):
+        assert y, "s2 has no data"
+        return x / y
+
+    cmd_args = [dict(subj="s1"), dict(subj="s2")]
+    failures = []
+    yield assert_equal, maskfactory.run_functions(divide, [(1, 1)]), [1]
+    try:
+        maskfactory.run_functions(divide, [(1, 1), (1, 0)], cmd_args)
+    except maskfactory.CommandError as err:
+        failures = err.failures
+    yield assert_equal, len(failures), 1
+    yield assert_equal, failures[0]["args"], dict(subj="s2")
+    yield assert_true, "s2 has no data" in failures[0]["output"]
+
+    # Failed commands within a call are reported with the call's labels
+    def run_hemis(subj):
+        maskfactory.run_commands([["true"], ["false"]],
+                                 [dict(hemi="lh"), dict(hemi="rh")])
+
+    failures = []
+    try:
+        maskfactory.run_functions(run_hemis, [("s1",), ("s2",)], cmd_args)
+    except maskfactory.CommandError as err:
+        failures = err.failures
+    yield assert_equal, [f["args"] for f in failures], \
+        [dict(subj="s1", hemi="rh"), dict(subj="s2", hemi="rh")]
+    yield assert_equal, failures[0]["cmd"], ["false"]
+
+
+def test_threshold_image():
+
+    test_dir = mkdtemp()
+    try:
+        data = np.array([-3, -1, 0, 1, 2.3, 3]).reshape(1, 2, 3)
+        aff = np.diag([2, 2, 2, 1])
+        in_file = op.join(test_dir, "zstat1.nii.gz")
+        out_file = op.join(test_dir, "mask.nii.gz")
+        nib.save(nib.Nifti1Image(data, aff), in_file)
+
+        maskfactory.threshold_image(in_file, "2.3", out_file)
+        img = nib.load(out_file)
+        yield assert_equal, img.get_data().ravel().tolist(), [0, 0, 0, 0, 1, 1]
+        yield assert_equal, img.get_data_dtype(), np.uint8
+        yield assert_true, np.array_equal(img.get_affine(), aff)
+
+        # Zero voxels stay out of the mask with a negative threshold
+        maskfactory.threshold_image(in_file, -2, out_file)
+        mask = nib.load(out_file).get_data().ravel().tolist()
+        yield assert_equal, mask, [0, 1, 0, 1, 1, 1]
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_binarize_labels():
+
+    test_dir = mkdtemp()
+    try:
+        data = np.array([0, 17, 53, 17, 2, 53], np.int32).reshape(1, 2, 3)
+        aff = np.diag([1, 1, 1, 1.])
+        in_file = op.join(test_dir, "aseg.mgz")
+        out_file = op.join(test_dir, "mask.nii.gz")
+        nib.save(nib.MGHImage(data, aff), in_file)
+
+        maskfactory.binarize_labels(in_file, [17, 53], out_file)
+        img = nib.load(out_file)
+        yield assert_equal, img.get_data().ravel().tolist(), [0, 1, 1, 1, 0, 1]
+        yield assert_true, np.array_equal(img.get_affine(), aff)
+    finally:
+        shutil.rmtree(test_dir)
+
+
+class ProjectFixture(object):
+    """Minimal project with epi-space stat images for some subjects."""
+    def __init__(self):
+        self.test_dir = mkdtemp()
+        self.env = dict((key, os.environ.get(key))
+                        for key in ["LYMAN_DIR", "SUBJECTS_DIR"])
+        os.environ["LYMAN_DIR"] = self.test_dir
+        with open(op.join(self.test_dir, "project.py"), "w") as fid:
+            fid.write("data_dir = %r\nanalysis_dir = %r\n"
+                      "default_exp = 'exp'\n" % (self.test_dir,
+                                                  self.test_dir))
+        self.stat_temp = op.join(self.test_dir, "%(subj)s", "zstat1.nii.gz")
+        self.mask_temp = op.join(self.test_dir, "%s", "masks", "%s.nii.gz")
+
+    def add_subject(self, subj):
+        aff = np.diag([2, 2, 2, 1.])
+        stat = np.array([0, 1, 2, 3, 4, 5.]).reshape(1, 2, 3)
+        preproc_dir = op.join(self.test_dir, "exp", subj, "preproc", "run_1")
+        os.makedirs(preproc_dir)
+        os.makedirs(op.join(self.test_dir, subj, "masks"))
+        nib.save(nib.Nifti1Image(np.ones((1, 2, 3)), aff),
+                 op.join(preproc_dir, "mean_func.nii.gz"))
+        nib.save(nib.Nifti1Image(stat, aff), self.stat_temp % dict(subj=subj))
+
+    def mask(self, subj, roi):
+        img = nib.load(self.mask_temp % (subj, roi))
+        return img.get_data().ravel().tolist()
+
+    def close(self):
+        sys.modules.pop("project", None)
+        for key, value in self.env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self.test_dir)
+
+
+def test_roi_table():
+
+    project = ProjectFixture()
+    try:
+        for subj in ["s1", "s2"]:
+            project.add_subject(subj)
+
+        table = op.join(project.test_dir, "rois.csv")
+        with open(table, "w") as fid:
+            fid.write("roi,type,source,hemi,param\n")
+            fid.write("high,stat_volume,%s,,4\n" % project.stat_temp)
+            fid.write("mid,stat_volume,%s,,2\n" % project.stat_temp)
+
+        factory = maskfactory.MaskFactory(["s1", "s2"], None, "atlas",
+                                          "roi_table", n_procs=2)
+        factory.from_roi_table(table, label_volume=True)
+
+        yield assert_equal, project.mask("s2", "high"), [0, 0, 0, 0, 1, 1]
+        yield assert_equal, project.mask("s2", "mid"), [0, 0, 1, 1, 1, 1]
+
+        # Earlier rows take precedence in the label volume
+        yield assert_equal, project.mask("s2", "atlas"), [0, 0, 2, 2, 1, 1]
+        lut_file = op.join(project.test_dir, "s1", "masks", "atlas.txt")
+        with open(lut_file) as fid:
+            yield assert_equal, fid.read(), "1\thigh\n2\tmid\n"
+
+        # Only the new subject is processed on a rerun
+        project.add_subject("s3")
+        mtime = op.getmtime(project.mask_temp % ("s1", "atlas"))
+        factory = maskfactory.MaskFactory(["s1", "s2", "s3"], None, "atlas",
+                                          "roi_table", n_procs=2)
+        factory.from_roi_table(table, label_volume=True)
+        yield assert_equal, factory.updated_subjects, ["s3"]
+        yield assert_equal, project.mask("s3", "atlas"), [0, 0, 2, 2, 1, 1]
+        yield (assert_equal, op.getmtime(project.mask_temp % ("s1", "atlas")),
+               mtime)
+
+        # Changing a row only remakes that roi
+        with open(table, "w") as fid:
+            fid.write("roi,type,source,hemi,param\n")
+            fid.write("high,stat_volume,%s,,5\n" % project.stat_temp)
+            fid.write("mid,stat_volume,%s,,2\n" % project.stat_temp)
+        factory.from_roi_table(table, label_volume=True)
+        yield assert_equal, factory.updated_rois["s1"], ["high"]
+        yield assert_equal, project.mask("s1", "atlas"), [0, 0, 2, 2, 2, 1]
+    finally:
+        project.close()
+
+
+def test_skip_current():
+
+    project = ProjectFixture()
+    try:
+        project.add_subject("s1")
+        project.add_subject("s2")
+
+        factory = maskfactory.MaskFactory(["s1", "s2"], None, "stat",
+                                          "stat_volume", n_procs=1)
+        factory.from_statistical_file(project.stat_temp, "3")
+        yield assert_equal, factory.updated_subjects, ["s1", "s2"]
+        yield assert_equal, project.mask("s1", "stat"), [0, 0, 0, 1, 1, 1]
+        sidecar = op.join(project.test_dir, "s1", "masks",
+                          "stat.sources.json")
+        yield assert_true, op.exists(sidecar)
+
+        factory.from_statistical_file(project.stat_temp, "3")
+        yield assert_equal, factory.updated_subjects, []
+
+        # New inputs, a removed mask, or new arguments trigger a remake
+        stat_file = project.stat_temp % dict(subj="s1")
+        data = np.arange(6.)[::-1].reshape(1, 2, 3)
+        nib.save(nib.Nifti1Image(data, np.eye(4)), stat_file)
+        os.utime(stat_file, (0, 0))
+        os.remove(project.mask_temp % ("s2", "stat"))
+        factory.from_statistical_file(project.stat_temp, "3")
+        yield assert_equal, factory.updated_subjects, ["s1", "s2"]
+        yield assert_equal, project.mask("s1", "stat"), [1, 1, 1, 0, 0, 0]
+
+        factory.from_statistical_file(project.stat_temp, "4")
+        yield assert_equal, factory.updated_subjects, ["s1", "s2"]
+
+        factory.force = True
+        factory.from_statistical_file(project.stat_temp, "4")
+        yield assert_equal, factory.updated_subjects, ["s1", "s2"]
+    finally:
+        project.close()
+
+
+def test_read_roi_table():
+
+    test_dir = mkdtemp()
+    try:
+        table = op.join(test_dir, "rois.csv")
+        with open(table, "w") as fid:
+            fid.write("roi, type, source, hemi, param\n")
+            fid.write("V1, fsaverage_label, V1, lh, graymid\n")
+        rois = maskfactory.read_roi_table(table)
+        yield assert_equal, rois, [dict(roi="V1", type="fsaverage_label",
+                                        source="V1", hemi="lh",
+                                        param="graymid")]
+
+        with open(table, "a") as fid:
+            fid.write("V2, surface, V2, lh, graymid\n")
+        yield assert_raises, ValueError, maskfactory.read_roi_table, table
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_mask_mosaic():
+
+    bg = np.ones((4, 3, 5))
+    bg[:, :, 0] = 0
+    mask = np.zeros((4, 3, 5))
+    mask[0, 2, 1] = 1
+    mosaic = maskfactory.mask_mosaic(bg, mask, width=0)
+
+    # Five slices tile into a 2 x 3 grid of (y, x) images
+    yield assert_equal, mosaic.shape, (2 * 3, 3 * 4, 3)
+    yield assert_equal, mosaic.dtype, np.uint8
+
+    # The masked voxel is red in the second slice, anterior up
+    red = np.argwhere((mosaic[..., 0] > mosaic[..., 1]))
+    yield assert_equal, red.tolist(), [[0, 4]]
+    yield assert_equal, mosaic[0, 0].tolist(), [0, 0, 0]
+    yield assert_equal, mosaic[0, -1].tolist(), [255, 255, 255]
+    yield assert_equal, mosaic[-1, -1].tolist(), [0, 0, 0]
+
+    big = maskfactory.mask_mosaic(bg, mask, width=30)
+    yield assert_equal, big.shape, (12, 24, 3)
+
+
+def test_write_png():
+
+    project = ProjectFixture()
+    try:
+        for subj in ["s1", "s2"]:
+            project.add_subject(subj)
+        factory = maskfactory.MaskFactory(["s1", "s2"], None, "stat",
+                                          "stat_volume", n_procs=2)
+        factory.from_statistical_file(project.stat_temp, "3")
+
+        sheet_dir = op.join(project.test_dir, "qc")
+        factory.write_png(sheet_dir=sheet_dir)
+        png_file = op.join(project.test_dir, "s1", "masks", "stat.png")
+        yield assert_true, op.exists(png_file)
+        yield assert_true, op.exists(op.join(sheet_dir, "stat.png"))
+
+        # Current masks are not redrawn
+        mtime = op.getmtime(png_file)
+        time.sleep(.01)
+        factory.from_statistical_file(project.stat_temp, "3")
+        factory.write_png()
+        yield assert_equal, op.getmtime(png_file), mtime
+    finally:
+        project.close()
+
+
+def write_surface_data(test_dir, subj, hemi, offset=0):
+    """Write a small white and pial surface with a label on two vertices."""
+    surf_dir = op.join(test_dir, subj, "surf")
+    label_dir = op.join(test_dir, subj, "label")
+    for dir in [surf_dir, label_dir]:
+        if not op.exists(dir):
+            os.makedirs(dir)
+
+    white = np.array([[-4, -4, -4], [0, 0, 0], [2, 0, 0]], np.float)
+    white[:, 0] += offset
+    faces = np.array([[0, 1, 2]])
+    nib.freesurfer.write_geometry(op.join(surf_dir, hemi + ".white"),
+                                  white, faces)
+    nib.freesurfer.write_geometry(op.join(surf_dir, hemi + ".pial"),
+                                  white + [0, 0, 2], faces)
+
+    label_file = op.join(label_dir, hemi + ".test.label")
+    with open(label_file, "w") as fid:
+        fid.write("#!ascii label\n2\n")
+        for vertex in [0, 1]:
+            fid.write("%d %g %g %g 0\n" % ((vertex,) + tuple(white[vertex])))
+    return label_file
+
+
+def test_project_label():
+
+    test_dir = mkdtemp()
+    try:
+        label_file = write_surface_data(test_dir, "s1", "lh")
+        surf_temp = op.join(test_dir, "s1", "surf", "lh.%s")
+        epi_img = nib.Nifti1Image(np.zeros((4, 4, 4)), np.diag([2, 2, 2, 1]))
+
+        # The center of the volume is at the tkregister origin
+        vox2ras = maskfactory.tkr_vox2ras(epi_img)
+        yield assert_equal, vox2ras.dot([2, 2, 2, 1]).tolist(), [0, 0, 0, 1]
+
+        mask = maskfactory.project_label(label_file, surf_temp % "white",
+                                         surf_temp % "pial", np.eye(4),
+                                         epi_img, ["frac", "0", "1", ".5"])
+        yield assert_equal, np.argwhere(mask).tolist(), [[0, 0, 0], [0, 0, 1],
+                                                         [2, 2, 2], [2, 2, 3]]
+
+        mask = maskfactory.project_label(label_file, surf_temp % "white",
+                                         surf_temp % "pial", np.eye(4),
+                                         epi_img, ["frac", "0", "0", "0"])
+        yield assert_equal, np.argwhere(mask).tolist(), [[0, 0, 0], [2, 2, 2]]
+
+        # The registration moves the samples in the functional volume
+        reg = np.eye(4)
+        reg[0, 3] = 2
+        mask = maskfactory.project_label(label_file, surf_temp % "white",
+                                         surf_temp % "pial", reg,
+                                         epi_img, ["frac", "0", "0", "0"])
+        yield assert_equal, np.argwhere(mask).tolist(), [[1, 0, 0], [3, 2, 2]]
+
+        yield (assert_raises, ValueError, maskfactory.project_label,
+               label_file, surf_temp % "white", surf_temp % "pial",
+               np.eye(4), epi_img, ["abs", "0", "1", ".5"])
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def add_surface_subject(project, subj):
+    """Give a subject surfaces, labels, and an identity registration."""
+    project.add_subject(subj)
+    preproc_dir = op.join(project.test_dir, "exp", subj, "preproc", "run_1")
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 4)), np.diag([2, 2, 2, 1])),
+             op.join(preproc_dir, "mean_func.nii.gz"))
+    with open(op.join(preproc_dir, "func2anat_tkreg.dat"), "w") as fid:
+        fid.write("%s\n2\n2\n0.15\n" % subj)
+        fid.write("\n".join(["1 0 0 0", "0 1 0 0", "0 0 1 0", "0 0 0 1"]))
+        fid.write("\nround\n")
+    write_surface_data(project.test_dir, subj, "lh")
+    write_surface_data(project.test_dir, subj, "rh", offset=2)
+
+
+def test_from_native_label():
+
+    project = ProjectFixture()
+    try:
+        add_surface_subject(project, "s1")
+
+        label_temp = op.join(project.test_dir, "%(subj)s", "label",
+                             "%(hemi)s.test.label")
+        factory = maskfactory.MaskFactory(["s1"], None, "test",
+                                          "native_label", n_procs=1,
+                                          native_projection=True)
+        proj_args = ["frac", "0", "0", "0"]
+        factory.from_native_label(label_temp, ["lh", "rh"], proj_args)
+
+        img = nib.load(project.mask_temp % ("s1", "test"))
+        yield assert_equal, np.argwhere(img.get_data()).tolist(), \
+            [[0, 0, 0], [1, 0, 0], [2, 2, 2], [3, 2, 2]]
+
+        factory.from_native_label(label_temp, ["lh", "rh"], proj_args)
+        yield assert_equal, factory.updated_subjects, []
+
+        # The projection mode and the surfaces are part of the fingerprint
+        params = ["from_native_label", (["lh", "rh"], proj_args), {}]
+        fingerprint, inputs = factory._mask_fingerprint("s1", [label_temp],
+                                                        params)
+        white_file = factory.surf_template % dict(subj="s1", hemi="lh",
+                                                  surf="white")
+        yield assert_true, white_file in inputs
+        factory.native_projection = False
+        yield (assert_true, factory._mask_fingerprint("s1", [label_temp],
+                                                      params)[0]
+               != fingerprint)
+        factory.native_projection = True
+        os.utime(white_file, (0, 0))
+        factory.from_native_label(label_temp, ["lh", "rh"], proj_args)
+        yield assert_equal, factory.updated_subjects, ["s1"]
+    finally:
+        project.close()
+
+
+def test_stream():
+
+    project = ProjectFixture()
+    try:
+        for subj in ["s1", "s2", "s3"]:
+            project.add_subject(subj)
+        factory = maskfactory.MaskFactory(["s1", "s2", "s3"], None, "test",
+                                          "stat_volume", n_procs=2)
+        scratch = {}
+
+        def process(factory):
+            subj, = factory.subject_list
+            scratch[subj] = factory.temp_dir
+            open(op.join(factory.temp_dir, "hires.nii.gz"), "w").close()
+            if subj == "s2":
+                raise IOError("no hires image")
+
+        failures = []
+        try:
+            factory._stream(process)
+        except maskfactory.CommandError as err:
+            failures = err.failures
+        yield assert_equal, len(failures), 1
+        yield assert_equal, failures[0]["args"], dict(subj="s2")
+
+        # Every subject had its own scratch, removed when it finished
+        yield assert_equal, sorted(scratch), ["s1", "s2", "s3"]
+        yield assert_equal, len(set(scratch.values())), 3
+        yield assert_true, not any(op.exists(d) for d in scratch.values())
+
+        temp_dir = factory.temp_dir
+        factory.cleanup()
+        yield assert_true, not op.exists(temp_dir)
+
+        ram_dir = maskfactory.ram_scratch_dir()
+        if ram_dir is not None:
+            factory = maskfactory.MaskFactory(["s1"], None, "test",
+                                              "stat_volume", n_procs=1,
+                                              scratch_dir="ram")
+            yield assert_equal, op.dirname(factory.temp_dir), ram_dir
+            factory.cleanup()
+    finally:
+        project.close()
+
+
+def test_mask_statistics():
+
+    stats = maskfactory.MaskStatistics()
+    mask = np.array([1, 1, 1, 0], bool)
+    func_mask = np.array([0, 1, 1, 1], bool)
+    stats.add("s1", "roi", mask, (2, 2, 2), func_mask)
+    row = stats.rows["s1", "roi"]
+    yield assert_equal, row["voxels"], 3
+    yield assert_equal, row["volume_mm3"], 24
+    yield assert_equal, row["func_mask_voxels"], 2
+    yield assert_equal, row["func_mask_fraction"], 2 / 3.
+    yield assert_true, np.isnan(row["mni_dice"])
+
+    masks = np.array([[1, 1, 0, 0, 0],
+                      [0, 1, 1, 0, 0],
+                      [1, 1, 0, 0, 0]], bool)
+    prob = stats.add_mni_overlap("roi", ["s1", "s2", "s3"], masks)
+    yield assert_equal, prob.tolist(), [2 / 3., 1, 1 / 3., 0, 0]
+    yield assert_equal, row["mni_voxels"], 2
+    yield assert_equal, row["mni_dice"], (.5 + 1) / 2
+    yield assert_equal, stats.rows["s2", "roi"]["mni_dice"], .5
+    yield assert_equal, row["voxels"], 3
+
+
+def test_write_stats():
+
+    project = ProjectFixture()
+    try:
+        for subj in ["s1", "s2"]:
+            project.add_subject(subj)
+        func_mask = np.array([0, 0, 0, 0, 1, 1]).reshape(1, 2, 3)
+        mask_file = op.join(project.test_dir, "exp", "s1", "preproc",
+                            "run_1", "functional_mask.nii.gz")
+        nib.save(nib.Nifti1Image(func_mask, np.diag([2, 2, 2, 1])),
+                 mask_file)
+
+        factory = maskfactory.MaskFactory(["s1"], None, "stat",
+                                          "stat_volume", n_procs=1)
+        factory.from_statistical_file(project.stat_temp, "3")
+        yield assert_equal, factory.stats.rows["s1", "stat"]["voxels"], 3
+
+        # Current masks are loaded to complete the table
+        factory = maskfactory.MaskFactory(["s1", "s2"], None, "stat",
+                                          "stat_volume", n_procs=1)
+        factory.from_statistical_file(project.stat_temp, "3")
+        yield assert_equal, sorted(factory.stats.rows), [("s2", "stat")]
+
+        stats_file = op.join(project.test_dir, "stats.csv")
+        factory.write_stats(stats_file)
+        with open(stats_file) as fid:
+            rows = list(csv.DictReader(fid))
+        yield assert_equal, [r["subject"] for r in rows], ["s1", "s2"]
+        yield assert_equal, [r["voxels"] for r in rows], ["3", "3"]
+        yield assert_equal, rows[0]["volume_mm3"], "24.0"
+        yield assert_equal, rows[0]["func_mask_voxels"], "2"
+        yield assert_equal, rows[1]["func_mask_voxels"], "nan"
+    finally:
+        project.close()
+
+
+def test_roi_table_native_projection():
+
+    project = ProjectFixture()
+    path = os.environ["PATH"]
+    try:
+        add_surface_subject(project, "s1")
+        write_surface_data(project.test_dir, "fsaverage", "lh")
+        write_surface_data(project.test_dir, "fsaverage", "rh", offset=2)
+
+        # Stand in for mri_label2label; the test surfaces share vertices
+        bin_dir = op.join(project.test_dir, "bin")
+        os.makedirs(bin_dir)
+        script = op.join(bin_dir, "mri_label2label")
+        with open(script, "w") as fid:
+            fid.write("#! /bin/sh\n"
+                      "while [ $# -gt 0 ]; do\n"
+                      "  case $1 in --srclabel) src=$2;; "
+                      "--trglabel) trg=$2;; esac\n"
+                      "  shift\n"
+                      "done\n"
+                      "cp $src $trg\n")
+        os.chmod(script, 0o755)
+        os.environ["PATH"] = bin_dir + os.pathsep + path
+
+        table = op.join(project.test_dir, "rois.csv")
+        with open(table, "w") as fid:
+            fid.write("roi,type,source,hemi,param\n")
+            fid.write("test,fsaverage_label,test,,frac 0 0 0\n")
+
+        factory = maskfactory.MaskFactory(["s1"], None, "atlas",
+                                          "roi_table", n_procs=1,
+                                          native_projection=True)
+        factory.from_roi_table(table)
+        img = nib.load(project.mask_temp % ("s1", "test"))
+        yield assert_equal, np.argwhere(img.get_data()).tolist(), \
+            [[0, 0, 0], [1, 0, 0], [2, 2, 2], [3, 2, 2]]
+    finally:
+        os.environ["PATH"] = path
+        project.close()
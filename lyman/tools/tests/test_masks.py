@@ -0,0 +1,205 @@
+import os
+import json
+import shutil
+import os.path as op
+from tempfile import mkdtemp
+import numpy as np
+import nibabel as nib
+from nipype.testing import assert_equal, assert_true, assert_raises
+
+from .. import masks
+
+
+def write_mask(data_dir, subj, name, data):
+    mask_dir = op.join(data_dir, subj, "masks")
+    try:
+        os.makedirs(mask_dir)
+    except OSError:
+        pass
+    img = nib.Nifti1Image(data.astype(np.uint8), np.diag([2, 2, 2, 1]))
+    nib.save(img, op.join(mask_dir, name + ".nii.gz"))
+
+
+def make_data_dir():
+
+    data_dir = mkdtemp()
+    rs = np.random.RandomState(0)
+    for subj in ["s1", "s2", "s3"]:
+        write_mask(data_dir, subj, "ifs", rs.rand(4, 5, 6) > .5)
+    write_mask(data_dir, "s1", "ppa", rs.rand(4, 5, 6) > .8)
+    os.makedirs(op.join(data_dir, "s4", "masks"))
+    return data_dir
+
+
+def test_index():
+
+    data_dir = make_data_dir()
+    try:
+        registry = masks.MaskRegistry(data_dir)
+        yield assert_equal, registry.names(), ["ifs", "ppa"]
+        yield assert_equal, registry.subjects("ppa"), ["s1"]
+        yield assert_equal, registry.names(["s2"]), ["ifs"]
+
+        found, missing = registry.query("ifs", ["s3", "s4", "s5", "s1"])
+        yield assert_equal, found, ["s3", "s1"]
+        yield assert_equal, missing, ["s4", "s5"]
+        yield assert_raises, IOError, registry.require, "ppa", ["s1", "s2"]
+        yield assert_raises, IOError, registry.mtime, "s2", "ppa"
+
+        fname = registry.mask_file("s1", "ifs")
+        yield assert_equal, registry.mtime("s1", "ifs"), op.getmtime(fname)
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_load():
+
+    data_dir = make_data_dir()
+    try:
+        registry = masks.MaskRegistry(data_dir, cache_size=2)
+        fname = registry.mask_file("s2", "ifs")
+        img = nib.load(fname)
+        want = img.get_data().astype(bool)
+
+        mask = registry.get("s2", "ifs")
+        yield assert_equal, mask.shape, (4, 5, 6)
+        yield assert_true, np.array_equal(mask.affine, img.get_affine())
+        yield assert_equal, len(mask), want.sum()
+        yield assert_equal, mask.name, "ifs"
+        yield assert_true, np.array_equal(registry.load("s2", "ifs"), want)
+
+        # Indices select voxels in the same order as the boolean mask
+        data = np.random.RandomState(1).rand(4, 5, 6, 3)
+        coords = np.unravel_index(mask.indices, mask.shape)
+        yield assert_true, np.array_equal(data[coords], data[want])
+
+        # Repeated loads come from the cache, dropping the oldest masks
+        yield assert_true, registry.get("s2", "ifs") is mask
+        registry.get("s1", "ifs")
+        registry.get("s3", "ifs")
+        yield assert_equal, sorted(registry._cache), [("s1", "ifs"),
+                                                      ("s3", "ifs")]
+        yield assert_true, registry.get("s2", "ifs") is not mask
+
+        # Rewritten and new masks are seen without rescanning
+        write_mask(data_dir, "s2", "ifs", np.ones((4, 5, 6)))
+        os.utime(fname, (0, 0))
+        yield assert_equal, registry.mtime("s2", "ifs"), 0
+        yield assert_equal, len(registry.get("s2", "ifs")), 120
+        write_mask(data_dir, "s2", "ppa", np.ones((4, 5, 6)))
+        yield assert_equal, len(registry.get("s2", "ppa")), 120
+        yield assert_equal, registry.names(["s2"]), ["ifs", "ppa"]
+        os.remove(fname)
+        yield assert_raises, IOError, registry.get, "s2", "ifs"
+        yield assert_equal, registry.names(["s2"]), ["ppa"]
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_voxel_counts():
+
+    data_dir = make_data_dir()
+    try:
+        # Loading a mask does not write the index until it is flushed
+        index_file = op.join(data_dir, masks.index_fname)
+        registry = masks.MaskRegistry(data_dir)
+        registry.get("s3", "ifs")
+        yield assert_true, not op.exists(index_file)
+        registry.flush()
+        yield assert_true, op.exists(index_file)
+
+        counts = registry.counts("ifs", ["s1", "s2", "s4"])
+        yield assert_equal, sorted(counts), ["s1", "s2"]
+        want = nib.load(registry.mask_file("s1", "ifs")).get_data().sum()
+        yield assert_equal, counts["s1"], want
+
+        # Counts persist in the index file and are used without loading
+        with open(index_file) as fid:
+            index = json.load(fid)
+        yield assert_equal, index["s1/ifs"][2], want
+        registry = masks.MaskRegistry(data_dir)
+        yield assert_equal, registry.voxel_count("s1", "ifs"), want
+        yield assert_equal, registry._cache, {}
+
+        registry = masks.MaskRegistry(data_dir, index_file=None)
+        yield assert_equal, registry.voxel_count("s1", "ifs"), want
+        yield assert_equal, len(registry._cache), 1
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_get_registry():
+
+    data_dir = make_data_dir()
+    try:
+        registry = masks.get_registry(data_dir)
+        yield assert_true, masks.get_registry(data_dir + "/") is registry
+    finally:
+        masks._registries.clear()
+        shutil.rmtree(data_dir)
+
+
+def test_mask_gather_scatter():
+
+    rs = np.random.RandomState(0)
+    want = rs.rand(4, 5, 6) > .5
+    mask = masks.Mask.from_array(want, np.eye(4), "roi")
+    yield assert_equal, len(mask), want.sum()
+    yield assert_true, np.array_equal(mask.to_array(), want)
+    yield assert_true, masks.as_mask(mask) is mask
+    yield assert_equal, masks.as_mask(want), mask
+    yield assert_raises, ValueError, masks.as_mask, want.astype(float)
+
+    data = rs.randn(4, 5, 6, 3)
+    values = mask.gather(data)
+    yield assert_true, np.array_equal(values, data[want])
+    yield assert_raises, ValueError, mask.gather, data[1:]
+
+    out = mask.scatter(values, np.nan)
+    yield assert_equal, out.shape, data.shape
+    yield assert_true, np.array_equal(out[want], data[want])
+    yield assert_true, np.isnan(out[~want]).all()
+    yield assert_raises, ValueError, mask.scatter, values[1:]
+
+
+def test_mask_sets():
+
+    a = masks.Mask([5, 1, 3, 3], (2, 3, 4))
+    b = masks.Mask([3, 4, 5, 23], (2, 3, 4))
+    yield assert_equal, a.indices.tolist(), [1, 3, 5]
+    yield assert_equal, (a | b).indices.tolist(), [1, 3, 4, 5, 23]
+    yield assert_equal, (a & b).indices.tolist(), [3, 5]
+    yield assert_equal, (a - b).indices.tolist(), [1]
+    yield assert_raises, ValueError, a.union, masks.Mask([1], (3, 3, 3))
+
+    # Set operations agree with the boolean volumes
+    yield (assert_true, np.array_equal((a & b).to_array(),
+                                       a.to_array() & b.to_array()))
+
+
+def test_mask_files():
+
+    test_dir = mkdtemp()
+    try:
+        rs = np.random.RandomState(0)
+        mask = masks.Mask.from_array(rs.rand(4, 5, 6) > .5,
+                                     np.diag([2, 2, 2, 1]))
+
+        fname = op.join(test_dir, "mask.npz")
+        mask.save(fname)
+        mask_ = masks.Mask.from_file(fname)
+        yield assert_equal, mask_, mask
+        yield assert_true, np.array_equal(mask_.affine, mask.affine)
+
+        mask = masks.Mask(mask.indices, mask.shape)
+        mask.save(fname)
+        yield assert_equal, masks.Mask.from_file(fname).affine, None
+
+        fname = op.join(test_dir, "mask.nii.gz")
+        mask.to_image().to_filename(fname)
+        mask_ = masks.Mask.from_file(fname, "roi")
+        yield assert_equal, mask_, mask
+        yield assert_equal, mask_.name, "roi"
+        yield assert_equal, mask_.digest(), mask.digest()
+    finally:
+        shutil.rmtree(test_dir)
@@ -0,0 +1,111 @@
+import csv
+import json
+import shutil
+import os.path as op
+from tempfile import mkdtemp
+from argparse import Namespace
+from nipype.testing import assert_equal, assert_true
+
+from nipype.pipeline.engine import Workflow, Node
+from nipype.interfaces.utility import Function
+
+from .. import main, profiling
+from .workflows import add_one, make_workflow
+
+
+def check_profile(profile_dir, n_rows):
+
+    csv_file = op.join(profile_dir, "test_profile.csv")
+    with open(csv_file) as fid:
+        rows = list(csv.DictReader(fid))
+    yield assert_equal, len(rows), n_rows
+    yield assert_equal, set(r["status"] for r in rows), set(["ok"])
+    yield assert_true, all(float(r["wall_time"]) >= 0 for r in rows)
+    yield assert_true, all(float(r["cpu_time"]) >= 0 for r in rows)
+    yield assert_true, all(float(r["peak_rss_mb"]) >= 0 for r in rows)
+
+    with open(op.join(profile_dir, "test_profile.json")) as fid:
+        summary = json.load(fid)
+    yield assert_equal, summary["n_nodes"], n_rows
+    yield assert_equal, summary["n_crashed"], 0
+    path = [step["node"] for step in summary["critical_path"]]
+    yield assert_equal, path, ["test.node1", "test.node2"]
+    yield assert_true, summary["by_interface"]["Function"]["n_nodes"] > 0
+
+
+def test_profile_linear():
+
+    test_dir = mkdtemp()
+    try:
+        wf, _, _ = make_workflow(test_dir, [1, 2])
+        profile_dir = op.join(test_dir, "profile")
+        args = Namespace(plugin="linear", queue=None, workflows=None,
+                         profile=profile_dir)
+        main.run_workflow(wf, args=args)
+
+        # The Linear plugin runs MapNode iterations inside the MapNode
+        for test in check_profile(profile_dir, 2):
+            yield test
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_profile_multiproc():
+
+    test_dir = mkdtemp()
+    try:
+        wf, _, _ = make_workflow(test_dir, [1, 2])
+        profile_dir = op.join(test_dir, "profile")
+        args = Namespace(plugin="multiproc", queue=None, workflows=None,
+                         nprocs=2, memory=None, profile=profile_dir)
+        main.run_workflow(wf, args=args)
+
+        # Two MapNode iterations, the MapNode itself, and node2
+        for test in check_profile(profile_dir, 4):
+            yield test
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def allocate(mb):
+    import time
+    import numpy as np
+    data = np.ones(mb * 1024 ** 2 // 8)
+    time.sleep(.5)
+    return data.size
+
+
+def test_peak_memory_per_node():
+
+    test_dir = mkdtemp()
+    try:
+        wf = Workflow(name="memory", base_dir=test_dir)
+        big = Node(Function(["mb"], ["x"], allocate), name="big")
+        big.inputs.mb = 200
+        small = Node(Function(["x"], ["x"], add_one), name="small")
+        wf.connect(big, "x", small, "x")
+
+        profiler = profiling.WorkflowProfiler(in_process=True)
+        wf.run("Linear", plugin_args=dict(status_callback=profiler))
+        peaks = dict((r["node"], r["peak_rss_mb"])
+                     for r in profiler.records.values())
+
+        # A small node after a large one is not charged with its peak
+        yield assert_true, peaks["memory.big"] > 150
+        yield assert_true, peaks["memory.small"] < 50
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_file_megabytes():
+
+    test_dir = mkdtemp()
+    try:
+        fname = op.join(test_dir, "data.bin")
+        with open(fname, "wb") as fid:
+            fid.write("\0" * 1024 ** 2)
+        size = profiling._file_megabytes(dict(a=[fname, fname], b=3,
+                                              c="not a file"))
+        yield assert_equal, size, 2.
+    finally:
+        shutil.rmtree(test_dir)
@@ -0,0 +1,125 @@
+import os
+import shutil
+import os.path as op
+from tempfile import mkdtemp
+from argparse import Namespace
+from nipype.testing import assert_equal, assert_true
+
+from .. import main, provenance
+from .workflows import make_subject_workflow
+
+
+def make_stage(test_dir, subjects):
+
+    wf, subj_source = make_subject_workflow(test_dir, subjects)
+    anal_dir = op.join(test_dir, "analysis")
+    store = provenance.ProvenanceStore(op.join(anal_dir, ".provenance"))
+    stage = store.stage("exp/prov", dict(a=1),
+                        [op.join(test_dir, "data", "%s.txt")],
+                        op.join(anal_dir, "%s", "prov"))
+
+    return wf, subj_source, stage
+
+
+def test_store():
+
+    test_dir = mkdtemp()
+    try:
+        store = provenance.ProvenanceStore(test_dir)
+        yield assert_equal, store.load("exp/preproc", "s1"), None
+        store.save("exp/preproc", "s1", dict(fingerprint="abc"))
+        yield assert_equal, store.load("exp/preproc", "s1"), \
+            dict(fingerprint="abc")
+        yield assert_equal, os.listdir(op.join(test_dir, "exp", "preproc")), \
+            ["s1.json"]
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_subject_glob():
+
+    glob = provenance._subject_glob("%s/bold/scan??.nii.gz", "s1")
+    yield assert_equal, glob, "s1/bold/scan??.nii.gz"
+
+    glob = provenance._subject_glob("%(subject_id)s/r%(run)d_%(event)s.txt",
+                                    "s1")
+    yield assert_equal, glob, "s1/r*_*.txt"
+
+
+def test_incremental_run():
+
+    test_dir = mkdtemp()
+    try:
+        os.makedirs(op.join(test_dir, "data"))
+        for subj in ["s1", "s2", "s3"]:
+            with open(op.join(test_dir, "data", subj + ".txt"), "w") as fid:
+                fid.write(subj)
+
+        args = Namespace(plugin="linear", queue=None, workflows=None)
+        out_temp = op.join(test_dir, "analysis", "%s", "prov", "out.txt")
+
+        # Initial run covers both subjects
+        wf, subj_source, stage = make_stage(test_dir, ["s1", "s2"])
+        yield assert_equal, stage.outdated(["s1", "s2"]), ["s1", "s2"]
+        main.run_workflow(wf, args=args, stage=stage, subj_source=subj_source)
+        yield assert_equal, open(out_temp % "s2").read(), "S2"
+        yield assert_equal, stage.outdated(["s1", "s2"]), []
+        yield assert_equal, subj_source.iterables[1], ["s1", "s2"]
+
+        # Nothing to do on a rerun, even without the working directory
+        shutil.rmtree(op.join(test_dir, "work"))
+        wf, subj_source, stage = make_stage(test_dir, ["s1", "s2"])
+        graph = main.run_workflow(wf, args=args, stage=stage,
+                                  subj_source=subj_source)
+        yield assert_equal, graph, None
+
+        # Adding a subject only runs that subject
+        wf, subj_source, stage = make_stage(test_dir, ["s1", "s2", "s3"])
+        yield assert_equal, stage.outdated(["s1", "s2", "s3"]), ["s3"]
+        s1_mtime = op.getmtime(out_temp % "s1")
+        main.run_workflow(wf, args=args, stage=stage, subj_source=subj_source)
+        yield assert_true, op.exists(out_temp % "s3")
+        yield assert_equal, op.getmtime(out_temp % "s1"), s1_mtime
+
+        # Changed inputs or removed outputs make a subject outdated
+        with open(op.join(test_dir, "data", "s1.txt"), "w") as fid:
+            fid.write("s1 again")
+        os.remove(out_temp % "s2")
+        yield assert_equal, stage.outdated(["s1", "s2", "s3"]), ["s1", "s2"]
+
+        # As do changed parameters
+        stage.params = dict(a=2)
+        yield assert_equal, stage.outdated(["s3"]), ["s3"]
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_output_filter():
+
+    test_dir = mkdtemp()
+    try:
+        out_dir = op.join(test_dir, "s1", "reg", "run_1")
+        os.makedirs(out_dir)
+        for fname in ["cope1.nii.gz", "timeseries_xfm.nii.gz"]:
+            open(op.join(out_dir, fname), "w").close()
+
+        store = provenance.ProvenanceStore(op.join(test_dir, ".provenance"))
+        out_temp = op.join(test_dir, "%s", "reg")
+        model = store.stage("exp/reg/model", {}, (), out_temp,
+                            output_filter=(None, "*timeseries*"))
+        series = store.stage("exp/reg/timeseries", {}, (), out_temp,
+                             output_filter=("*timeseries*", None))
+        yield (assert_equal, [op.basename(f) for f in model.outputs("s1")],
+               ["cope1.nii.gz"])
+        yield (assert_equal, [op.basename(f) for f in series.outputs("s1")],
+               ["timeseries_xfm.nii.gz"])
+
+        # Removing one kind of output only outdates the stage that owns it
+        for stage in model, series:
+            stage.sunk.add("s1")
+            stage.record(["s1"])
+        os.remove(op.join(out_dir, "timeseries_xfm.nii.gz"))
+        yield assert_equal, model.outdated(["s1"]), []
+        yield assert_equal, series.outdated(["s1"]), ["s1"]
+    finally:
+        shutil.rmtree(test_dir)
@@ -0,0 +1,111 @@
+import os
+import shutil
+import os.path as op
+from tempfile import mkdtemp
+from nose.tools import assert_equal, assert_not_equal, assert_true
+
+from nipype.pipeline.engine import Workflow, Node, MapNode
+from nipype.interfaces.utility import Function
+
+from .. import reports
+from .workflows import add_one
+
+template = """\
+Test Report
+===========
+
+**Subject:** %(subject_id)s
+
+.. image:: %(image)s
+"""
+
+
+def test_deferred_report():
+
+    test_dir = mkdtemp()
+    orig_dir = os.getcwd()
+    try:
+        os.chdir(test_dir)
+        image = op.join(test_dir, "image.png")
+        with open(image, "wb") as f:
+            f.write("not really a png")
+
+        report_dict = dict(subject_id="subj01", image=image)
+        rst_file, html_file = reports.write_workflow_report("test",
+                                                            template,
+                                                            report_dict,
+                                                            defer_pdf=True)
+        yield assert_equal, rst_file, op.join(test_dir, "test_report.rst")
+        yield assert_true, op.exists(html_file)
+        yield assert_true, "subj01" in open(html_file).read()
+        yield assert_true, ".. image:: image.png" in open(rst_file).read()
+
+        found = reports.find_deferred_reports(test_dir)
+        yield assert_equal, found, [rst_file]
+    finally:
+        os.chdir(orig_dir)
+        shutil.rmtree(test_dir)
+
+
+def write_report(x, defer_pdf=False):
+    return x
+
+
+def test_set_pdf_deferral():
+
+    wf = Workflow(name="test")
+    report = MapNode(Function(["x", "defer_pdf"], ["x"], write_report),
+                     iterfield=["x"], name="report")
+    report.inputs.x = [1, 2]
+    inner = Workflow(name="inner")
+    other = Node(Function(["x"], ["x"], add_one), name="other")
+    inner.add_nodes([other])
+    wf.add_nodes([report, inner])
+
+    reports.set_pdf_deferral(wf, True)
+    yield assert_equal, report.inputs.defer_pdf, True
+    yield assert_true, not hasattr(other.inputs, "defer_pdf")
+
+    # The setting is part of the node hash, so a cached report reruns
+    hashval = report.inputs.get_hashval()[1]
+    reports.set_pdf_deferral(wf, False)
+    yield assert_not_equal, report.inputs.get_hashval()[1], hashval
+
+
+def test_report_hash():
+
+    test_dir = mkdtemp()
+    try:
+        rst_file = op.join(test_dir, "test_report.rst")
+        with open(rst_file, "w") as f:
+            f.write(template % dict(subject_id="subj01", image="image.png"))
+        image = op.join(test_dir, "image.png")
+        with open(image, "wb") as f:
+            f.write("first image")
+
+        hash_1 = reports.report_hash(rst_file)
+        yield assert_equal, hash_1, reports.report_hash(rst_file)
+
+        with open(image, "wb") as f:
+            f.write("second image")
+        yield assert_not_equal, hash_1, reports.report_hash(rst_file)
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_html_skip_current():
+
+    test_dir = mkdtemp()
+    try:
+        rst_file = op.join(test_dir, "test_report.rst")
+        html_file = op.join(test_dir, "test_report.html")
+        with open(rst_file, "w") as f:
+            f.write(template % dict(subject_id="subj01", image="image.png"))
+
+        reports.render_html(rst_file, html_file)
+        with open(html_file, "w") as f:
+            f.write("sentinel")
+        reports.render_html(rst_file, html_file)
+        yield assert_equal, open(html_file).read(), "sentinel"
+    finally:
+        shutil.rmtree(test_dir)
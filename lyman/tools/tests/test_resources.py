@@ -0,0 +1,131 @@
+import shutil
+from tempfile import mkdtemp
+import numpy as np
+import scipy.sparse as ssp
+from nipype.testing import assert_equal, assert_true
+
+from nipype.pipeline.engine import Node
+from nipype.interfaces.utility import IdentityInterface, Function
+from nipype.interfaces import fsl
+
+from .. import resources
+from .workflows import add_one, make_workflow
+
+
+def test_host_resources():
+
+    n_cores, mem_gb = resources.host_resources()
+    yield assert_true, n_cores >= 1
+    yield assert_true, mem_gb is None or mem_gb > 0
+
+    n_procs, memory_gb = resources.plan_resources(3, 2.)
+    yield assert_equal, (n_procs, memory_gb), (3, 2.)
+
+
+def test_node_memory():
+
+    wf, node1, node2 = make_workflow()
+    yield assert_equal, resources.node_memory(node1), 1.
+    node3 = Node(IdentityInterface(fields=["x"]), name="node3")
+    yield (assert_equal, resources.node_memory(node3),
+           resources.default_memory)
+
+    fnirt = Node(fsl.FNIRT(), name="fnirt")
+    yield assert_equal, resources.node_memory(fnirt), 4.
+
+
+def test_request_node_memory():
+
+    wf, node1, node2 = make_workflow()
+    node2.plugin_args = dict(qsub_args="-l mem=100mb")
+    resources.request_node_memory(wf, "SGE")
+    yield assert_equal, node1.plugin_args["qsub_args"], "-l h_vmem=1.0G"
+    yield assert_equal, node2.plugin_args["qsub_args"], "-l mem=100mb"
+
+    wf, node1, node2 = make_workflow()
+    resources.request_node_memory(wf, "PBS")
+    yield assert_equal, node1.plugin_args["qsub_args"], "-l mem=1024mb"
+
+
+class RecordingPlugin(resources.ResourceMultiProcPlugin):
+    """Keep the largest amount of memory in use at any one time."""
+    peak_gb = 0
+
+    def _submit_job(self, node, updatehash=False):
+        taskid = super(RecordingPlugin, self)._submit_job(node, updatehash)
+        self.peak_gb = max(self.peak_gb, self._memory_used())
+        return taskid
+
+
+def test_resource_multiproc():
+
+    wf, node1, node2 = make_workflow(mkdtemp())
+    try:
+        started = []
+
+        def callback(node, status):
+            if status == "start":
+                started.append(node.fullname)
+
+        # The budget only fits one subnode at a time
+        plugin = RecordingPlugin(dict(n_procs=4, memory_gb=1.5,
+                                      max_jobs=3,
+                                      status_callback=callback))
+        graph = wf.run(plugin)
+        node = [n for n in graph.nodes() if n.name == "node2"][0]
+        yield assert_equal, node.result.outputs.x, 9
+        yield assert_equal, plugin.peak_gb, 1.
+        yield assert_equal, plugin._task_memory, {}
+        yield assert_equal, plugin.max_jobs, 3
+
+        # Nodes that had to wait were not reported as started
+        yield assert_equal, len(started), len(set(started))
+    finally:
+        shutil.rmtree(wf.base_dir)
+
+
+class SmallFunction(Function):
+    """Function interface with the default (smaller) memory estimate."""
+
+
+class DryRunPlugin(resources.ResourceMultiProcPlugin):
+    """Record submissions instead of sending them to the pool."""
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        self._task_memory[self._taskid] = resources.node_memory(node)
+        self.submitted.append(node.name)
+        return self._taskid
+
+
+def test_reserve_for_oldest():
+
+    procs = []
+    for name, interface in [("big1", Function), ("big2", Function),
+                            ("small1", SmallFunction),
+                            ("small2", SmallFunction)]:
+        node = Node(interface(["x"], ["x"], add_one), name=name)
+        node.config = dict(execution=dict(local_hash_check="false"))
+        procs.append(node)
+
+    plugin = DryRunPlugin(dict(n_procs=4, memory_gb=1.5))
+    plugin.procs = procs
+    plugin.depidx = ssp.lil_matrix((4, 4))
+    plugin.proc_done = np.zeros(4, bool)
+    plugin.proc_pending = np.zeros(4, bool)
+    plugin.pending_tasks, plugin.mapnodes, plugin.mapnodesubids = [], [], {}
+    plugin.submitted = []
+
+    # big2 waits for room, and the small nodes may not take it meanwhile
+    plugin._send_procs_to_workers()
+    yield assert_equal, plugin.submitted, ["big1"]
+    yield assert_true, not plugin.proc_done[1:].any()
+
+    # Once big1 is done, big2 goes first and a small node fills the rest
+    plugin._task_memory.pop(1)
+    plugin.pending_tasks = []
+    plugin._send_procs_to_workers()
+    yield assert_equal, plugin.submitted, ["big1", "big2", "small1"]
+
+    # A node larger than the whole budget runs when nothing else is
+    yield assert_true, plugin._fits(8., 0., 0)
+    yield assert_true, not plugin._fits(.5, 0., 4)
@@ -0,0 +1,53 @@
+"""Small nipype workflows shared by the execution tests."""
+import os.path as op
+
+from nipype.pipeline.engine import Workflow, Node, MapNode
+from nipype.interfaces.utility import Function
+
+from .. import main
+
+
+def add_one(x):
+    return x + 1
+
+
+def total(x):
+    return sum(x)
+
+
+def make_workflow(base_dir=None, inputs=(1, 2, 3)):
+    """Add one to each input in a MapNode and sum the results."""
+    wf = Workflow(name="test", base_dir=base_dir)
+    node1 = MapNode(Function(["x"], ["x"], add_one),
+                    iterfield=["x"], name="node1")
+    node1.inputs.x = list(inputs)
+    node2 = Node(Function(["x"], ["x"], total), name="node2")
+    wf.connect(node1, "x", node2, "x")
+    return wf, node1, node2
+
+
+def write_output(subject_id, in_dir):
+    import os.path as op
+    with open(op.join(in_dir, subject_id + ".txt")) as fid:
+        text = fid.read()
+    out_file = op.abspath("out.txt")
+    with open(out_file, "w") as fid:
+        fid.write(text.upper())
+    return out_file
+
+
+def make_subject_workflow(test_dir, subjects):
+    """Uppercase <test_dir>/data/<subj>.txt into analysis/<subj>/prov."""
+    in_dir = op.join(test_dir, "data")
+    anal_dir = op.join(test_dir, "analysis")
+
+    subj_source = main.make_subject_source(subjects)
+    wf = Workflow(name="prov", base_dir=op.join(test_dir, "work"))
+    node = Node(Function(["subject_id", "in_dir"], ["out_file"],
+                         write_output), name="write")
+    node.inputs.in_dir = in_dir
+    sink = Node(main.DataSink(base_directory=anal_dir), name="sink")
+    wf.connect([(subj_source, node, [("subject_id", "subject_id")]),
+                (node, sink, [("out_file", "prov.@out")])])
+    main.OutputWrapper(wf, subj_source, sink, None).set_subject_container()
+    return wf, subj_source
@@ -1,7 +1,12 @@
-from preproc import create_preprocessing_workflow
-from model import create_timeseries_model_workflow
-from registration import (create_mni_reg_workflow,
-                          create_epi_reg_workflow,
-                          spaces)
-from fixedfx import (create_volume_ffx_workflow)
-from mixedfx import (create_volume_mixedfx_workflow)
+from ..tools.lazy import lazy_package
+
+# Available registration spaces; defined here so the command-line
+# parsers can list them without importing the workflow modules
+spaces = ["epi", "mni"]
+
+lazy_package(__name__, {"create_preprocessing_workflow": ".preproc",
+                        "create_timeseries_model_workflow": ".model",
+                        "create_mni_reg_workflow": ".registration",
+                        "create_epi_reg_workflow": ".registration",
+                        "create_volume_ffx_workflow": ".fixedfx",
+                        "create_volume_mixedfx_workflow": ".mixedfx"})
@@ -67,7 +67,8 @@ def create_volume_ffx_workflow(name="volume_ffx",
     report = Node(Function(input_names=["subject_id",
                                         "mask_png",
                                         "zstat_pngs",
-                                        "contrast"],
+                                        "contrast",
+                                        "defer_pdf"],
                            output_names=["reports"],
                            function=write_ffx_report),
                   name="report")
@@ -160,30 +161,38 @@ def create_dof_image(copes, dof_files):
 
 
 def create_ffx_mask(masks, background_file):
-    """Create a mask for areas that are nonzero in all masks"""
+    """Create a mask for areas that are nonzero in all masks.
+
+    Masks may be image files or lyman.tools.masks.Mask objects.
+
+    """
     import os
     from os.path import abspath, join
     from nibabel import load, Nifti1Image
-    from numpy import zeros
+    from numpy import bincount, concatenate, prod
     from subprocess import call
+    from lyman.tools.masks import Mask
     from lyman.workflows.fixedfx import force_list
     masks = force_list(masks)
-    mask_imgs = map(load, masks)
-    data_shape = list(mask_imgs[0].shape) + [len(mask_imgs)]
-    mask_data = zeros(data_shape, int)
-    for i, img in enumerate(mask_imgs):
-        data = img.get_data()
-        data[data < 1e-4] = 0
-        mask_data[..., i] = img.get_data()
-
-    out_mask_data = mask_data.all(axis=-1)
-    sum_data = mask_data.astype(bool).sum(axis=-1)
-
-    template_img = load(masks[0])
-    template_affine = template_img.get_affine()
-    template_hdr = template_img.get_header()
-
-    mask_img = Nifti1Image(out_mask_data, template_affine, template_hdr)
+
+    packed, template_hdr = [], None
+    for mask in masks:
+        if not isinstance(mask, Mask):
+            img = load(mask)
+            if template_hdr is None:
+                template_hdr = img.get_header()
+            # Values below 1 are outside, as when the data were cast to int
+            mask = Mask.from_array(img.get_data() >= 1, img.get_affine())
+        packed.append(mask)
+
+    out_mask = reduce(lambda a, b: a & b, packed)
+    shape = out_mask.shape
+    sum_data = bincount(concatenate([m.indices for m in packed]),
+                        minlength=prod(shape)).reshape(shape)
+    template_affine = packed[0].affine
+
+    mask_img = Nifti1Image(out_mask.to_array(), template_affine,
+                           template_hdr)
     mask_file = abspath("fixed_effects_mask.nii.gz")
     mask_img.to_filename(mask_file)
 
@@ -205,7 +214,8 @@ def create_ffx_mask(masks, background_file):
     return mask_file, mask_png
 
 
-def write_ffx_report(subject_id, mask_png, zstat_pngs, contrast):
+def write_ffx_report(subject_id, mask_png, zstat_pngs, contrast,
+                     defer_pdf=False):
     import time
     from lyman.tools import write_workflow_report
     from lyman.workflows.reporting import ffx_report_template
@@ -219,7 +229,7 @@ def write_ffx_report(subject_id, mask_png, zstat_pngs, contrast):
 
     out_files = write_workflow_report("ffx",
                                       ffx_report_template,
-                                      report_dict)
+                                      report_dict, defer_pdf)
     return out_files
 
 def force_list(f):
@@ -1,7 +1,7 @@
 from nipype.interfaces import fsl
 from nipype.interfaces.utility import IdentityInterface, Function
 from nipype.pipeline.engine import Node, MapNode, Workflow
-from .. import tools
+from ..tools.clusters import write_peak_tables
 
 
 def create_volume_mixedfx_workflow(name="volume_group",
@@ -54,7 +54,6 @@ def create_volume_mixedfx_workflow(name="volume_group",
                                   pthreshold=0.05,
                                   out_threshold_file=True,
                                   out_index_file=True,
-                                  out_localmax_txt_file=True,
                                   use_mm=True),
                       iterfield=["in_file", "dlh", "volume"],
                       name="cluster")
@@ -70,18 +69,18 @@ def create_volume_mixedfx_workflow(name="volume_group",
                      name="slicer")
     slicer.inputs.sample_axial = 2
 
-    boxplot = MapNode(Function(input_names=["cope_file", "localmax_file"],
+    peaktable = MapNode(Function(input_names=["zstat_file"],
+                                 output_names=["rst_file", "csv_file"],
+                                 function=write_peak_tables),
+                        iterfield=["zstat_file"],
+                        name="peaktable")
+
+    boxplot = MapNode(Function(input_names=["cope_file", "peak_file"],
                                output_names=["out_file"],
                                function=mfx_boxplot),
-                      iterfield=["localmax_file"],
+                      iterfield=["peak_file"],
                       name="boxplot")
 
-    peaktable = MapNode(Function(input_names=["localmax_file"],
-                                 output_names=["out_file"],
-                                 function=tools.cluster_to_rst),
-                        iterfield=["localmax_file"],
-                        name="peaktable")
-
     # Build pdf and html reports
     report = Node(Function(input_names=["subject_list",
                                         "l1_contrast",
@@ -89,7 +88,8 @@ def create_volume_mixedfx_workflow(name="volume_group",
                                         "boxplots",
                                         "peak_tables",
                                         "mask_png",
-                                        "contrasts"],
+                                        "contrasts",
+                                        "defer_pdf"],
                               output_names=["reports"],
                               function=write_mfx_report),
                      name="report")
@@ -138,10 +138,10 @@ def create_volume_mixedfx_workflow(name="volume_group",
             [("zstats", "in_file")]),
         (mergecope, boxplot,
             [("merged_file", "cope_file")]),
-        (cluster, boxplot,
-            [("localmax_txt_file", "localmax_file")]),
         (cluster, peaktable,
-            [("localmax_txt_file", "localmax_file")]),
+            [("threshold_file", "zstat_file")]),
+        (peaktable, boxplot,
+            [("csv_file", "peak_file")]),
         (cluster, overlay,
             [("threshold_file", "stat_image")]),
         (overlay, slicer,
@@ -155,13 +155,14 @@ def create_volume_mixedfx_workflow(name="volume_group",
         (boxplot, report,
             [("out_file", "boxplots")]),
         (peaktable, report,
-            [("out_file", "peak_tables")]),
+            [("rst_file", "peak_tables")]),
         (report, outputnode,
             [("reports", "reports")]),
         (cluster, outputnode,
             [("threshold_file", "thresh_zstat"),
-             ("index_file", "cluster_image"),
-             ("localmax_txt_file", "cluster_peaks")]),
+             ("index_file", "cluster_image")]),
+        (peaktable, outputnode,
+            [("csv_file", "cluster_peaks")]),
         (boxplot, outputnode,
             [("out_file", "boxplots")]),
         (maskpng, outputnode,
@@ -203,19 +204,19 @@ def mfx_mask_func(varcope_file, brain_mask, background_file):
     return out_file
 
 
-def mfx_boxplot(cope_file, localmax_file):
+def mfx_boxplot(cope_file, peak_file):
     """Plot the distribution of fixed effects COPEs at each local maximum."""
     from os.path import abspath
     from nibabel import load
     import matplotlib.pyplot as plt
-    import numpy as np
+    import pandas as pd
     import seaborn as sns
     sns.set()
 
     out_file = abspath("peak_boxplot.png")
-    peak_array = np.loadtxt(localmax_file, int, skiprows=1, usecols=(2, 3, 4))
+    peak_array = pd.read_csv(peak_file)[["i", "j", "k"]].values
 
-    if not peak_array.any():
+    if not len(peak_array):
         # If there wre no significant peaks, return an empty text file
         with open(out_file, "w") as f:
             f.write("")
@@ -243,7 +244,8 @@ def mfx_boxplot(cope_file, localmax_file):
 
 
 def write_mfx_report(subject_list, l1_contrast, mask_png,
-                     zstat_pngs, peak_tables, boxplots, contrasts):
+                     zstat_pngs, peak_tables, boxplots, contrasts,
+                     defer_pdf=False):
     import time
     from lyman.tools import write_workflow_report
     from lyman.workflows.reporting import mfx_report_template
@@ -291,5 +293,5 @@ def write_mfx_report(subject_list, l1_contrast, mask_png,
 
     out_files = write_workflow_report("mfx",
                                       mfx_report_template,
-                                      report_dict)
+                                      report_dict, defer_pdf)
     return out_files
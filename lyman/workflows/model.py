@@ -107,7 +107,8 @@ def create_timeseries_model_workflow(name="model", exp_info={}):
                                            "design_corr",
                                            "residual",
                                            "zstat_pngs",
-                                           "contrast_names"],
+                                           "contrast_names",
+                                           "defer_pdf"],
                               output_names=["reports"],
                               function=write_model_report),
                      iterfield=["design_image",
@@ -348,7 +349,7 @@ def dump_exp_info(exp_info, timeseries):
     from os.path import abspath
     import json
     json_file = abspath("experiment_info.json")
-    json_info = deepcopy(exp_info)
+    json_info = deepcopy(dict(exp_info))
     del json_info["contrasts"]
     with open(json_file, "w") as fp:
         json.dump(json_info, fp, sort_keys=True, indent=4)
@@ -356,7 +357,8 @@ def dump_exp_info(exp_info, timeseries):
 
 
 def write_model_report(subject_id, design_image, design_corr,
-                       residual, zstat_pngs, contrast_names):
+                       residual, zstat_pngs, contrast_names,
+                       defer_pdf=False):
     """Write model report info to rst and convert to pdf/html."""
     import time
     from lyman.tools import write_workflow_report
@@ -385,5 +387,5 @@ def write_model_report(subject_id, design_image, design_corr,
 
     out_files = write_workflow_report("model",
                                       model_report_template,
-                                      report_dict)
+                                      report_dict, defer_pdf)
     return out_files
@@ -186,7 +186,8 @@ def create_preprocessing_workflow(name="preproc",
                                                 "mean_func_slices",
                                                 "intensity_plot",
                                                 "outlier_volumes",
-                                                "coreg_report"],
+                                                "coreg_report",
+                                                "defer_pdf"],
                                    output_names=["out_files"],
                                    function=write_preproc_report),
                      iterfield=["input_timeseries",
@@ -808,7 +809,7 @@ def write_coreg_plot(subject_id, in_file):
 
 def write_preproc_report(subject_id, input_timeseries, realign_report,
                          mean_func_slices, intensity_plot, outlier_volumes,
-                         coreg_report):
+                         coreg_report, defer_pdf=False):
 
     import os.path as op
     import time
@@ -850,7 +851,7 @@ def write_preproc_report(subject_id, input_timeseries, realign_report,
     # Write the reports (this is sterotyped for workflows from here
     out_files = write_workflow_report("preproc",
                                       preproc_report_template,
-                                      report_dict)
+                                      report_dict, defer_pdf)
 
     # Return both report files as a list
     return out_files
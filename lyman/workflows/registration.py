@@ -12,7 +12,7 @@ from nipype.interfaces import freesurfer as surf
 from nipype.interfaces.utility import Function, IdentityInterface
 from nipype.pipeline.engine import Workflow, Node, MapNode
 
-spaces = ["epi", "mni"]
+from . import spaces
 
 def create_epi_reg_workflow(name="epi_reg", interp="spline"):
     """Set up a workflow to register several runs into the first run space."""
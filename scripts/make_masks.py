@@ -24,14 +24,35 @@ subject-level preprocessing to have been performed. This program
 should be executed from a directory containing a project.py file
 that defines the relevant data and analysis paths.
 
+Many ROIs can be made at once by passing a csv table to -table (see
+lyman.tools.maskfactory.read_roi_table for the columns). All of the
+jobs for each processing stage then share one execution queue, and if
+-roi is also given, an integer label volume with that name is written
+alongside the binary masks.
+
+Masks are only remade when their source file, the functional template,
+the registration, or the relevant arguments have changed since they
+were last written (as recorded in a .sources.json file next to each
+mask), so rerunning after adding subjects only processes the new
+subjects. Use -force to remake every mask.
+
 The script will also write a mosiac png with the mask overlaid on
-the mean functional image defining the epi space. Additionally, it
-will write a json file with the command line argument dictionary
-for provenence tracking.
+the mean functional image defining the epi space; with -sheet_dir, the
+mosaics for all subjects are also combined into one contact sheet.
+Additionally, it will write a json file with the command line argument
+dictionary for provenence tracking.
+
+With -stats, a csv table is written with the size of each mask and its
+overlap with the functional brain mask. These are counted as the masks
+are made. Adding -mni_overlap warps the masks to MNI space (this needs
+the anatomical normalization) to add each subject's mean Dice overlap
+with the other subjects, and writes a map of the fraction of subjects
+including each voxel next to the table.
 
 If an IPython cluster is running, the processing will be executed
-in parallel by default on all availible engines. This can be avoided
-by using the -serial option.
+in parallel by default on all availible engines. Otherwise, or when
+-nprocs is given, the commands run in a pool of local processes sized
+to the machine. This can be avoided by using the -serial option.
 
 """
 import sys
@@ -40,14 +61,40 @@ import time
 import os.path as op
 import argparse
 
-from lyman import MaskFactory
-
 
 def main(arglist):
 
     # Parse command line arguments
     args = parse_args(arglist)
 
+    factory_kws = dict(force_serial=args.serial, debug=args.debug,
+                       n_procs=args.nprocs, timeout=args.timeout,
+                       force=args.force, native_projection=args.native_proj,
+                       scratch_dir=args.scratch)
+
+    # Make a batch of ROIs from a table
+    if args.table is not None:
+        from lyman.tools.maskfactory import MaskFactory, read_roi_table
+        rois = read_roi_table(args.table)
+        factory = MaskFactory(args.subjects, args.exp, args.roi, "roi_table",
+                              **factory_kws)
+        factory.from_roi_table(rois, label_volume=args.roi is not None)
+        roi_names = [roi["roi"] for roi in rois]
+        factory.write_png(roi_names, args.sheet_dir)
+        write_stats(factory, roi_names, args)
+        factory.cleanup()
+
+        args.created = time.asctime()
+        for subj, updated in factory.updated_rois.items():
+            for roi in rois:
+                if roi["roi"] not in updated:
+                    continue
+                json_file = op.join(factory.data_dir, subj,
+                                    "masks/%s.json" % roi["roi"])
+                with open(json_file, "w") as fid:
+                    json.dump(dict(args.__dict__, **roi), fid, sort_keys=True)
+        return
+
     # Determine the type of processing we will do
     # First look for shortcut keys
     if args.label is not None:
@@ -69,8 +116,9 @@ def main(arglist):
         print "Processing type: %s" % orig_type
 
     # Initialise a factory object
+    from lyman import MaskFactory
     factory = MaskFactory(args.subjects, args.exp, args.roi, orig_type,
-                          args.serial, args.debug)
+                          **factory_kws)
 
     # Ensure that the orig file is an absolute path
     if args.orig is not None:
@@ -84,10 +132,8 @@ def main(arglist):
             file_temp = "%(hemi)s." + args.label + ".label"
         hemis = ["lh", "rh"] if args.hemi is None else [args.hemi]
         if args.sample is not None:
-            proj_args = dict(white=["frac", "0", "0", "0"],
-                             graymid=["frac", ".5", ".5", "0"],
-                             pial=["frac", "1", "1", "0"],
-                             cortex=["frac", "0", "1", ".1"])[args.sample]
+            from lyman.tools.maskfactory import projection_samples
+            proj_args = projection_samples[args.sample]
         else:
             proj_args = args.proj
         if orig_type == "native_label":
@@ -130,17 +176,28 @@ def main(arglist):
         factory.from_statistical_file(stat_file_temp, args.thresh)
 
     # Write an image of the mask
-    factory.write_png()
+    factory.write_png(sheet_dir=args.sheet_dir)
+    write_stats(factory, [args.roi], args)
+    factory.cleanup()
 
     # Get the current date
     args.created = time.asctime()
     # Write provenence information
-    for subj in factory.subject_list:
+    for subj in factory.updated_subjects:
         json_file = op.join(factory.data_dir, subj, "masks/%s.json" % args.roi)
         with open(json_file, "w") as fid:
             json.dump(args.__dict__, fid, sort_keys=True)
 
 
+def write_stats(factory, rois, args):
+    """Write the table of mask statistics if requested."""
+    if args.stats is None:
+        return
+    if args.mni_overlap:
+        factory.mni_overlap(rois, op.dirname(op.abspath(args.stats)))
+    factory.write_stats(args.stats, rois)
+
+
 def parse_args(arglist):
     """Handle the command line."""
     parser = argparse.ArgumentParser(description=__doc__,
@@ -150,8 +207,10 @@ def parse_args(arglist):
     parser.add_argument("-s", "-subjects", nargs="*", dest="subjects",
                         required=True,
                         help="subject ids or path to text file")
-    parser.add_argument("-roi", required=True,
+    parser.add_argument("-roi",
                         help="will form name out output mask file")
+    parser.add_argument("-table",
+                        help="csv file specifying a batch of rois")
     parser.add_argument("-exp",
                         help="experiment (can use default from project.py)")
 
@@ -172,6 +231,9 @@ def parse_args(arglist):
                         help="projection args passed directly mri_label2vol")
     parser.add_argument("-save_native", action="store_true",
                         help="save label file after warping from common space")
+    parser.add_argument("-native_proj", action="store_true",
+                        help="project fractional labels in-process "
+                             "instead of with mri_label2vol")
 
     # Atlas-type image relevant images
     parser.add_argument("-aseg", action="store_true",
@@ -191,10 +253,30 @@ def parse_args(arglist):
     # Generic execution relevant arguments
     parser.add_argument("-serial", action="store_true",
                         help="force serial execution")
+    parser.add_argument("-nprocs", type=int,
+                        help="run in a local pool of this many processes")
+    parser.add_argument("-timeout", type=float,
+                        help="seconds before an external command is killed")
+    parser.add_argument("-scratch",
+                        help="directory for temporary files ('ram' to use "
+                             "a memory-backed filesystem)")
+    parser.add_argument("-stats",
+                        help="csv file for voxel counts and overlap stats")
+    parser.add_argument("-mni_overlap", action="store_true",
+                        help="add inter-subject overlap in mni space to stats")
+    parser.add_argument("-sheet_dir",
+                        help="write a contact sheet of all subjects here")
+    parser.add_argument("-force", action="store_true",
+                        help="remake masks even if they are current")
     parser.add_argument("-debug", action="store_true",
                         help="enable debug mode")
 
-    return parser.parse_args(arglist)
+    args = parser.parse_args(arglist)
+    if args.roi is None and args.table is None:
+        parser.error("either -roi or -table is required")
+    if args.mni_overlap and args.stats is None:
+        parser.error("-mni_overlap requires -stats")
+    return args
 
 
 if __name__ == "__main__":
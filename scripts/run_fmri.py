@@ -9,12 +9,6 @@ import time
 import shutil
 import os.path as op
 
-import matplotlib as mpl
-mpl.use("Agg")
-from nipype.pipeline.engine import Node
-from nipype.interfaces.io import DataGrabber, DataSink
-from nipype.interfaces.utility import IdentityInterface
-
 import lyman.workflows as wf
 from lyman import tools
 from lyman.tools.commandline import parser
@@ -24,11 +18,20 @@ def main(arglist):
     """Main function for workflow setup and execution."""
     args = parse_args(arglist)
 
+    # Import the heavy dependencies only once the arguments are valid
+    import matplotlib as mpl
+    mpl.use("Agg")
+    from nipype.pipeline.engine import Node
+    from nipype.interfaces.io import DataGrabber
+    from lyman.tools import DataSink
+    from nipype.interfaces.utility import IdentityInterface
+
     # Get and process specific information
     project = tools.gather_project_info()
     if project["default_exp"] is not None and args.experiment is None:
         args.experiment = project["default_exp"]
-    exp = tools.gather_experiment_info(args.experiment, args.altmodel)
+    exp = tools.gather_experiment_info(args.experiment, args.altmodel,
+                                       copy=True)
 
     # Set up the SUBJECTS_DIR for Freesurfer
     os.environ["SUBJECTS_DIR"] = project["data_dir"]
@@ -53,6 +56,11 @@ def main(arglist):
     if not os.path.exists(anal_dir_base):
         os.makedirs(anal_dir_base)
 
+    # Records of which subjects have current outputs for each workflow
+    # These persist in the analysis directory across working dir cleanup
+    provenance = tools.ProvenanceStore(op.join(project["analysis_dir"],
+                                               ".provenance"))
+
     # Preprocessing Workflow
     # ======================
 
@@ -106,8 +114,18 @@ def main(arglist):
     # Configure crashdump output
     tools.crashdump_config(preproc, crashdump_dir)
 
+    # Skip subjects whose preprocessed data is current
+    preproc_params = dict((k, exp[k]) for k in [
+        "source_template", "n_runs", "slice_time_correction",
+        "frames_to_toss", "interleaved", "slice_order", "TR",
+        "smooth_fwhm", "hpf_sigma", "partial_fov"])
+    preproc_inputs = [op.join(project["data_dir"], exp["source_template"])]
+    preproc_stage = provenance.stage(
+        op.join(exp_name, "preproc"), preproc_params, preproc_inputs,
+        op.join(anal_dir_base, "%s", "preproc"))
+
     # Possibly execute the workflow, depending on the command line
-    tools.run_workflow(preproc, "preproc", args)
+    tools.run_workflow(preproc, "preproc", args, preproc_stage, subj_source)
 
     # Timeseries Model
     # ================
@@ -152,8 +170,18 @@ def main(arglist):
     model.base_dir = work_dir_base
     tools.crashdump_config(model, crashdump_dir)
 
+    # The model depends on the whole experiment definition
+    model_inputs = []
+    if "parfile_template" in exp and "parfile_base_dir" in exp:
+        model_inputs.append(op.join(exp["parfile_base_dir"],
+                                    exp["parfile_template"]))
+    model_stage = provenance.stage(
+        op.join(exp_name, "model", model_smooth), dict(exp), model_inputs,
+        op.join(anal_dir_base, "%s", "model", model_smooth),
+        upstream=op.join(args.experiment, "preproc"))
+
     # Possibly execute the workflow
-    tools.run_workflow(model, "model", args)
+    tools.run_workflow(model, "model", args, model_stage, subj_source)
 
     # Across-Run Registration
     # =======================
@@ -294,8 +322,28 @@ def main(arglist):
     reg.base_dir = work_dir_base
     tools.crashdump_config(reg, crashdump_dir)
 
+    reg_params = dict(space=space, interp=interp, smooth=reg_smooth,
+                      timeseries=args.timeseries,
+                      contrast_names=exp["contrast_names"])
+    reg_inputs = []
+    if space == "mni":
+        reg_inputs.append(field_template["warpfield"])
+    # Both kinds of registration write into the same directories, so
+    # they are tracked as separate stages that own different files
+    if args.timeseries:
+        reg_upstream = op.join(args.experiment, "preproc")
+        reg_mode, reg_filter = "timeseries", ("*timeseries*", None)
+    else:
+        reg_upstream = op.join(exp_name, "model", reg_smooth)
+        reg_mode, reg_filter = "model", (None, "*timeseries*")
+    reg_stage_name = op.join(exp_name, "reg", space, reg_smooth, reg_mode)
+    reg_stage = provenance.stage(
+        reg_stage_name, reg_params, reg_inputs,
+        op.join(anal_dir_base, "%s", "reg", space), upstream=reg_upstream,
+        output_filter=reg_filter)
+
     # Possibly run registration workflow and clean up
-    tools.run_workflow(reg, "reg", args)
+    tools.run_workflow(reg, "reg", args, reg_stage, subj_source)
 
     # Cross-Run Fixed Effects Model
     # -----------------------------
@@ -382,12 +430,26 @@ def main(arglist):
     ffx.base_dir = work_dir_base
     tools.crashdump_config(ffx, crashdump_dir)
 
+    ffx_params = dict(space=space, smooth=model_smooth,
+                      contrast_names=exp["contrast_names"])
+    ffx_inputs = []
+    if "background_file" in ffx_field_template:
+        ffx_inputs.append(ffx_field_template["background_file"])
+    ffx_stage = provenance.stage(
+        op.join(exp_name, "ffx", space, model_smooth), ffx_params,
+        ffx_inputs, op.join(anal_dir_base, "%s", "ffx", space, model_smooth),
+        upstream=reg_stage_name)
+
     # Possibly run fixed effects workflow
-    tools.run_workflow(ffx, "ffx", args)
+    tools.run_workflow(ffx, "ffx", args, ffx_stage, subj_source)
 
     # Clean-up
     # --------
 
+    if args.defer_pdf:
+        n_procs, _ = tools.plan_resources(args.nprocs)
+        tools.render_deferred_reports(anal_dir_base, n_procs)
+
     if project["rm_working_dir"]:
         shutil.rmtree(project["working_dir"])
 
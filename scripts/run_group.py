@@ -9,12 +9,6 @@ import time
 import shutil
 import os.path as op
 
-import matplotlib as mpl
-mpl.use("Agg")
-from nipype.pipeline.engine import Node, MapNode
-from nipype.interfaces.io import DataGrabber, DataSink
-from nipype.interfaces.utility import IdentityInterface
-
 import lyman.workflows as wf
 from lyman import tools
 from lyman.tools.commandline import parser
@@ -24,11 +18,20 @@ def main(arglist):
     """Main function for workflow setup and execution."""
     args = parse_args(arglist)
 
+    # Import the heavy dependencies only once the arguments are valid
+    import matplotlib as mpl
+    mpl.use("Agg")
+    from nipype.pipeline.engine import Node, MapNode
+    from nipype.interfaces.io import DataGrabber
+    from lyman.tools import DataSink
+    from nipype.interfaces.utility import IdentityInterface
+
     # Get and process specific information
     project = tools.gather_project_info()
     if project["default_exp"] is not None and args.experiment is None:
         args.experiment = project["default_exp"]
-    exp = tools.gather_experiment_info(args.experiment, args.altmodel)
+    exp = tools.gather_experiment_info(args.experiment, args.altmodel,
+                                       copy=True)
 
     if args.altmodel:
         exp_name = "-".join([args.experiment, args.altmodel])
@@ -111,6 +114,12 @@ def main(arglist):
     # Execute
     tools.run_workflow(mfx, args=args)
 
+    # Possibly convert the reports to pdf now that the run is done
+    if args.defer_pdf:
+        out_dir = op.join(anal_dir_base, args.output, args.regspace)
+        n_procs, _ = tools.plan_resources(args.nprocs)
+        tools.render_deferred_reports(out_dir, n_procs)
+
     # Clean up
     if project["rm_working_dir"]:
         shutil.rmtree(project["working_dir"])
@@ -3,14 +3,13 @@ import sys
 import shutil
 from lyman import tools
 from lyman.tools.commandline import parser
-from lyman.workflows import anatwarp
 
 
 def main(arglist):
 
     # Process cmdline args
     args = parser.parse_args(arglist)
-    plugin, plugin_args = tools.determine_engine(args)
+    from lyman.workflows import anatwarp
 
     # Load up the lyman info
     subject_list = tools.determine_subjects(args.subjects)
@@ -23,7 +22,7 @@ def main(arglist):
     tools.crashdump_config(normalize, "/tmp")
 
     # Execute the workflow
-    normalize.run(plugin=plugin, plugin_args=plugin_args)
+    tools.run_workflow(normalize, args=args)
 
     # Clean up
     if project["rm_working_dir"]: